@@ -4,39 +4,180 @@ import streamlit.components.v1 as stc
 # File Processing Pkgs
 import pandas as pd
 import numpy as np
-import base64
+import hashlib
+import io
+import os
 import datetime as dt
+from manifest_utils import crosstab, check_plate_wells, check_plate_wells_incremental, hash_rows, plate_grid, fill_missing, recode
+from stage_timer import StageTimer, null_timer
+from manifest_store import table_bytes
+from numeric_profile import profile
+from sample_id_index import SampleIDIndex, index_path
+from manifest_rules import upload_rules, validate_incremental, find_issue, cell_errors, vocab, numeric_cols, read_manifest, known_cols
 # import matplotlib.pyplot as plt # don't work...
 today = dt.datetime.today()
 version = f'{today.year}{today.month}{today.day}'
 
 
 
-def read_file(data_file):
-	if data_file.type == "text/csv":
-		df = pd.read_csv(data_file)
-	elif data_file.type == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":
-		df = pd.read_excel(data_file, sheet_name=0)
+# parsed uploads are kept per content hash (LRU, bounded by max_entries) so that
+# widget-triggered reruns reuse the DataFrame instead of re-parsing the file
+@st.cache_data(max_entries=16, show_spinner=False)
+def parse_upload(digest, file_type, _file_bytes):
+	# columns with a few distinct values are read as categoricals (manifest_rules.schema)
+	# xlsx: the sheet xml is parsed directly (manifest_xlsx), much faster than pd.read_excel
+	if file_type == "text/csv":
+		df = read_manifest(io.BytesIO(_file_bytes))
+	elif file_type == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":
+		df = read_manifest(io.BytesIO(_file_bytes), excel=True, usecols=known_cols) # the template columns only
 	return (df)
 
-def get_table_download_link(df):
-	"""Generates a link allowing the data in a given panda dataframe to be downloaded
-	in:  dataframe
-	out: href string
+def upload_digest(data_file):
+	return hashlib.sha256(data_file.getvalue()).hexdigest()
+
+def read_file(data_file, digest=None):
+	if digest is None:
+		digest = upload_digest(data_file)
+	return parse_upload(digest, data_file.type, data_file.getvalue())
+
+def upload_record(df, data_file, choice, max_entries=8):
+	"""states of the incremental checks of the last upload of the same study, file name and menu
+	in this session (a dict, updated by revalidate and check_plates), so that a corrected manifest
+	is re-checked only for the changed rows
+	"""
+	uploads = st.session_state.setdefault('uploads', {})
+	key = (str(df.study.iloc[0]) if 'study' in df.columns and len(df)>0 else '', data_file.name, choice)
+	record = uploads.pop(key, {})
+	uploads[key] = record # the most recent last
+	while len(uploads) > max_entries:
+		uploads.pop(next(iter(uploads)))
+	return record
+
+def revalidate(df, record, keys):
+	"""validate_incremental against the last upload (record of upload_record)
+	out: (issues, changed rows, the file was uploaded before)
+	"""
+	prev = record.get('rules')
+	issues, state, changed = validate_incremental(df, upload_rules, prev, keys)
+	if state is not None: # the previous state is kept e.g. if columns are missing
+		record['rules'] = state
+	return issues, changed, prev is not None
+
+# derived QC column --> the original column it is mapped from
+derived_cols = {'Phenotype':'study_arm', 'sex_for_qc':'sex', 'race_for_qc':'race',
+				'family_history_for_qc':'family_history', 'region_for_qc':'region'}
+
+def cached_stage(name, deps, func):
+	"""Returns func() computed on a previous rerun if deps did not change since then.
+	deps must cover everything func reads (upload digest, mapping dict, ...)
+	"""
+	stages = st.session_state.setdefault('stages', {})
+	if name not in stages or stages[name][0] != deps:
+		stages[name] = (deps, func())
+	return stages[name][1]
+
+def derive_column(df, target, mapdic):
+	"""Creates the derived column target from its original column with mapdic
+	and cross-tabulates the two.
+	out: (derived column, crosstab)
+	"""
+	source = derived_cols[target]
+	if target == 'Phenotype':
+		col = df.study_arm.map(mapdic)
+	elif target == 'sex_for_qc':
+		col = recode(df.sex, mapdic)
+	else:
+		col = fill_missing(df[source], 'Not Reported').map(mapdic)
+		if target != 'race_for_qc':
+			col = fill_missing(col, 'Not Assigned')
+	col = col.rename(target)
+	source_na = None if target in ['Phenotype', 'sex_for_qc'] else '_Missing'
+	xtab = crosstab(col, df[source], df.sample_id, columns_na=source_na)
+	return col, xtab
+
+def check_plates(df, n_wells=96, record=None, keys=None):
+	"""Cross-tabulates Plate_name x study_arm and checks N, duplicated and out of range positions
+	for all plates at once. With record (of upload_record) and the row keys, only the plates
+	changed since the last upload are checked (check_plate_wells_incremental)
+	out: (crosstab, output of check_plate_wells, list of error messages)
+	"""
+	errors = []
+	xtab = crosstab(df.Plate_name, df.study_arm, df.sample_id, index_na='_Missing')
+
+	if record is None:
+		wells = check_plate_wells(df.Plate_name, df.Plate_position, n_wells)
+	else:
+		wells, record['plates'] = check_plate_wells_incremental(df.Plate_name, df.Plate_position, keys,
+																record.get('plates'), n_wells)
+	for plate in wells['over_capacity'].index:
+		errors.append(f'Please make sure, N of samples on plate [{plate}] is =<{n_wells}')
+	for plate, dup_pos in wells['duplicated'].groupby('Plate_name', sort=False).Plate_position:
+		errors.append(f' !!!SERIOUS ERROR!!!  Plate position duplicated position {list(dup_pos)} on plate [{plate}]')
+	for plate, bad_pos in wells['out_of_range'].groupby('Plate_name', sort=False).Plate_position:
+		errors.append(f' !!!SERIOUS ERROR!!!  Plate position {list(bad_pos)} not on a {n_wells}-well plate [{plate}]')
+	return xtab, wells, errors
+
+def well_colors(grid):
+	# empty wells blank, used wells green and duplicated wells red
+	colors = np.select([grid>1, grid==1], ['background-color: #f4a3a3', 'background-color: #a8d5a2'], '')
+	return pd.DataFrame(colors, index=grid.index, columns=grid.columns)
+
+def map_stage(df, digest, target, mapdic):
+	"""Keeps mapdic in st.session_state and recomputes the derived column only
+	when the upload or this mapping changed. The other derived columns stay cached.
+	"""
+	st.session_state.setdefault('mappings', {})[target] = mapdic
+	return cached_stage(target, (digest, mapdic), lambda: derive_column(df, target, mapdic))
+
+# global sample ID index (sample_id_index.build_index), reopened when the index file changes
+@st.cache_resource
+def open_sample_index(path, mtime):
+	return SampleIDIndex(path, read_only=True)
+
+def sample_id_collisions(df, digest):
+	"""sample_id of the upload already used by the finalized manifests (any study).
+	None if there is no index
 	"""
-	csv = df.to_csv(index=False)
+	keys_path = os.path.splitext(index_path)[0] + '.keys.npy'
+	if not (os.path.exists(index_path) and os.path.exists(keys_path)):
+		return None
+	index = open_sample_index(index_path, os.stat(keys_path).st_mtime_ns)
+	return cached_stage('sample_index', (digest, os.stat(keys_path).st_mtime_ns), lambda: index.collisions(df))
+
+# download formats (manifest_store.table_bytes) --> mime type
+download_types = {'csv':'text/csv', 'csv.gz':'application/gzip', 'parquet':'application/vnd.apache.parquet'}
+
+def download_button(df, deps, fmt='csv'):
+	"""Download button of the QCed table. The file is built once per deps
+	(everything the table depends on) and kept for the following reruns
+	"""
+	data = cached_stage('download', (deps, fmt), lambda: table_bytes(df, fmt))
 	study_code = df.study.unique()[0]
-	b64 = base64.b64encode(csv.encode()).decode()  # some strings <-> bytes conversions necessary here
-	href = f'<a href="data:file/csv;base64,{b64}"  download="{study_code}_sample_manifest_selfQC_{version}.csv">Download csv file</a>'
-	return href
+	st.download_button(f'Download {fmt} file', data, file_name=f'{study_code}_sample_manifest_selfQC_{version}.{fmt}',
+					   mime=download_types[fmt], on_click='ignore')
 	
+def debug_timer():
+	# timer of the checks if the debug panel is on (the checkboxes are drawn by show_timings)
+	return StageTimer(memory=st.session_state.get('debug_memory', False),
+					  enabled=st.session_state.get('debug_timings', False))
+
+def show_timings(timer):
+	# debug panel in the sidebar: time (and peak memory) of each check of this rerun
+	st.sidebar.markdown('---')
+	st.sidebar.checkbox('Debug: show timings of the checks', key='debug_timings')
+	if timer.enabled:
+		st.sidebar.checkbox('Trace memory (slow)', key='debug_memory')
+		report = timer.report()
+		st.sidebar.dataframe(report, hide_index=True)
+		st.sidebar.text(f'Total: {report.wall_sec.sum():.3f} sec')
+
 # @st.cache
 # def load_image(image_file):
 # 	img = Image.open(image_file)
 # 	return img 
 
 
-def main():
+def main(timer=null_timer):
 	menu = ["For Fulgent", "For NIH"]
 	choice = st.sidebar.selectbox("Menu",menu)
 	flag=0
@@ -44,19 +185,6 @@ def main():
 	sex_conf=''
 	race_conf = ''
 	fh_conf=''
-	cols = ['study', 'sample_id', 'sample_type',
-		'DNA_volume', 'DNA_conc', 'r260_280',
-		'Plate_name', 'Plate_position', 'clinical_id', 
-		'study_arm', 'sex', 'race', 
-		'age', 'age_of_onset', 'age_at_diagnosis', 'age_at_death', 'family_history',
-		'region', 'comment', 'alternative_id1', 'alternative_id2']
-	required_cols = ['study', 'sample_id', 'sample_type', 'clinical_id','study_arm', 'sex']
-	allowed_samples=['Blood (EDTA)', 'Blood (ACD)', 'Blood', 'DNA', 
-					'DNA from blood', 'DNA from FFPE', 'RNA', 'Saliva', 
-					'Buccal Swab', 'T-25 Flasks (Amniotic)', 'FFPE Slide',
-					'FFPE Block', 'Fresh tissue', 'Frozen tissue', 
-					'Bone Marrow Aspirate', 'Whole BMA', 'CD3+ BMA', 'Other']
-	fulgent_cols = ['DNA_volume', 'DNA_conc', 'Plate_name', 'Plate_position']
 	data_file = st.sidebar.file_uploader("Upload Sample Manifest (CSV/XLSX) [Currently only CSV!]", type=['csv', 'xlsx'])
 	
 
@@ -73,36 +201,47 @@ def main():
 		# st.write(file_details)
 		
 		# read a file
-		df = read_file(data_file)
+		digest = upload_digest(data_file)
+		df = read_file(data_file, digest)
 		df['Genotyping_site'] = choice.replace('For ', '')
-		if choice=='For Fulgent':
-			required_cols = required_cols + fulgent_cols
+		timer.lap('read file')
+
+		# all the checks of manifest_rules.upload_rules at once (only the changed rows if uploaded before)
+		record = upload_record(df, data_file, choice)
+		keys = cached_stage('row_keys', (digest, choice), lambda: hash_rows(df)) # to find the changed rows
+		issues, changed, uploaded_before = cached_stage('rules', (digest, choice), lambda: revalidate(df, record, keys))
+		timer.lap('rule checks')
 		
 		# missing col check
-		missing_cols = np.setdiff1d(cols, df.columns)
+		missing_cols = issues.column[issues.kind=='column'].to_numpy()
 		if len(missing_cols)>0:
 			st.error(f'{missing_cols} are missing. Please use the template sheet')
 			return
 		
 		else:
 			st.text('Check column names--> OK')
-			df_non_miss_check = df[required_cols].copy()
+		if uploaded_before:
+			st.text(f'N of rows changed since the last upload of {data_file.name}: {changed.sum()}')
+			if changed.any():
+				with st.expander('Changed rows'):
+					st.write(df[changed].head(1000))
 		
 		# required columns checks
-		if df_non_miss_check.isna().sum().sum()>0:
+		missing = issues[issues.kind=='missing']
+		if len(missing)>0:
 			st.error('There are some missing entries in the required columns. Please fill the missing cells ')
 			st.text('First ~30 columns with missing data in any required fields')
-			st.write(df_non_miss_check[df_non_miss_check.isna().sum(1)>0].head(20))
+			rows = np.unique(np.concatenate(missing.rows.tolist()))
+			st.write(df.iloc[rows[:20]][['sample_id'] + [v for v in missing.column.unique() if v!='sample_id']])
 			flag=1
 		
 		else:
 			st.text('Check missing data in the required fields --> OK')
-			sample_id_dup = df.sample_id[df.sample_id.duplicated()].unique()
 		
 		# sample dup check
-		if len(sample_id_dup)>0:
-			sample_id_dup = df.sample_id[df.sample_id.duplicated()].unique()
-			st.text(f'Duplicated sample_id:{sample_id_dup}')
+		sample_id_dup = find_issue(issues, 'sample_id', 'unique')
+		if sample_id_dup is not None:
+			st.text(f'Duplicated sample_id:{sample_id_dup["values"]}')
 			st.error(f'Unique sample IDs are required (clinical IDs can be duplicated if replicated)')
 			flag=1
 		else:
@@ -110,105 +249,107 @@ def main():
 			st.text(f'N of sample_id (entries):{df.shape[0]}')
 			st.text(f'N of unique clinical_id : {len(df.clinical_id.unique())}')
 
+		# sample_id used by the earlier manifests (all studies)
+		collisions = sample_id_collisions(df, digest)
+		if collisions is not None and len(collisions)>0:
+			st.error(f'{collisions.id.nunique()} sample_id already used in the finalized manifests. Please use new sample IDs')
+			st.write(collisions.drop(columns='column').rename(columns={'col':'used as'}).head(1000))
+			flag=1
+		elif collisions is not None:
+			st.text('Check sample_id against the finalized manifests --> OK')
+
 		# sample type check
 		st.text('sample_type check')
 		st.write(df.sample_type.astype('str').value_counts())
-		not_allowed = np.setdiff1d(df.sample_type.unique(), allowed_samples)
-		if len(not_allowed)>0:
-			st.error(f'sample_type: {not_allowed} not allowed.')
-			sample_list = '\n * '.join(allowed_samples)
+		not_allowed = find_issue(issues, 'sample_type', 'vocab')
+		if not_allowed is not None:
+			st.error(f'sample_type: {not_allowed["values"]} not allowed.')
+			sample_list = '\n * '.join(vocab['sample_type'])
 			st.text(f'Allowed sample list - \n * {sample_list}')
 			flag=1
+		timer.lap('sample checks')
 
 
 
 		# study_arm --> Phenotype
 		st.subheader('Create "Phenotype"')
 		st.text('Count per study_arm')
-		st.write(df.study_arm.astype('str').value_counts())
-		arms=df.study_arm.dropna().unique()
+		st.write(cached_stage('study_arm_counts', digest, lambda: df.study_arm.astype('str').value_counts()))
+		arms = cached_stage('study_arm_levels', digest, lambda: df.study_arm.dropna().unique())
 		n_arms = st.columns(len(arms))
 		phenotypes={}
 		for i, x in enumerate(n_arms):
 			with x:
 				arm = arms[i]
-				phenotypes[arm]=x.selectbox(f"[{arm}]: For QC, please pick the closest Phenotype",["PD", "Control", "Prodromal", "Other", "Not Reported"], key=i)
-		df['Phenotype'] = df.study_arm.map(phenotypes)
+				phenotypes[arm]=x.selectbox(f"[{arm}]: For QC, please pick the closest Phenotype",vocab['Phenotype'], key=f'Phenotype_{i}')
+		df['Phenotype'], xtab = map_stage(df, digest, 'Phenotype', phenotypes)
 
 		# cross-tabulation of study_arm and Phenotype
 		st.text('=== Phenotype x study_arm===')
-		xtab = df.pivot_table(index='Phenotype', columns='study_arm', margins=True,
-								values='sample_id', aggfunc='count', fill_value=0)
 		st.write(xtab)
 		
 		ph_conf = st.checkbox('Confirm Phenotype?')
 		if ph_conf:
 			st.info('Thank you')
+		timer.lap('Phenotype')
 		
 
 		# sex for qc
 		st.subheader('Create "sex_for_qc"')
 		st.text('Count per sex group')
-		st.write(df.sex.astype('str').value_counts())
-		sexes=df.sex.dropna().unique()
+		st.write(cached_stage('sex_counts', digest, lambda: df.sex.astype('str').value_counts()))
+		sexes = cached_stage('sex_levels', digest, lambda: df.sex.dropna().unique())
 		n_sexes = st.columns(len(sexes))
 		mapdic={}
 		for i, x in enumerate(n_sexes):
 			with x:
 				sex = sexes[i]
 				mapdic[sex]=x.selectbox(f"[{sex}]: For QC, please pick a word below", 
-									["Male", "Female", "Intersex", "Unknown", "Other", "Not Reported"], key=i)
-		df['sex_for_qc'] = df.sex.replace(mapdic)
+									vocab['sex'], key=f'sex_for_qc_{i}')
+		df['sex_for_qc'], xtab = map_stage(df, digest, 'sex_for_qc', mapdic)
 
 		# cross-tabulation of study_arm and Phenotype
 		st.text('=== sex_for_qc x sex ===')
-		xtab = df.pivot_table(index='sex_for_qc', columns='sex', margins=True,
-								values='sample_id', aggfunc='count', fill_value=0)
 		st.write(xtab)
 		
 		sex_conf = st.checkbox('Confirm sex_for_qc?')
 		if sex_conf:
 			st.info('Thank you')
+		timer.lap('sex_for_qc')
 
 		# race for qc
 		st.subheader('Create "race_for_qc"')
 		st.text('Count per race (Not Reported = missing)')
-		df['race_for_qc'] = df.race.fillna('Not Reported')
-		st.write(df.race_for_qc.astype('str').value_counts())
-		races = df.race.dropna().unique()
-		nmiss = sum(pd.isna(df.race))
+		st.write(cached_stage('race_counts', digest, lambda: fill_missing(df.race, 'Not Reported').astype('str').value_counts()))
+		races = cached_stage('race_levels', digest, lambda: df.race.dropna().unique())
+		nmiss = cached_stage('race_nmiss', digest, lambda: df.race.isna().sum())
 
 		if nmiss>0:
 			st.text(f'{nmiss} entries missing race...')
 			
 		
 		mapdic = {'Not Reported':'Not Reported'}
-		for race in races:
+		for i, race in enumerate(races):
 			mapdic[race]=st.selectbox(f"[{race}]: For QC purppose, select the best match from the followings",
-			["American Indian or Alaska Native", "Asian", "White", "Black or African American", 
-			"Multi-racial", "Native Hawaiian or Other Pacific Islander", "Other", "Unknown", "Not Reported"])
-		df['race_for_qc'] = df.race_for_qc.map(mapdic)
+			vocab['race'], key=f'race_for_qc_{i}')
+		df['race_for_qc'], xtab = map_stage(df, digest, 'race_for_qc', mapdic)
 		
 		# cross-tabulation
 		st.text('=== race_for_qc X race ===')
-		dft = df.copy()
-		dft['race'] = dft.race.fillna('_Missing')
-		xtab = dft.pivot_table(index='race_for_qc', columns='race', margins=True,
-								values='sample_id', aggfunc='count', fill_value=0)
 		st.write(xtab)
 		
 		race_conf = st.checkbox('Confirm race_for_qc?')
 		if race_conf:
 			st.info('Thank you')
+		timer.lap('race_for_qc')
 		
 
 		# family history for qc
 		st.subheader('Create "family_history_for_qc"')
 		st.text('Count per family_history category (Not Reported = missing)')
-		df['family_history_for_qc'] = df.family_history.fillna('Not Reported')
-		st.write(df.family_history_for_qc.astype('str').value_counts())
-		family_historys = df.family_history.dropna().unique()
-		nmiss = sum(pd.isna(df.family_history))
+		st.write(cached_stage('family_history_counts', digest, lambda: fill_missing(df.family_history, 'Not Reported').astype('str').value_counts()))
+		family_historys = cached_stage('family_history_levels', digest, lambda: df.family_history.dropna().unique())
+		nmiss = cached_stage('family_history_nmiss', digest, lambda: df.family_history.isna().sum())
 
 		if nmiss>0:
 			st.text(f'{nmiss} entries missing family_history')
@@ -219,29 +360,25 @@ def main():
 			for i, x in enumerate(n_fhs):
 				with x:
 					fh = family_historys[i]
-					mapdic[fh]=x.selectbox(f'[{fh}]: For QC, any family history?',['Yes', 'No', 'Not Reported'], key=i)
-		df['family_history_for_qc'] = df.family_history_for_qc.map(mapdic).fillna('Not Assigned')
+					mapdic[fh]=x.selectbox(f'[{fh}]: For QC, any family history?',['Yes', 'No', 'Not Reported'], key=f'family_history_for_qc_{i}')
+		df['family_history_for_qc'], xtab = map_stage(df, digest, 'family_history_for_qc', mapdic)
 
 		# cross-tabulation 
 		st.text('=== family_history_for_qc X family_history ===')
-		dft = df.copy()
-		dft['family_history'] = dft.family_history.fillna('_Missing')
-		xtab = dft.pivot_table(index='family_history_for_qc', columns='family_history', margins=True,
-								values='sample_id', aggfunc='count', fill_value=0)
 		st.write(xtab)
 
 		fh_conf = st.checkbox('Confirm family_history_for_qc?')
 		if fh_conf:
 			st.info('Thank you')
+		timer.lap('family_history_for_qc')
 
 
 		# region for qc
 		st.subheader('Create "region_for_qc"')
 		st.text('Count per region (Not Reported = missing)')
-		df['region_for_qc'] = df.region.fillna('Not Reported')
-		st.write(df.region_for_qc.astype('str').value_counts())
-		regions = df.region.dropna().unique()
-		nmiss = sum(pd.isna(df.region))
+		st.write(cached_stage('region_counts', digest, lambda: fill_missing(df.region, 'Not Reported').astype('str').value_counts()))
+		regions = cached_stage('region_levels', digest, lambda: df.region.dropna().unique())
+		nmiss = cached_stage('region_nmiss', digest, lambda: df.region.isna().sum())
 		if nmiss>0:
 			st.text(f'{nmiss} entries missing for region')
 		
@@ -254,17 +391,13 @@ def main():
 			for i, x in enumerate(n_rgs):
 				with x:
 					region = regions[i]
-					region_to_map = x.text_input(f'[{region}] in 3 LETTER (or NA)')
+					region_to_map = x.text_input(f'[{region}] in 3 LETTER (or NA)', key=f'region_for_qc_{i}')
 					if len(region_to_map)>1:
 						mapdic[region]=region_to_map
-		df['region_for_qc'] = df.region_for_qc.map(mapdic).fillna('Not Assigned')
+		df['region_for_qc'], xtab = map_stage(df, digest, 'region_for_qc', mapdic)
 
 		# cross-tabulation 
 		st.text('=== region_for_qc X region ===')
-		dft = df.copy()
-		dft['region'] = dft.region.fillna('_Missing')
-		xtab = dft.pivot_table(index='region_for_qc', columns='region', margins=True,
-								values='sample_id', aggfunc='count', fill_value=0)
 		st.write(xtab)
 
 		rg_conf = st.checkbox('Confirm regino_for_qc?')
@@ -274,6 +407,7 @@ def main():
 				flag=1
 			else:
 				st.info('Thank you')
+		timer.lap('region_for_qc')
 
 
 
@@ -281,58 +415,73 @@ def main():
 
 		# Plate Info
 		st.subheader('Plate Info')
-		dft = df.copy()
-		dft['Plate_name'] = dft.Plate_name.fillna('_Missing')
-		xtab = dft.pivot_table(index='Plate_name', 
-							columns='study_arm', margins=True,
-							values='sample_id', aggfunc='count', fill_value=0)
+		xtab, wells, plate_errors = cached_stage('plates', (digest, choice), lambda: check_plates(df, 96, record, keys))
 		st.write(xtab)
-
-		for plate in dft.Plate_name.unique():
-			df_plate = dft[dft.Plate_name==plate].copy()
-			df_plate_pos = df_plate.Plate_position
-			# duplicated position check
-			if plate!='_Missing':
-				if len(df_plate_pos)>96:
-					st.error('Please make sure, N of samples on plate [{plate}] is =<96')
-					flag=1
-				dup_pos = df_plate_pos[df_plate_pos.duplicated()].unique()
-				if len(dup_pos)>0:
-					st.error(f' !!!SERIOUS ERROR!!!  Plate position duplicated position {dup_pos} on plate [{plate}]')
-					flag=1
+		for er in plate_errors:
+			st.error(er)
+			flag=1
+		if len(wells['n_samples'])>0:
+			plate = st.selectbox('Plate layout (N of samples per well)', wells['n_samples'].index, key='plate_layout')
+			st.dataframe(plate_grid(wells, plate).style.apply(well_colors, axis=None))
+		timer.lap('plate check')
 
 		# Numeric values
 		st.subheader('Numeric Values')
-		numerics_cols = ['DNA_volume', 'DNA_conc', 'r260_280','age', 'age_of_onset', 'age_at_diagnosis', 'age_at_death']
 		flag3 = 0
-		for v in numerics_cols:
-			if df.dtypes[v] not in ['float64', 'int64']:
-				st.error(f'{v} is not numeric')
-				flag=1
-				flag3=1
+		for x in issues[issues.kind=='numeric'].itertuples():
+			st.error(f'{x.column} is not numeric: {list(x.values[:10])} in {x.n} entries (see Errors by cell)')
+			flag=1
+			flag3=1
 		if flag3==0:
 			st.text('Numeric chek --> OK. Check the distribution with the below button')
+			# all the numeric columns profiled at once, once per upload (numeric_profile)
+			prof = cached_stage('numeric_profile', digest, lambda: profile(df))
+			for x in prof['violations'].itertuples():
+				st.warning(f'{x.check}: {x.n} entries. Please check the values')
+				st.write(df.iloc[x.rows[:20]][['sample_id'] + [v for v in numeric_cols if v in x.check]])
 
 			if st.button("Check Distribution"):
-				for v in numerics_cols:
-					nmiss = df[v].isna().sum()
-					vuniq = df[v].dropna().unique()
-					nuniq = len(vuniq)
+				for v in numeric_cols:
+					nmiss = prof['summary'].n_missing[v]
+					nuniq = prof['summary'].n_distinct[v]
 					if nuniq==0:
 						st.text(f'{v} - All missing')
 					elif nuniq==1:
-						st.text(f'{v} - One value = {vuniq[0]}, ({nmiss} entries missing)')
+						st.text(f'{v} - One value = {prof["values"][v].index.dropna()[0]}, ({nmiss} entries missing)')
 					elif nuniq <6:
-						st.write(df[v].value_counts(dropna=False))
+						st.write(prof['values'][v])
 					else:
 						st.text(f'{v} - histgram ({nmiss} entries missing)')
-						hist_values=np.histogram(df[v].dropna())[0]
-						st.bar_chart(hist_values, )
+						st.bar_chart(prof['hist'][v][0], )
+		timer.lap('numeric check')
+
+		# all the failed checks down to the cells (row, column), browsable by column and kind
+		st.subheader('Errors by cell')
+		cells = cached_stage('cell_errors', (digest, choice), lambda: cell_errors(df, issues, n_wells=96))
+		if len(cells)==0:
+			st.text('No cell with an error --> OK')
+		else:
+			st.text(f'{len(cells)} cells in {cells.row.nunique()} rows (row: 0-based, the header not counted)')
+			col1, col2, col3 = st.columns(3)
+			columns = col1.multiselect('Column', list(cells.column.cat.categories), key='cell_columns')
+			kinds = col2.multiselect('Error', list(cells.kind.cat.categories), key='cell_kinds')
+			page_size = col3.selectbox('Rows per page', [50, 200, 1000], key='cell_page_size')
+			keep = np.ones(len(cells), bool)
+			if len(columns)>0:
+				keep &= cells.column.isin(columns).to_numpy()
+			if len(kinds)>0:
+				keep &= cells.kind.isin(kinds).to_numpy()
+			view = cells[keep]
+			n_pages = max(1, -(-len(view) // page_size))
+			page = st.number_input(f'Page (of {n_pages})', min_value=1, max_value=n_pages, value=1)
+			st.dataframe(view.iloc[(page-1)*page_size:page*page_size], hide_index=True)
+		timer.lap('cell errors')
 
 		# Sample Submitter
 		st.subheader('Sample Submitter')
 		Submitter = st.text_input('First name initial + ". (dot&space)" + last name" (e.g.- H. Morris)')
 		df['Sample_submitter'] = Submitter
+		download_fmt = st.selectbox('Download format', list(download_types), key='download_format')
 
 		if st.button("Finished?"):
 			st.text("If everything is good, you will see the download link for the qced data")
@@ -343,10 +492,16 @@ def main():
 			elif not (ph_conf & sex_conf & race_conf & fh_conf & rg_conf):
 				st.error('Forget to confirm?')
 			else:
-				st.markdown(get_table_download_link(df), unsafe_allow_html=True)
+				mappings = dict(st.session_state.get('mappings', {})) # the mappings of this rerun
+				download_button(df, (digest, choice, mappings, Submitter), download_fmt)
+				timer.lap('download file')
 
 # git add app.py;git commit -m "debug";git push -u origin main
 
 if __name__ == '__main__':
-	main()
+	with debug_timer() as timer:
+		try:
+			main(timer)
+		finally:
+			show_timings(timer)
 
@@ -0,0 +1,211 @@
+# headless QC (and GP2ID assignment) of many sample manifests with a process pool
+# python batch_qc.py 'manifests/*.csv' --out qc_reports
+# python batch_qc.py manifests/ --assign --repo_dir /path/to/sample_manifest --format parquet --registry gp2id_registry.sqlite
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import io
+import json
+import os
+import re
+import time
+import pandas as pd
+from manifest_func2 import checkSampleManifest, giveGP2ID
+from manifest_store import ManifestStore
+from sample_id_index import SampleIDIndex
+from manifest_rules import read_manifest, known_cols
+from stage_timer import StageTimer
+
+
+def list_manifests(paths):
+  # csv/xlsx files of the directories and globs (in the order given, sorted within each)
+  files = []
+  for p in paths:
+    if os.path.isdir(p):
+      p = os.path.join(p, '*')
+    files += sorted(f for f in glob.glob(p) if f.lower().endswith(('.csv', '.xlsx')))
+  return list(dict.fromkeys(files))
+
+
+def read_file(path):
+  # manifest_rules.read_manifest of a csv/xlsx file (xlsx: the template columns only, as the app)
+  if path.lower().endswith('.xlsx'):
+    return read_manifest(path, excel=True, usecols=known_cols)
+  return read_manifest(path)
+
+
+def manifest_id_of(path, default=None):
+  # manifest_id from the file name (..._m3.csv --> m3)
+  m = re.search(r'_(m\d+)\.(csv|xlsx)$', os.path.basename(path))
+  return m.group(1) if m else default
+
+
+def issue_records(issues, max_rows=1000):
+  # output of validate as json-able records (the first max_rows rows of each issue)
+  return [{'column':x.column, 'kind':x.kind, 'severity':x.severity, 'n':int(x.n),
+           'values':[str(v) for v in x.values], 'rows':[int(i) for i in x.rows[:max_rows]]}
+          for x in issues.itertuples()]
+
+
+def qc_file(path, out_dir, dup_not_allowed=True, n_wells=96, sample_index=None):
+  """
+  checkSampleManifest of a file. Writes {out_dir}/{file name}.log (printed output)
+  and {out_dir}/{file name}.json (report)
+  sample_index: path of a sample_id_index file. sample_id already in the index --> CHECK (not assigned)
+  out: (report dict, QCed DataFrame or None)
+  """
+  name = os.path.basename(path)
+  t0 = time.perf_counter()
+  report = {'file':path, 'status':'FAIL'}
+  log = io.StringIO()
+  x = None
+  try:
+    data = read_file(path)
+    report['n_rows'] = data.shape[0]
+    report['studies'] = [str(v) for v in data.study.dropna().unique()] if 'study' in data.columns else []
+    qc = {} # the rule checks of checkSampleManifest (not run again here)
+    with StageTimer() as timer, contextlib.redirect_stdout(log):
+      x = checkSampleManifest(data, dup_not_allowed, n_wells, timer=timer, report=qc)
+    report['issues'] = issue_records(qc['issues'])
+    report['stages'] = timer.report().to_dict('records')
+    if x is not None:
+      report['status'] = 'PASS' if 'QC' in x.columns else 'CHECK'
+      report['n_qced'] = x.shape[0]
+    if sample_index is not None:
+      index = SampleIDIndex(sample_index, read_only=True)
+      used = index.collisions(data)
+      index.close()
+      report['sample_id_used'] = used.drop(columns='column').head(1000).to_dict('records')
+      if len(used)>0 and report['status']=='PASS':
+        report['status'] = 'CHECK'
+  except Exception as e:
+    report['error'] = f'{type(e).__name__}: {e}'
+  report['sec'] = round(time.perf_counter() - t0, 3)
+  with open(os.path.join(out_dir, f'{name}.log'), 'w') as f:
+    f.write(log.getvalue())
+  with open(os.path.join(out_dir, f'{name}.json'), 'w') as f:
+    json.dump(report, f, indent=2)
+  return report, x
+
+
+def assign_study(study, items, out_dir, store, list_non_finalized_mid=[], registry=None, sample_index=None):
+  """
+  giveGP2ID of the samples of a study, one manifest after another (in the order of items).
+  Only this worker assigns the IDs of the study in this batch, and giveGP2ID holds the lock of the study
+  in the store, so other batches or curators assigning the same study wait.
+  items: list of (file, manifest_id, QCed DataFrame of the study)
+  store: manifest_store.ManifestStore of the previous/output files
+  sample_index: sample ID index file, the IDs of the assigned manifests are added to it
+  out: list of reports (one per manifest), status OK or FAIL (error)
+  """
+  reports = []
+  for path, manifest_id, x in items:
+    t0 = time.perf_counter()
+    report = {'file':path, 'study':study, 'manifest_id':manifest_id, 'status':'FAIL'}
+    log = io.StringIO()
+    try:
+      with contextlib.redirect_stdout(log):
+        x2 = giveGP2ID(x, manifest_id, list_non_finalized_mid, registry, store=store, sample_index=sample_index)
+      x3 = x2[x2.manifest_id==manifest_id]
+      report['n_samples'] = x3.shape[0]
+      report['n_GP2ID'] = x3.GP2ID.nunique()
+      report['output'] = store.find('qced', f'{study}_sample_manifest_qced_{manifest_id}')
+      report['status'] = 'OK'
+      if manifest_id not in list_non_finalized_mid: # the next manifest of the study reads it from qced
+        list_non_finalized_mid = list_non_finalized_mid + [manifest_id]
+    except Exception as e:
+      report['error'] = f'{type(e).__name__}: {e}'
+    report['sec'] = round(time.perf_counter() - t0, 3)
+    with open(os.path.join(out_dir, f'{study}_{manifest_id}.gp2id.log'), 'w') as f:
+      f.write(log.getvalue())
+    reports.append(report)
+  return reports
+
+
+def run_batch(files, out_dir, workers=None, assign=False, manifest_id=None, store=None,
+              list_non_finalized_mid=[], registry=None, dup_not_allowed=True, n_wells=96, sample_index=None):
+  """
+  1. checkSampleManifest of all files (one task per file), sample_id against sample_index if given
+  2. if assign, giveGP2ID of the PASSed files (one task per study, the manifests of the study in order)
+     with the previous/output files in store (default: manifest_store.get_store()).
+     The assigned manifests are added to sample_index
+  Reports are written in out_dir as well as summary.json and summary.csv
+  out: summary DataFrame (one row per file). With assign, gp2id_status (OK, FAIL if the assignment
+    of any study of the file failed) and n_GP2ID_assigned are added, and the errors of the assignment
+    are added to error
+  """
+  os.makedirs(out_dir, exist_ok=True)
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = [pool.submit(qc_file, f, out_dir, dup_not_allowed, n_wells, sample_index) for f in files]
+    results = [f.result() for f in futures]
+    reports = [r for r, _ in results]
+
+    assigned = []
+    if assign:
+      by_study = {}
+      for report, x in results:
+        if report['status']!='PASS':
+          continue
+        mid = manifest_id_of(report['file'], manifest_id)
+        if mid is None:
+          report['error'] = 'manifest_id not found in the file name (use --manifest_id)'
+          continue
+        for study, xs in x.groupby('study', sort=False):
+          by_study.setdefault(study, []).append((report['file'], mid, xs))
+      for items in by_study.values(): # manifests of a study in the order of manifest_id
+        items.sort(key=lambda v: int(v[1][1:]))
+      futures = [pool.submit(assign_study, study, items, out_dir, store or ManifestStore(),
+                             list_non_finalized_mid, registry, sample_index)
+                 for study, items in by_study.items()]
+      assigned = [r for f in futures for r in f.result()]
+
+  summary = pd.DataFrame([{'file':r['file'], 'status':r['status'], 'n_rows':r.get('n_rows'),
+                           'n_errors':sum(v['severity']=='error' for v in r.get('issues', [])),
+                           'n_warnings':sum(v['severity']=='warning' for v in r.get('issues', [])),
+                           'n_sample_id_used':len(r.get('sample_id_used', [])),
+                           'sec':r['sec'], 'error':r.get('error')} for r in reports])
+  if assign:
+    # a file of several studies has one assignment per study
+    gp2id = {}
+    for r in assigned:
+      g = gp2id.setdefault(r['file'], {'status':'OK', 'n':0, 'errors':[]})
+      g['n'] += r.get('n_samples', 0)
+      if r['status']!='OK':
+        g['status'] = 'FAIL'
+        g['errors'].append(f'GP2ID {r["study"]}_{r["manifest_id"]}: {r.get("error")}')
+    summary['gp2id_status'] = [gp2id[f]['status'] if f in gp2id else None for f in summary.file]
+    summary['n_GP2ID_assigned'] = pd.array([gp2id[f]['n'] if f in gp2id else None for f in summary.file], dtype='Int64')
+    summary['error'] = ['; '.join([v for v in [e] if pd.notna(e)] + (gp2id[f]['errors'] if f in gp2id else [])) or None
+                        for f, e in zip(summary.file, summary.error)]
+  summary.to_csv(os.path.join(out_dir, 'summary.csv'), index=False)
+  with open(os.path.join(out_dir, 'summary.json'), 'w') as f:
+    json.dump({'qc':reports, 'gp2id':assigned}, f, indent=2, default=str)
+  return summary
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='QC (and GP2ID assignment) of sample manifests in parallel')
+  parser.add_argument('paths', nargs='+', help='manifest files, directories or globs')
+  parser.add_argument('--out', default='qc_reports', help='output directory of the reports')
+  parser.add_argument('--workers', type=int, help='N of processes (default: N of CPUs)')
+  parser.add_argument('--allow_dup', action='store_true', help='dup_not_allowed=False')
+  parser.add_argument('--n_wells', type=int, default=96, choices=[96, 384], help='N of wells per plate')
+  parser.add_argument('--assign', action='store_true', help='giveGP2ID for the files passed the QC')
+  parser.add_argument('--manifest_id', help='manifest_id if not in the file name (..._m3.csv)')
+  parser.add_argument('--non_finalized', nargs='*', default=[], help='manifest_ids not finalized yet (list_non_finalized_mid)')
+  parser.add_argument('--repo_dir', help='sample_manifest folder (qced, finalized)')
+  parser.add_argument('--format', choices=['csv', 'parquet'], help='file format of the qced/finalized files')
+  parser.add_argument('--cache', help='local folder to keep copies of the previous manifests read from repo_dir')
+  parser.add_argument('--sample_index', help='sample ID index file (see sample_id_index.build_index)')
+  parser.add_argument('--registry', help='GP2ID registry file (see gp2id_registry.build_registry)')
+  args = parser.parse_args()
+
+  files = list_manifests(args.paths)
+  print(f'N of manifests: {len(files)}')
+  store = ManifestStore(args.repo_dir, args.format, args.cache)
+  summary = run_batch(files, args.out, args.workers, args.assign, args.manifest_id, store, args.non_finalized,
+                      args.registry, not args.allow_dup, args.n_wells, args.sample_index)
+  with pd.option_context('display.max_rows', None, 'display.width', 200):
+    print(summary)
+  print(f'\nReports saved in {args.out}')
@@ -0,0 +1,351 @@
+# benchmarks of the manifest QC functions
+# python benchmark.py --sizes 1000 100000 1000000 --out benchmark.json --compare benchmark_previous.json
+import argparse
+import base64
+import concurrent.futures
+import contextlib
+import datetime as dt
+import io
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+import numpy as np
+from manifest_func2 import checkSampleManifest, giveGP2ID, compare_consistency
+from manifest_utils import format_gp2id, format_gp2sampleid, parse_gp2id, crosstab
+from manifest_rules import read_manifest, validate, cell_errors, upload_rules, known_cols, numeric_cols
+from gp2id_registry import build_registry
+from sample_id_index import build_index, SampleIDIndex
+from master_log import MasterSheetLog
+from numeric_profile import profile
+from manifest_store import ManifestStore, table_bytes
+from sample_manifest import make_manifest, split_manifests
+try: # the app stages need streamlit
+  import app
+except ImportError:
+  app = None
+try:
+  import pyarrow
+  parquet = True
+except ImportError:
+  parquet = False
+
+id_cols = ['study', 'clinical_id', 'GP2ID', 'GP2sampleID'] # history needed for the ID assignment
+
+
+def timeit(func, repeat=3):
+  # best wall time of func() in seconds
+  best = np.inf
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    func()
+    best = min(best, time.perf_counter() - t0)
+  return best
+
+
+def measure(func):
+  """
+  Wall time and peak allocation (tracemalloc) of func().
+  func is called twice: tracemalloc slows down the pandas code a lot, so the time is from
+  a run without it.
+  out: (output of func, {'sec':.., 'peak_mb':..})
+  """
+  with contextlib.redirect_stdout(io.StringIO()): # the QC functions print a lot
+    t0 = time.perf_counter()
+    func()
+    sec = time.perf_counter() - t0
+    tracemalloc.start()
+    try:
+      out = func()
+      peak = tracemalloc.get_traced_memory()[1]
+    finally:
+      tracemalloc.stop()
+  return out, {'sec':round(sec, 4), 'peak_mb':round(peak / 2**20, 2)}
+
+
+class Upload:
+  # the file given to read_file (what streamlit's file_uploader returns)
+  def __init__(self, data, type='text/csv'):
+    self.data = data
+    self.type = type
+  def getvalue(self):
+    return self.data
+
+
+class RemoteStore(ManifestStore):
+  # stand-in of the shared drive: each read/copy of a file in root waits latency sec first
+  def __init__(self, root, fmt='csv', cache_dir=None, max_workers=None, latency=0.2):
+    super().__init__(root, fmt, cache_dir, max_workers)
+    self.latency = latency
+
+  def _read_file(self, path, columns=None):
+    time.sleep(self.latency)
+    return super()._read_file(path, columns)
+
+  def _copy_file(self, src, dst):
+    time.sleep(self.latency)
+    super()._copy_file(src, dst)
+
+
+class UnlockedStore(ManifestStore):
+  # store without the per-study lock (how giveGP2ID ran before), for the contrast in hammer
+  def lock(self, name, timeout=None):
+    return contextlib.nullcontext()
+
+
+def _hammer_task(root, locked, x, manifest_id, registry=None, wait=120):
+  # giveGP2ID of one manifest after the output of the previous manifest of the study exists
+  store = (ManifestStore if locked else UnlockedStore)(root)
+  mnum = int(manifest_id[1:])
+  study = x.study.iloc[0]
+  t0 = time.monotonic()
+  while mnum > 1 and not store.exists('qced', f'{study}_sample_manifest_qced_m{mnum-1}'):
+    if time.monotonic() - t0 > wait:
+      raise TimeoutError(f'{study} m{mnum-1} not assigned')
+    time.sleep(0.01)
+  with contextlib.redirect_stdout(io.StringIO()):
+    giveGP2ID(x, manifest_id, [f'm{i}' for i in range(1, mnum)], registry, store=store)
+  return manifest_id
+
+
+def _redo_content(manifests, manifest_id, seed):
+  # changed content of a rerun of manifest_id: 10% of the samples dropped, another sample of
+  # a few participants of the later manifests and a few new participants added
+  x = manifests[manifest_id]
+  later = pd.concat([v for k, v in manifests.items() if int(k[1:]) > int(manifest_id[1:])], ignore_index=True)
+  extra = later.sample(n=min(5, len(later)), random_state=seed).copy()
+  extra['sample_id'] = [f'redo{seed}_extra{i}' for i in range(len(extra))]
+  new = x.sample(n=min(5, len(x)), random_state=seed).copy()
+  new['clinical_id'] = [f'redo{seed}_new{i}' for i in range(len(new))]
+  new['sample_id'] = [f'redo{seed}_new{i}' for i in range(len(new))]
+  return pd.concat([x.drop(x.sample(frac=0.1, random_state=seed).index), extra, new], ignore_index=True)
+
+
+def hammer(n_procs=8, n_manifests=8, n_redo=8, nr=4000, registry=False, locked=True, seed=1):
+  """
+  giveGP2ID of the manifests of one study from n_procs processes at the same time:
+  m1..m{n_manifests} plus n_redo reruns of random earlier manifests (every other one with
+  changed content, see _redo_content), all submitted at once
+  (in a temporary folder, with a GP2ID registry if registry).
+  out: dict with the N of GP2IDs given to more than one clinical_id, of clinical_ids with more
+  than one GP2ID and of duplicated GP2sampleIDs in the qced files (all 0 if the allocation is safe)
+  """
+  with contextlib.redirect_stdout(io.StringIO()):
+    x = checkSampleManifest(make_manifest(nr, 1, qced=True), dup_not_allowed=False)
+  x = x.sample(frac=1, random_state=seed).reset_index(drop=True) # participants spread over the manifests
+  manifests = split_manifests(x, n_manifests)
+  rng = random.Random(seed)
+  # a redo is submitted at a random point after the first run of its manifest (the first runs in order,
+  # so a task waiting for the previous manifest never holds the worker that would run it)
+  tasks = [(mid, manifests[mid]) for mid in manifests]
+  for i in range(n_redo):
+    mid = f'm{rng.randint(1, n_manifests - 1)}'
+    first = next(j for j, (v, _) in enumerate(tasks) if v==mid)
+    tasks.insert(rng.randint(first + 1, len(tasks)),
+                 (mid, _redo_content(manifests, mid, rng.randrange(2**31)) if i % 2==0 else manifests[mid]))
+  with tempfile.TemporaryDirectory() as tmp:
+    store = ManifestStore(tmp)
+    for sub in ['qced', 'finalized']:
+      os.makedirs(store.folder(sub))
+    reg = f'{tmp}/registry.sqlite' if registry else None
+    t0 = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(n_procs) as pool:
+      futures = [pool.submit(_hammer_task, tmp, locked, content, mid, reg) for mid, content in tasks]
+      errors = [str(e) for e in (f.exception() for f in futures) if e is not None]
+    sec = time.perf_counter() - t0
+    out = pd.concat([store.read('qced', v) for v in store.list('qced')], ignore_index=True)
+  out['clinical_id'] = out.clinical_id.astype(str)
+  return {'procs':n_procs, 'tasks':len(tasks), 'registry':registry, 'locked':locked, 'sec':round(sec, 3),
+          'errors':errors, 'n_samples':out.shape[0],
+          'GP2ID_reused':int((out.groupby('GP2ID').clinical_id.nunique()>1).sum()),
+          'clinical_id_split':int((out.groupby('clinical_id').GP2ID.nunique()>1).sum()),
+          'GP2sampleID_dup':int(out.GP2sampleID.duplicated().sum())}
+
+
+def bench_gp2id(n=1_000_000, study_code='PDSTUDY'):
+  """
+  GP2ID / GP2sampleID construction and parsing:
+  the vectorized functions vs the list comprehension and str.split versions
+  """
+  rng = np.random.default_rng(1)
+  uid_idx = pd.Series(rng.integers(1, 10**6, n))
+  rep = pd.Series(rng.integers(1, 4, n))
+  gp2id = pd.Series(format_gp2id(study_code, uid_idx))
+  res = {
+    'format_gp2id': timeit(lambda: format_gp2id(study_code, uid_idx)),
+    'format_gp2id_listcomp': timeit(lambda: [f'{study_code}_{i:06}' for i in uid_idx]),
+    'format_gp2sampleid': timeit(lambda: format_gp2sampleid(study_code, uid_idx, rep)),
+    'format_gp2sampleid_str_concat': timeit(lambda: gp2id + '_s' + rep.astype('str')),
+    'parse_gp2id': timeit(lambda: parse_gp2id(gp2id)),
+    'parse_gp2id_str_split': timeit(lambda: gp2id.str.split('_', expand=True).iloc[:,1].astype('int')),
+  }
+  return {k: round(v, 4) for k, v in res.items()}
+
+
+def bench_pipeline(nr, n_manifests=3, n_studies=1, latency=0.2, xlsx_max=100000):
+  """
+  Time and peak memory of each stage for a mock manifest of nr samples.
+  giveGP2ID is run for the last of n_manifests manifests (the others are the previous ones)
+  in a temporary folder, with the previous manifests as csv and as parquet files (if pyarrow is installed).
+  The previous manifests are also loaded from the folder with latency sec per file (RemoteStore)
+  one by one, in parallel and from the local cache.
+  xlsx upload (pd.read_excel vs manifest_xlsx) only if nr <= xlsx_max (writing the workbook is slow)
+  """
+  res = {}
+  raw = make_manifest(nr, n_studies)
+  qced = make_manifest(nr, n_studies, qced=True)
+  csv = raw.to_csv(index=False).encode()
+  # object columns (pd.read_csv) vs the categoricals of manifest_rules.schema
+  obj, res['read_csv_object'] = measure(lambda: pd.read_csv(io.BytesIO(csv)))
+  cat, res['read_manifest'] = measure(lambda: read_manifest(io.BytesIO(csv)))
+  _, res['validate_object'] = measure(lambda: validate(obj, upload_rules))
+  _, res['validate_category'] = measure(lambda: validate(cat, upload_rules))
+  _, res['crosstab_object'] = measure(lambda: crosstab(obj.Plate_name, obj.study_arm, obj.sample_id))
+  _, res['crosstab_category'] = measure(lambda: crosstab(cat.Plate_name, cat.study_arm, cat.sample_id))
+  # numeric columns: one column at a time (the former Check Distribution) vs numeric_profile
+  def numeric_loop():
+    out = {}
+    for v in numeric_cols:
+      vuniq = cat[v].dropna().unique()
+      out[v] = (cat[v].isna().sum(), len(vuniq), cat[v].value_counts(dropna=False) if len(vuniq) < 6 else
+                np.histogram(cat[v].dropna())[0], cat[v].min(), cat[v].mean(), cat[v].max())
+    return out
+  _, res['numeric_loop'] = measure(numeric_loop)
+  _, res['numeric_profile'] = measure(lambda: profile(cat))
+  # errors scattered over 1% of the rows (text in a numeric column, missing, duplicated) down to the cells
+  bad = cat.copy()
+  rows = np.random.default_rng(1).choice(nr, max(3, nr // 100), replace=False)
+  bad['age'] = bad.age.astype('object')
+  bad.loc[rows[0::3], 'age'] = 'unknown'
+  bad.loc[rows[1::3], 'sex'] = np.nan
+  bad.loc[rows[2::3], 'sample_id'] = bad.sample_id.iloc[0]
+  issues, res['validate_scattered'] = measure(lambda: validate(bad, upload_rules))
+  _, res['cell_errors'] = measure(lambda: cell_errors(bad, issues, n_wells=96))
+  if nr<=xlsx_max:
+    xlsx = io.BytesIO()
+    raw.to_excel(xlsx, index=False)
+    xlsx = xlsx.getvalue()
+    _, res['read_excel'] = measure(lambda: pd.read_excel(io.BytesIO(xlsx), sheet_name=0))
+    _, res['read_manifest_xlsx'] = measure(lambda: read_manifest(io.BytesIO(xlsx), excel=True, usecols=known_cols))
+  if app is not None:
+    def read():
+      app.parse_upload.clear()
+      return app.read_file(Upload(csv))
+    df, res['read_file'] = measure(read)
+    mapdic = {v:'White' for v in df.race.dropna().unique()}
+    mapdic['Not Reported'] = 'Not Reported'
+    _, res['app_crosstab'] = measure(lambda: app.derive_column(df, 'race_for_qc', mapdic))
+    _, res['app_plates'] = measure(lambda: app.check_plates(df))
+
+  x, res['checkSampleManifest'] = measure(lambda: checkSampleManifest(qced, dup_not_allowed=False))
+  # download of the QCed table: the former base64 data link vs the byte buffers
+  _, res['export_base64_link'] = measure(lambda: base64.b64encode(x.to_csv(index=False).encode()).decode())
+  for fmt in ['csv', 'csv.gz'] + (['parquet'] if parquet else []):
+    _, res[f'export_{fmt}'] = measure(lambda: table_bytes(x, fmt))
+
+  with tempfile.TemporaryDirectory() as tmp:
+    store = ManifestStore(f'{tmp}/csv', 'csv')
+    pq_store = ManifestStore(f'{tmp}/parquet', 'parquet') if parquet else None
+    for s in [store, pq_store]:
+      for sub in ['qced', 'finalized', 'master_sheet']:
+        if s is not None:
+          os.makedirs(s.folder(sub))
+    manifests = split_manifests(x, n_manifests)
+    last = f'm{n_manifests}'
+    with contextlib.redirect_stdout(io.StringIO()):
+      for mid in list(manifests)[:-1]: # previous manifests (finalized)
+        giveGP2ID(manifests[mid], mid, store=store)
+        for name in store.list('qced'):
+          os.replace(store.path('qced', name), store.path('finalized', name))
+          if pq_store is not None:
+            pq_store.write(store.read('finalized', name), 'finalized', name)
+      reg = build_registry(f'{tmp}/registry.sqlite', store=store)
+      build_index(f'{tmp}/sample_id_index.sqlite', store=store).close()
+    x2, res['giveGP2ID'] = measure(lambda: giveGP2ID(manifests[last], last, store=store))
+    _, res['giveGP2ID_registry'] = measure(lambda: giveGP2ID(manifests[last], last, registry=reg, store=store))
+    reg.close()
+    history = store.list('finalized')
+    _, res['history_load_csv'] = measure(lambda: [store.read('finalized', v) for v in history])
+    items = [('finalized', v) for v in history]
+    remote = lambda **kw: RemoteStore(store.root, 'csv', latency=latency, **kw)
+    _, res['history_load_remote'] = measure(lambda: remote(max_workers=1).read_many(items))
+    _, res['history_load_remote_parallel'] = measure(lambda: remote().read_many(items))
+    cached = remote(cache_dir=f'{tmp}/cache')
+    cached.read_many(items) # copies the files to the cache
+    _, res['history_load_remote_cached'] = measure(lambda: cached.read_many(items))
+    if pq_store is not None:
+      _, res['history_load_parquet'] = measure(lambda: [pq_store.read('finalized', v) for v in history])
+      _, res['history_load_parquet_ids'] = measure(lambda: [pq_store.read('finalized', v, id_cols) for v in history])
+      _, res['giveGP2ID_parquet'] = measure(lambda: giveGP2ID(manifests[last], last, store=pq_store))
+      _, res['giveGP2ID_parquet_ids'] = measure(lambda: giveGP2ID(manifests[last], last, store=pq_store,
+                                                                  history_columns=id_cols))
+
+    # sample_id of the new manifest against the index of all the finalized ones
+    _, res['sample_index_load'] = measure(lambda: SampleIDIndex(f'{tmp}/sample_id_index.sqlite', read_only=True))
+    index = SampleIDIndex(f'{tmp}/sample_id_index.sqlite', read_only=True)
+    _, res['sample_index_check'] = measure(lambda: index.collisions(manifests[last]))
+    index.close()
+
+    ref = x2[x2.manifest_id!=last]
+    _, res['compare_consistency'] = measure(lambda: compare_consistency(x2, ref, store=store))
+    _, res['compare_consistency_fingerprint'] = measure(lambda: compare_consistency(x2, ref, fingerprint=True, store=store))
+    # master sheet log: the new manifest validated against the key index of the previous ones
+    log = MasterSheetLog(store)
+    with contextlib.redirect_stdout(io.StringIO()):
+      log.snapshot(ref)
+    new = x2[x2.manifest_id==last]
+    _, res['master_log_validate'] = measure(lambda: log.validate(new))
+    _, res['master_log_compare'] = measure(lambda: log.compare(x2)) # the full target against the index
+    with contextlib.redirect_stdout(io.StringIO()):
+      log.append(new)
+    _, res['master_log_materialize'] = measure(lambda: log.materialize())
+  return res
+
+
+def compare(res, previous):
+  # prints the ratio of time and peak memory (current / previous) of each stage
+  for nr, stages in res['pipeline'].items():
+    for stage, v in stages.items():
+      p = previous.get('pipeline', {}).get(nr, {}).get(stage)
+      if p is None:
+        continue
+      print(f'{nr:>8s} {stage:34s} time x{v["sec"] / max(p["sec"], 1e-6):5.2f}  memory x{v["peak_mb"] / max(p["peak_mb"], 1e-6):5.2f}')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmarks of the sample manifest QC')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000], help='N of samples')
+  parser.add_argument('--manifests', type=int, default=3, help='N of manifests (the last one gets GP2IDs)')
+  parser.add_argument('--studies', type=int, default=1, help='N of studies')
+  parser.add_argument('--latency', type=float, default=0.2, help='sec per file read from the mock shared drive')
+  parser.add_argument('--xlsx_max', type=int, default=100000, help='max N of samples of the xlsx read benchmark')
+  parser.add_argument('--hammer', type=int, default=0, help='N of processes of the concurrent GP2ID assignment test (0: skip)')
+  parser.add_argument('--out', default='benchmark.json', help='output json')
+  parser.add_argument('--compare', help='previous output json to compare with')
+  args = parser.parse_args()
+
+  res = {'meta': {'date': dt.datetime.today().isoformat(timespec='seconds'),
+                  'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                  'manifests': args.manifests, 'studies': args.studies, 'latency': args.latency, 'xlsx_max': args.xlsx_max},
+         'gp2id': bench_gp2id(),
+         'pipeline': {}}
+  for k, v in res['gp2id'].items():
+    print(f'{k:34s}{v:8.4f} sec')
+  for nr in args.sizes:
+    res['pipeline'][str(nr)] = bench_pipeline(nr, args.manifests, args.studies, args.latency, args.xlsx_max)
+    for stage, v in res['pipeline'][str(nr)].items():
+      print(f'{nr:>8d} {stage:34s}{v["sec"]:8.3f} sec {v["peak_mb"]:9.1f} MB')
+  if args.hammer > 0:
+    res['hammer'] = [hammer(args.hammer, registry=registry, locked=locked)
+                     for registry in [False, True] for locked in [True, False]]
+    for v in res['hammer']:
+      print({k:v[k] for k in ['registry', 'locked', 'sec', 'GP2ID_reused', 'clinical_id_split', 'GP2sampleID_dup']}, v['errors'][:1])
+  with open(args.out, 'w') as f:
+    json.dump(res, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      compare(res, json.load(f))
@@ -0,0 +1,147 @@
+# GP2ID registry: a local SQLite file of the ID mappings so that giveGP2ID
+# does not need to re-read all the previous manifests
+import glob
+import os
+import re
+import sqlite3
+import pandas as pd
+import numpy as np
+from manifest_utils import format_gp2id, format_gp2sampleid, parse_gp2id, canonical_id, sort_ids
+from manifest_store import get_store, read_table
+
+schema = """
+CREATE TABLE IF NOT EXISTS study (
+  study TEXT PRIMARY KEY,
+  next_uid INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS participant (
+  study TEXT NOT NULL,
+  clinical_id TEXT NOT NULL,
+  GP2ID TEXT NOT NULL,
+  uid INTEGER NOT NULL,
+  PRIMARY KEY (study, clinical_id));
+DROP TABLE IF EXISTS replicate;
+CREATE TABLE IF NOT EXISTS sample (
+  GP2sampleID TEXT PRIMARY KEY,
+  GP2ID TEXT NOT NULL,
+  study TEXT NOT NULL,
+  manifest_id TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS sample_manifest ON sample (study, manifest_id);
+CREATE INDEX IF NOT EXISTS sample_gp2id ON sample (GP2ID);
+"""
+
+
+class GP2IDRegistry:
+  """
+  study --> next uid index
+  (study, clinical_id) --> GP2ID
+  GP2sampleID --> GP2ID, manifest_id (to redo the assignment of a manifest;
+    the last replicate number of a GP2ID is the max of its GP2sampleIDs)
+  """
+  def __init__(self, path='gp2id_registry.sqlite'):
+    self.path = path
+    self.con = sqlite3.connect(path, isolation_level=None, timeout=60)
+    self.con.executescript(schema)
+
+  def close(self):
+    self.con.close()
+
+  def _select_in(self, sql, keys, params=()):
+    # runs sql joined with the temporary table _keys(k) filled with keys
+    cur = self.con.cursor()
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS _keys (k TEXT PRIMARY KEY)')
+    cur.execute('DELETE FROM _keys')
+    cur.executemany('INSERT OR IGNORE INTO _keys VALUES (?)', ((k,) for k in keys))
+    return dict(cur.execute(sql, params).fetchall())
+
+  def assign(self, study, manifest_id, clinical_ids):
+    """
+    Gives GP2IDs and sample replicate numbers to the samples of a manifest of the study
+    with O(N of the samples) lookups. If the manifest was already assigned,
+    the previous assignment is replaced.
+    clinical_ids: clinical_id of the samples (in the order of the manifest)
+    out: (uid index, replicate number) arrays. GP2ID is {study}_{uid index:06}
+    """
+    keys = canonical_id(clinical_ids).fillna('').to_numpy(dtype=object)
+    cur = self.con.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+      # redo of the manifest
+      cur.execute('DELETE FROM sample WHERE study=? AND manifest_id=?', (study, manifest_id))
+
+      # clinical_id --> uid index
+      uids = pd.unique(keys)
+      mapid = self._select_in('SELECT p.clinical_id, p.uid FROM participant p JOIN _keys ON p.clinical_id=_keys.k '
+                              'WHERE p.study=?', uids, (study,))
+      row = cur.execute('SELECT next_uid FROM study WHERE study=?', (study,)).fetchone()
+      n = 1 if row is None else row[0]
+      uids_new = [k for k in uids if k not in mapid]
+      if row is not None: # same order as the previous manifests based assignment
+        uids_new = list(sort_ids(uids_new))
+      new_uid = np.arange(n, n + len(uids_new))
+      cur.executemany('INSERT INTO participant VALUES (?,?,?,?)',
+                      zip([study]*len(new_uid), uids_new, format_gp2id(study, new_uid), new_uid.tolist()))
+      cur.execute('INSERT INTO study VALUES (?,?) ON CONFLICT(study) DO UPDATE SET next_uid=excluded.next_uid',
+                  (study, n + len(new_uid)))
+      mapid.update(zip(uids_new, new_uid.tolist()))
+
+      # GP2ID --> sample replicate number
+      uid = pd.Series(keys).map(mapid).astype(np.int64)
+      u_uid = pd.unique(uid)
+      u_gp2id = format_gp2id(study, u_uid)
+      # last replicate number in the other manifests (a redone manifest does not reuse the numbers
+      # of the manifests after it) --> GP2sampleID is {GP2ID}_s{replicate number}
+      n_prev = self._select_in('SELECT s.GP2ID, max(CAST(substr(s.GP2sampleID, length(s.GP2ID)+3) AS INTEGER)) '
+                               'FROM sample s JOIN _keys ON s.GP2ID=_keys.k GROUP BY s.GP2ID', u_gp2id)
+      n_prev = pd.Series([n_prev.get(g, 0) for g in u_gp2id], index=u_uid)
+      reps = uid.map(n_prev) + uid.groupby(uid).cumcount() + 1
+      cur.executemany('INSERT INTO sample VALUES (?,?,?,?)',
+                      zip(format_gp2sampleid(study, uid, reps), format_gp2id(study, uid),
+                          [study]*len(uid), [manifest_id]*len(uid)))
+      cur.execute('COMMIT')
+    except BaseException:
+      cur.execute('ROLLBACK')
+      raise
+    return uid.to_numpy(), reps.to_numpy()
+
+  def import_history(self, df):
+    """
+    Adds GP2ID assigned manifests (study, clinical_id, GP2ID, GP2sampleID, manifest_id)
+    to the registry. Samples already in the registry are replaced, so overlapping files are fine.
+    """
+    keys = canonical_id(df.clinical_id).fillna('')
+    uid = parse_gp2id(df.GP2ID)
+    cur = self.con.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+      cur.executemany('INSERT OR REPLACE INTO participant VALUES (?,?,?,?)',
+                      zip(df.study, keys, df.GP2ID, uid.tolist()))
+      cur.executemany('INSERT OR REPLACE INTO sample VALUES (?,?,?,?)',
+                      zip(df.GP2sampleID, df.GP2ID, df.study, df.manifest_id))
+      # next_uid is never lowered (uids already given may have been replaced)
+      cur.execute('INSERT INTO study SELECT study, max(uid)+1 FROM participant WHERE true GROUP BY study '
+                  'ON CONFLICT(study) DO UPDATE SET next_uid=max(next_uid, excluded.next_uid)')
+      cur.execute('COMMIT')
+    except BaseException:
+      cur.execute('ROLLBACK')
+      raise
+
+
+def build_registry(path='gp2id_registry.sqlite', finalized_dir=None, qced_files=[], store=None):
+  """
+  One time import of the existing manifests to a registry.
+  All the {study_code}_sample_manifest_qced_m{n} csv/parquet files in finalized_dir
+  (default: the finalized folder of the store, see manifest_store) are loaded.
+  Not yet finalized manifests can be added as a list of paths (qced_files)
+  """
+  reg = GP2IDRegistry(path)
+  if finalized_dir is None:
+    finalized_dir = get_store(store).folder('finalized')
+  files = sorted(glob.glob(os.path.join(finalized_dir, '*_sample_manifest_qced_m*.csv')) +
+                 glob.glob(os.path.join(finalized_dir, '*_sample_manifest_qced_m*.parquet'))) + list(qced_files)
+  for f in files:
+    mid = re.search(r'_sample_manifest_qced_(m\d+)\.(csv|parquet)$', f).group(1)
+    df = read_table(f, ['study', 'clinical_id', 'GP2ID', 'GP2sampleID'])
+    df['manifest_id'] = mid
+    reg.import_history(df)
+    print(f'{os.path.basename(f)}: nrow = {df.shape[0]}')
+  return reg
@@ -2,8 +2,19 @@
 import pandas as pd 
 import numpy as np
 import datetime as dt 
-
-def checkSampleManifest(data, dup_not_allowed=True):
+import os
+import re
+from manifest_utils import crosstab, check_plate_wells, format_gp2id, format_gp2sampleid, parse_gp2id, row_fingerprint
+from manifest_utils import canonical_id, sort_ids, fill_missing
+from gp2id_registry import GP2IDRegistry
+from sample_id_index import SampleIDIndex
+# qced, finalized and master_sheet files (manifest_store.configure to change the folder/format)
+from manifest_store import get_store, read_table
+from stage_timer import null_timer
+from manifest_rules import qc_rules, validate, find_issue, cell_errors
+from numeric_profile import profile
+
+def checkSampleManifest(data, dup_not_allowed=True, n_wells=96, timer=None, report=None):
   """
   This function is to be used for data qc. 
   Input data should have columns named as the templete PLUS Phenotype!
@@ -14,19 +25,25 @@ def checkSampleManifest(data, dup_not_allowed=True):
   2. clincal_id can be duplicated but no missing
   3. Phenotype sex, race, sample_type should be given (no missing)
   4. For Fulgent samples, we need Plate_id and Plate_position
+  5. Plate_position are unique and on the plate (n_wells=96: A1-H12, n_wells=384: A1-P24)
+  1-4 are the rules in manifest_rules.qc_rules (shared with the app)
+  data can be read with manifest_rules.read_manifest (categorical columns, much less memory)
+  timer: stage_timer.StageTimer to record the time/memory of each check (optional)
+  report: dict to get the failed rules as report['issues'] (output of manifest_rules.validate,
+    rows are positions in data), e.g. for batch_qc (optional)
   """
-  cols = ['study', 'sample_id', 'sample_type',
-          'DNA_volume', 'DNA_conc', 'r260_280',
-          'Plate_name', 'Plate_position', 'clinical_id', 
-          'study_arm', 'sex', 'race', 
-          'age', 'age_of_onset', 'age_at_diagnosis', 'age_at_death', 'family_history',
-          'region', 'comment', 'alternative_id1', 'alternative_id2', 
-          'Phenotype','Genotyping_site', 'Sample_submitter', 'original_manifest']
+  if timer is None:
+    timer = null_timer
+  timer.reset()
   qc_cols= ['sex_for_qc', 'race_for_qc', 'family_history_for_qc', 'region_for_qc']
   origin_col = ['sex', 'race', 'family_history', 'region']
   
   # requirements
-  nocols = np.setdiff1d(cols, data.columns)
+  col_issues = validate(data, [r for r in qc_rules if r['kind']=='column'])
+  nocols = col_issues.column.to_numpy()
+  if report is not None:
+    report['issues'] = col_issues
+  timer.lap('column check')
   if len(nocols)>0:
     print('!!!SERIOUS ERROR!!! \nSome columns are missing')
     print('Missing columns:', nocols)
@@ -46,22 +63,46 @@ def checkSampleManifest(data, dup_not_allowed=True):
 
   # NAs
   print('N of original data entries:', data.shape[0])
-  x1 = data[pd.notna(data.sample_id)].copy()
+  kept = pd.notna(data.sample_id).to_numpy().copy()
+  x1 = data[kept]
   print('N of missing sample_id --> removed:', data.shape[0] - x1.shape[0])
   # duplication
-  x2 = x1.drop_duplicates(keep='first').copy()
+  dup = x1.duplicated(keep='first').to_numpy()
+  kept[kept] = ~dup # positions of x2 in data
+  x2 = x1[~dup].copy() # the only copy: columns are updated below
   print('N of duplicated entries --> removed:', x2.shape[0] - x1.shape[0])
   # effective entry
   print('\nN of effective entries:', x2.shape[0])
   # unique sample_id, clinical_id
   print('N of unique sample_id:', len(x2.sample_id.unique()))
   print('N of unique clinical_id:', len(x2.clinical_id.unique()), '\n')
-  
+  timer.lap('dedup')
+
+  # set aside the original sex, race, region, family history and update origin_cols
+  x2_origin = x2[origin_col]
+  if qcing:
+    cols_update = [v.replace('_for_qc', '') for v in cols_qcing]
+    x2[cols_update] = x2[cols_qcing]
+    print(f'Below, {cols_update} are referring to the "*_for_qc" variables')
+
+  # all the rules at once
+  issues = validate(x2, [r for r in qc_rules if r['kind']!='column'])
+  def issue_values(column, kind):
+    x = find_issue(issues, column, kind)
+    return np.array([]) if x is None else x['values']
+  def issue_n(column, kind):
+    x = find_issue(issues, column, kind)
+    return 0 if x is None else x['n']
+  if report is not None:
+    pos = np.flatnonzero(kept)
+    report['issues'] = pd.concat([col_issues, issues.assign(rows=[pos[r] for r in issues.rows])], ignore_index=True)
+  timer.lap('rule checks')
+
   # dup check
-  sample_id_dup =  x2.sample_id[x2.sample_id.duplicated()].unique()
+  sample_id_dup = issue_values('sample_id', 'unique')
   if len(sample_id_dup)>0:
     print('Duplicated sample_id:', sample_id_dup)
-  clinical_id_dup =  x2.clinical_id[x2.clinical_id.duplicated()].unique()
+  clinical_id_dup = issue_values('clinical_id', 'unique')
   if len(clinical_id_dup)>0:
     print('Duplicated clinical_id:', clinical_id_dup)
   if (len(sample_id_dup) + len(clinical_id_dup)) > 0:
@@ -74,17 +115,16 @@ def checkSampleManifest(data, dup_not_allowed=True):
       print('!!DUPLICATIONS IGNORED!!')
 
   # All have clinical ID?
-  if sum(pd.isna(x2.clinical_id))>0:
+  if issue_n('clinical_id', 'missing')>0:
     print('\n!!!SERIOUS ERROR!!! \nPlease provide clinical ID for all entries with sample IDs')
-    print('N of entries with clinical ID missing:', sum(pd.isna(x2.clinical_id)))
+    print('N of entries with clinical ID missing:', issue_n('clinical_id', 'missing'))
     serious_error=1
-  
-  # set aside the original sex, race, region, family history and update origin_cols
-  x2_origin = x2[origin_col].copy()
-  if qcing:
-    cols_update = [v.replace('_for_qc', '') for v in cols_qcing]
-    x2[cols_update] = x2[cols_qcing].copy()
-    print(f'Below, {cols_update} are referring to the "*_for_qc" variables')
+
+  # sample_type
+  st_er = issue_values('sample_type', 'vocab')
+  if len(st_er)>0:
+    print(f'\nUndefined "sample_type" value: {st_er}')
+    flag=1
 
 
 
@@ -93,119 +133,105 @@ def checkSampleManifest(data, dup_not_allowed=True):
   nmiss_study_arm = sum(pd.isna(x2.study_arm))
   if nmiss_study_arm>0: # fill na
     print('N of study_arm info missing --> recoded as "Not Reported":', nmiss_study_arm)
-    x2['study_arm'] = x2.study_arm.fillna('Not Reported')
+    x2['study_arm'] = fill_missing(x2.study_arm, 'Not Reported')
   nmiss_Phenotype = sum(pd.isna(x2.Phenotype))
   if nmiss_Phenotype>0: # fill na
     print('N of Phenotype info missing --> recoded as "Not Reported":', nmiss_Phenotype)
-    x2['Phenotype']=x2.Phenotype.fillna("Not Reported")
+    x2['Phenotype']=fill_missing(x2.Phenotype, "Not Reported")
   # cross-tabulation of study_arm and Phenotype
   print('\n=== study_arm X Phenotype ===')
-  xtab = x2.pivot_table(index='study_arm', columns='Phenotype', margins=True,
-                        values='sample_id', aggfunc='count', fill_value=0)
+  xtab = crosstab(x2.study_arm, x2.Phenotype, x2.sample_id)
   print(xtab)
   # undefined "Phenotype"
-  ph_er = np.setdiff1d(x2.Phenotype.astype('str'), ["PD", "Control", "Prodromal", "Other", "Not Reported"])
+  ph_er = issue_values('Phenotype', 'vocab')
   if len(ph_er)>0:
     print(f'\nUndefined "Phenotype" value: {ph_er}')
     flag=1
-
-  # sex
-  nmiss_sex = sum(pd.isna(x2.sex))
-  if nmiss_sex>0: # fill na
-    print('\nsex info missing --> recoded as "Not Reported":', nmiss_sex)
-    x2['sex'] = x2.sex.fillna('Not Reported')
-    flag=1
-  else:
-    print('\nsex info: no missing')
-  sex_er = np.setdiff1d(x2.sex.unique().astype('str'), ["Male", "Female", "Intersex", "Unknown", "Other", "Not Reported"])
-  if len(sex_er)>0:
-    print('Undefined value:', sex_er)
-    flag=1
-  print(x2.sex.value_counts().to_frame())
-  
-  # race
-  nmiss_race = sum(pd.isna(x2.race))
-  if nmiss_race>0: # fill na
-    print('\nrace info missing --> recoded as "Not Reported":', nmiss_race)
-    x2['race'] = x2.race.fillna('Not Reported')
-    flag=1
-  else:
-    print('\nrace info: no missing')
-  race_er = np.setdiff1d(x2.race.unique().astype('str'), ["American Indian or Alaska Native", "Asian", "White", "Black or African American", "Multi-racial", "Native Hawaiian or Other Pacific Islander", "Other", "Unknown", "Not Reported"])
-  if len(race_er)>0:
-    print('Undefined value:', race_er)
-    flag=1
-  print(x2.race.value_counts().to_frame())
-
-
-  # family_history
-  nmiss_fh = sum(pd.isna(x2.family_history))
-  if nmiss_fh>0: # fill na
-    print('\nfamily history info missing --> recoded as "Not Reported":', nmiss_fh)
-    x2['family_history'] = x2.family_history.fillna('Not Reported')
-    flag=1
-  else:
-    print('\nfamily history info: no missing')
-  fh_er = np.setdiff1d(x2.family_history.unique().astype('str'), ["Yes", "No", "Unknown", "Not Reported"])
-  if len(fh_er)>0:
-    print('Undefined value:', fh_er)
-    flag=1
-  print(x2.family_history.value_counts().to_frame())
+  timer.lap('Phenotype check')
+
+  # sex, race and family_history (missing --> "Not Reported")
+  for v, label in [('sex', 'sex'), ('race', 'race'), ('family_history', 'family history')]:
+    nmiss = issue_n(v, 'missing')
+    if nmiss>0: # fill na
+      print(f'\n{label} info missing --> recoded as "Not Reported":', nmiss)
+      x2[v] = fill_missing(x2[v], 'Not Reported')
+      flag=1
+    else:
+      print(f'\n{label} info: no missing')
+    v_er = issue_values(v, 'vocab')
+    if len(v_er)>0:
+      print('Undefined value:', v_er)
+      flag=1
+    counts = x2[v].value_counts()
+    print(counts[counts>0].to_frame()) # not the unused categories
+    timer.lap(f'{v} check')
 
 
   # numeric parameter check
   print('\n')
-  for v in ['age', 'age_of_onset', 'age_at_diagnosis', 'age_at_death']:
-    if x2.dtypes[v] not in ['float64', 'int64']:
-      print(f'ERROR: {v} needs to be numeric (or missing)')
+  age_cols = ['age', 'age_of_onset', 'age_at_diagnosis', 'age_at_death']
+  prof = profile(x2, [v for v in age_cols if find_issue(issues, v, 'numeric') is None]) # all columns at once
+  for v in age_cols:
+    x = find_issue(issues, v, 'numeric')
+    if x is not None:
+      print(f'ERROR: {v} needs to be numeric (or missing). {x.n} entries, e.g. {list(x["values"][:5])} '
+            f'of sample_id {list(x2.sample_id.iloc[x.rows[:5]])}')
       flag=1
     else:
-      v_vec = x2[v].dropna()
-      if len(v_vec)>0:
-        print(f'{v} : {len(v_vec)} non-missing obs, min={np.min(v_vec)}, mean={np.mean(v_vec)}, max={np.max(v_vec)}')
+      r = prof['summary'].loc[v]
+      n = prof['summary'].n[v]
+      if n>0:
+        vmin, vmax = (int(r['min']), int(r['max'])) if pd.api.types.is_integer_dtype(x2[v].dtype) else (r['min'], r['max'])
+        print(f'{v} : {n} non-missing obs, min={vmin}, mean={r["mean"]}, max={vmax}')
       else:
         print(f'{v} is all missing')
+  for x in prof['violations'].itertuples(): # range and cross-column plausibility
+    print(f'WARNING: {x.check} in {x.n} samples: {list(x2.sample_id.iloc[x.rows[:10]])}')
+  timer.lap('numeric check')
 
   # Other missing check
-  x2_non_miss_check = x2[['sample_id', 'study', 'sample_type', 'region', 'Genotyping_site', 'Sample_submitter']].copy()
-  if x2_non_miss_check.isna().sum().sum()>0:
+  miss = issues[(issues.kind=='missing') & (issues.severity=='error') & (issues.column!='clinical_id')]
+  miss_all = miss[miss['where'].isna()]
+  if len(miss_all)>0:
     print('\n!!!SERIOUS ERROR!!! \nMissing not allowed for the following columns. Please fill and repeat this process again.')
-    print(x2_non_miss_check.info())
+    print(miss_all[['column', 'n']].rename(columns={'n':'n_missing'}).to_string(index=False))
+    print('First cells to fill (row of the data without the removed entries):')
+    print(cell_errors(x2, miss_all)[['row', 'sample_id', 'column']].head(20).to_string(index=False))
     serious_error=1
 
   # Genotyping_site check
-  gs_er = np.setdiff1d(x2.Genotyping_site.unique().astype('str'), ['NIH', 'Fulgent'])
+  gs_er = issue_values('Genotyping_site', 'vocab')
   if len(gs_er)>0:
-    print('Undefined value:', fh_er)
+    print('Undefined value:', gs_er)
     print('\n!!!SERIOUS ERROR!!! \nGenotyping_site is either NIH or Fulgent')
     serious_error=1
 
   # If shipping to Fulgent, Box ID and Well position determined? 
-  x2_fulgent_non_miss_check = x2.loc[x2.Genotyping_site=='Fulgent', 
-                                     ['sample_id', 'DNA_volume', 'DNA_conc',  'Plate_name', 'Plate_position']
-                                     ].copy()
-  if x2_fulgent_non_miss_check.isna().sum().sum()>0:
+  miss_fulgent = miss[miss['where'].notna()]
+  if len(miss_fulgent)>0:
     print('\n!!!SERIOUS ERROR!!! \nThese are samples to Fulgent.\nMissing not allowed for the following columns. Please fill and repeat this process again.')
-    print(x2_fulgent_non_miss_check.info())
+    print(miss_fulgent[['column', 'n']].rename(columns={'n':'n_missing'}).to_string(index=False))
+    print('First cells to fill (row of the data without the removed entries):')
+    print(cell_errors(x2, miss_fulgent)[['row', 'sample_id', 'column']].head(20).to_string(index=False))
     serious_error=1
+  timer.lap('required fields check')
 
   # Plate name, Position check
   print('\n==== Check N per plate/box (Usually less than 96) ====')
-  x2_plate_fillna = x2.copy()
-  x2_plate_fillna.Plate_name = x2_plate_fillna.Plate_name.fillna('Not Provided')
-  for plate in x2_plate_fillna.Plate_name.unique():
-    x2_plate = x2_plate_fillna[x2_plate_fillna.Plate_name==plate].copy()
-    x2_plate_pos = x2_plate.Plate_position
-    # duplicated position check
-    if plate!='Not Provided':
-      dup_pos = x2_plate_pos[x2_plate_pos.duplicated()].unique()
-      if len(dup_pos)>0:
-        print(f'\n!!!SERIOUS ERROR!!! \nPlate position duplicated - {dup_pos} on [{plate}]')
-        serious_error = 1
-  xtab = x2_plate_fillna.pivot_table(index='Plate_name', 
-                      columns='Phenotype', margins=True,
-                      values='sample_id', aggfunc='count', fill_value=0)
+  wells = check_plate_wells(x2.Plate_name, x2.Plate_position, n_wells)
+  if len(wells['over_capacity'])>0:
+    print(f'\nMore than {n_wells} samples on a plate:')
+    print(wells['over_capacity'])
+  # duplicated position check
+  for plate, dup_pos in wells['duplicated'].groupby('Plate_name', sort=False).Plate_position:
+    print(f'\n!!!SERIOUS ERROR!!! \nPlate position duplicated - {list(dup_pos)} on [{plate}]')
+    serious_error = 1
+  for plate, bad_pos in wells['out_of_range'].groupby('Plate_name', sort=False).Plate_position:
+    print(f'\n!!!SERIOUS ERROR!!! \nPlate position not on a {n_wells}-well plate - {list(bad_pos)} on [{plate}]')
+    serious_error = 1
+  xtab = crosstab(x2.Plate_name, x2.Phenotype, x2.sample_id, index_na='Not Provided')
   print(xtab)
+  timer.lap('plate check')
 
   if serious_error==1:
     print('please resolve errorss')
@@ -215,6 +241,7 @@ def checkSampleManifest(data, dup_not_allowed=True):
   x2[qc_cols] = x2[origin_col].copy()
   # recover original cols
   x2[origin_col] = x2_origin[origin_col].copy() 
+  timer.lap('output')
     
   # return the data
   if flag==1:
@@ -231,6 +258,7 @@ def checkSampleManifest(data, dup_not_allowed=True):
     return (data_qced)
   
 # function to convert numeric if possible (to avoid the program to tell 3011.0 and 3011 are different)
+# giveGP2ID and compare_consistency use manifest_utils.canonical_id instead (typed strings, not object)
 def convertNumeric(arr):
   # If the object can be converted to be numeric, then convert to numeric
   # If not, then keep the string.
@@ -240,7 +268,67 @@ def convertNumeric(arr):
 
 ####################################################################################
 
-def giveGP2ID(data, manifest_id, list_non_finalized_mid = []):
+alloc_cols = ['manifest_id', 'first_uid', 'last_uid', 'n_new']
+
+def read_assigned(store, study_code, mnum, columns=None):
+  """
+  The GP2ID assigned files of the manifests m{mnum} (an earlier run) and after of the study
+  (qced folder, else finalized) with manifest_id and canonical clinical_id. Empty if none
+  """
+  names = {}
+  for folder in ['finalized', 'qced']: # qced if in both
+    for name in store.list(folder, f'{study_code}_sample_manifest_qced_m*'):
+      m = re.fullmatch(rf'{re.escape(study_code)}_sample_manifest_qced_m(\d+)', name)
+      if m is not None and int(m.group(1)) >= mnum:
+        names[name] = (folder, f'm{m.group(1)}')
+  dfs = store.read_many([(folder, name) for name, (folder, _) in names.items()], columns)
+  for df, (_, mid) in zip(dfs, names.values()):
+    df['manifest_id'] = mid
+    df['clinical_id'] = canonical_id(df.clinical_id)
+  if len(dfs)==0:
+    return pd.DataFrame({v:pd.Series(dtype=object) for v in ['study', 'clinical_id', 'GP2ID', 'GP2sampleID', 'manifest_id']})
+  return pd.concat(dfs, ignore_index=True)
+
+def read_alloc_log(store, study_code):
+  # uid_idx range allocated to each manifest of the study (gp2id_alloc folder of the store)
+  path = store.find('gp2id_alloc', study_code)
+  if path is None:
+    return pd.DataFrame({'manifest_id':pd.Series(dtype=str), 'first_uid':pd.Series(dtype=np.int64),
+                         'last_uid':pd.Series(dtype=np.int64), 'n_new':pd.Series(dtype=np.int64)})
+  return read_table(path)
+
+def write_alloc_log(store, study_code, alloc, manifest_id, first_uid, n_new):
+  # adds the range of a run of manifest_id (call while holding the lock of the study).
+  # The range of a redone manifest only grows: the uid_idx of the earlier run are not given back
+  os.makedirs(store.folder('gp2id_alloc'), exist_ok=True)
+  records = [r for r in alloc[alloc_cols].to_dict('records') if r['manifest_id']!=manifest_id]
+  last_uid = first_uid + n_new - 1
+  prev = alloc[alloc.manifest_id==manifest_id]
+  if len(prev)>0:
+    first_uid = int(prev.first_uid.min()) if n_new==0 else min(first_uid, int(prev.first_uid.min()))
+    last_uid = max(last_uid, int(prev.last_uid.max()))
+  records.append({'manifest_id':manifest_id, 'first_uid':first_uid, 'last_uid':last_uid, 'n_new':n_new})
+  return store.write(pd.DataFrame(records, columns=alloc_cols), 'gp2id_alloc', study_code)
+
+def read_alloc_participants(store, study_code):
+  # clinical_id --> uid_idx of all the participants allocated in the study (gp2id_alloc folder),
+  # also those later dropped from their manifest by a redo
+  path = store.find('gp2id_alloc', f'{study_code}_participants')
+  if path is None:
+    return pd.Series(dtype=np.int64)
+  x = read_table(path)
+  return pd.Series(x.uid_idx.to_numpy(dtype=np.int64), index=canonical_id(x.clinical_id))
+
+def write_alloc_participants(store, study_code, participants, new):
+  # adds the new participants (Series of clinical_id --> uid_idx, call while holding the lock of the study)
+  if len(new)==0:
+    return
+  os.makedirs(store.folder('gp2id_alloc'), exist_ok=True)
+  x = pd.concat([participants, new])
+  return store.write(pd.DataFrame({'clinical_id':x.index, 'uid_idx':x.to_numpy()}), 'gp2id_alloc', f'{study_code}_participants')
+
+def giveGP2ID(data, manifest_id, list_non_finalized_mid = [], registry=None, timer=None,
+              store=None, history_columns=None, sample_index=None):
   """
   This is a function to assign GP2ID to the data. 
   This will automatically read previous manifests of the study 
@@ -254,22 +342,72 @@ def giveGP2ID(data, manifest_id, list_non_finalized_mid = []):
   provide output_suffix and then {output_suffix}_sample_manifest_qced_{manifest_id}.csv
   # Not yet finalized manifests can be provided as list of manifest_id
   ## m1 and m2 are not finalized when doing qc for m3 --> list_non_finalized_mid = ['m1','m2']
+  # If a GP2ID registry (GP2IDRegistry or path to the file, see gp2id_registry.build_registry)
+  # is provided, the previous mappings are looked up there instead of reading the previous manifests.
+  ## Then only the samples of this manifest are returned
+  # To process the studies one by one without keeping all of them, use giveGP2ID_by_study
+  # Runs for the same study wait for each other (store.lock), so several curators/processes
+  ## can assign at the same time. The uid_idx range of each manifest is kept in the gp2id_alloc folder
+  ## and not given to another manifest of the study
+  # A redo of a manifest keeps the GP2IDs of its participants (also of those in the manifests after it
+  ## and of those dropped since, kept in the gp2id_alloc folder), and its new samples continue the
+  ## sample numbers of the other manifests, as with the registry
+  # timer: stage_timer.StageTimer to record the time/memory of each stage (optional)
+  # store: manifest_store.ManifestStore of the previous/output files (default: manifest_store.get_store())
+  ## the previous manifests are read in parallel; set cache_dir of the store to keep local copies of them
+  # history_columns: columns to load from the previous manifests (default: all).
+  ## e.g. history_columns=[] loads only study, clinical_id, GP2ID and GP2sampleID
+  ## (much faster with parquet files). The other columns of the previous samples are then missing
+  # sample_index: sample_id_index.SampleIDIndex or path to the file (see sample_id_index.build_index).
+  ## The IDs of the saved manifest are added to it (replacing those of an earlier run of the manifest)
+  """
+  study_codes = []
+  allx2 = []
+  for study_code, x2, x3 in giveGP2ID_by_study(data, manifest_id, list_non_finalized_mid, registry, timer,
+                                                   store, history_columns, sample_index):
+    study_codes.append(study_code)
+    allx2.append(x2)
+  if len(allx2)==0:
+    return
+
+  print(f'The DataFrame of all samples from {("+").join(study_codes)} including those from the previous manifests is returned for further checking')
+  return pd.concat(allx2)
+
+
+def giveGP2ID_by_study(data, manifest_id, list_non_finalized_mid = [], registry=None, timer=None,
+                       store=None, history_columns=None, sample_index=None):
   """
+  Streaming version of giveGP2ID.
+  Yields (study_code, GP2ID assigned samples including the previous manifests, samples of this manifest)
+  for each study as soon as the study is done and saved.
+  If there are multiple studies, the samples of this manifest for all studies are saved at the end.
+  Stages are recorded per study ('{study_code}: ID mapping' etc.) to timer if given
+  """
+  if timer is None:
+    timer = null_timer
+  timer.reset()
+  store = get_store(store)
+  if history_columns is not None:
+    history_columns = ['study', 'clinical_id', 'GP2ID', 'GP2sampleID'] + [v for v in history_columns if v not in ['study', 'clinical_id', 'GP2ID', 'GP2sampleID']]
   # check the data was QCed
   if "QC" not in data.columns:
     print('\n!!!SERIOUS ERROR!!! \nThe data does not seem to be QCed.')
     return
 
   # preparation
-  allx2 = pd.DataFrame()
-  allx3 = pd.DataFrame()
+  allx3 = []
   d = data.copy()
   d['manifest_id'] = manifest_id
-  d['clinical_id'] = convertNumeric(d.clinical_id)
+  d['clinical_id'] = canonical_id(d.clinical_id)
   mnum = int(manifest_id.replace('m', ''))
   study_codes = d.study.unique()
   if len(study_codes)>1:
     print('MULTIPLE STUDIES ARE DETECTED\n\n')
+  if isinstance(registry, str):
+    registry = GP2IDRegistry(registry)
+  if isinstance(sample_index, str):
+    sample_index = SampleIDIndex(sample_index)
+  timer.lap('preparation')
   
   for study_code in study_codes:
     x1 = d[d.study==study_code].copy()
@@ -280,135 +418,243 @@ def giveGP2ID(data, manifest_id, list_non_finalized_mid = []):
     print('N of participants:', len(uids))
 
     
-    # load previous manifest if available
-    x0 = pd.DataFrame()
-    if mnum > 1:
-      for mnum_i in range(1,mnum):
-        if f'm{mnum_i}' in list_non_finalized_mid:
-          df_previous=pd.read_csv(f'/content/drive/Shared drives/GP2_data_repo/sample_manifest/qced/{study_code}_sample_manifest_qced_m{mnum_i}.csv')
-          print(f'previous version - m{mnum_i}: nrow = {df_previous.shape[0]} - !!Note the manifest not finalized - loaded from the "qced" folder')
+    # one process at a time per study (other studies in parallel): reading the previous manifests,
+    # allocating the uid_idx and writing the output are not interleaved with another run of the study
+    with store.lock(f'gp2id_{study_code}'):
+      # load previous manifest if available
+      x0 = []
+      if mnum > 1 and registry is None:
+        ## read concurrently (store.max_workers files at a time, from the local cache if set)
+        folders = ['qced' if f'm{mnum_i}' in list_non_finalized_mid else 'finalized' for mnum_i in range(1,mnum)]
+        dfs_previous = store.read_many([(folder, f'{study_code}_sample_manifest_qced_m{mnum_i}')
+                                        for mnum_i, folder in zip(range(1,mnum), folders)], history_columns)
+        for mnum_i, folder, df_previous in zip(range(1,mnum), folders, dfs_previous):
+          if folder=='qced':
+            print(f'previous version - m{mnum_i}: nrow = {df_previous.shape[0]} - !!Note the manifest not finalized - loaded from the "qced" folder')
           
-        else:
-          df_previous=pd.read_csv(f'/content/drive/Shared drives/GP2_data_repo/sample_manifest/finalized/{study_code}_sample_manifest_qced_m{mnum_i}.csv')
-          print(f'previous version - m{mnum_i}: nrow = {df_previous.shape[0]}')
-
-        df_previous['manifest_id']=f'm{mnum_i}'
-        df_previous['clinical_id']=convertNumeric(df_previous['clinical_id'])
-        x0 = x0.append(df_previous)
+          else:
+            print(f'previous version - m{mnum_i}: nrow = {df_previous.shape[0]}')
+
+          df_previous['manifest_id']=f'm{mnum_i}'
+          df_previous['clinical_id']=canonical_id(df_previous['clinical_id'])
+          x0.append(df_previous)
+      x0 = pd.concat(x0, ignore_index=True) if len(x0)>0 else pd.DataFrame()
+      timer.lap(f'{study_code}: previous manifest load')
           
-    # create mapping dictionary (mapid) of clinical id --> uid_idx
-    if len(x0)>0: ## retrieve previous mapping
-      uid_idx_previous = x0.GP2ID.str.split('_', expand=True).iloc[:,1].astype('int')
-      mapid = {clin:i for (clin,i) in zip(x0.clinical_id, uid_idx_previous)}
-      n=max(list(mapid.values()))+1 # uid_idx to use for new clinical_id
-
-      # update uids for the current data
-      uids_new = np.setdiff1d(uids, list(mapid.keys()))
-      print('N of new participants not in the previous manifests:', len(uids_new))
-      uids = uids_new # update
-
-    else:
-      n=1
-      mapid = {}
-    
-    # allocated uid_idx for new participants
-    for uid in uids:
-      mapid[uid]= n
-      n += 1
-
-    # map the sequencial number and create GP2IDs
-    x2 = pd.concat([x0,x1], ignore_index=True)
-    x2['uid_idx'] = x2.clinical_id.map(mapid)
-    x2['GP2ID'] = [f'{study_code}_{i:06}' for i in x2.uid_idx]
-
-    # unique sample ID for GP2sampleID
-    x2['uid_idx_cumcount'] = x2.groupby('GP2ID').cumcount() + 1
-    x2['GP2sampleID'] = x2.GP2ID + '_s' + x2.uid_idx_cumcount.astype('str')
-    x2['SampleRepNo'] = 's' + x2.uid_idx_cumcount.astype('str')
-    x2 = x2.reset_index(drop=True)
-
-
-    # Table for Sample Number values
-    x2['manifest'] = x2.study + '_' + x2.manifest_id
-    print('\n====================')
-    xtab = x2.pivot_table(index='manifest', columns='SampleRepNo', margins=True,
-                          values='GP2sampleID', aggfunc='count', fill_value=0)
-    print(xtab)
-
-    # Table for Phenotypes
-    print('\n====================')
-    xtab = x2.pivot_table(index='manifest', columns='Phenotype', margins=True,
-                          values='GP2sampleID', aggfunc='count', fill_value=0)
-    print(xtab)
-
-    # drop temporary variables
-    x2 = x2.drop(columns=['uid_idx', 'uid_idx_cumcount', 'manifest', 'QC'])
-    x3 = x2.loc[x2.manifest_id==manifest_id].copy().reset_index(drop=True)
+      if registry is not None: ## previous mappings from the registry
+        x2 = x1.reset_index(drop=True)
+        x2['uid_idx'], x2['uid_idx_cumcount'] = registry.assign(study_code, manifest_id, x2.clinical_id)
+      else:
+        # clinical_id --> uid_idx: the previous manifests first, then the earlier run of this manifest,
+        # the manifests assigned after it (a redo keeps their GP2IDs, as the registry does)
+        x_done = read_assigned(store, study_code, mnum, history_columns)
+        x_after = x_done[x_done.manifest_id!=manifest_id]
+        # and the participants dropped by a redo (gp2id_alloc)
+        participants = read_alloc_participants(store, study_code)
+        mapid = pd.Series(dtype=np.int64)
+        for x in [x0, x_done[x_done.manifest_id==manifest_id], x_after]:
+          if len(x)>0:
+            m = pd.Series(parse_gp2id(x.GP2ID), index=x.clinical_id)
+            m = m[~m.index.duplicated(keep='last')]
+            mapid = pd.concat([mapid, m[~m.index.isin(mapid.index)]])
+        mapid = pd.concat([mapid, participants[~participants.index.isin(mapid.index)]])
+
+        # uid_idx for new clinical_id: after all the uid_idx given so far in the study
+        # (also those allocated to the manifests, gp2id_alloc, e.g. m2 redone after m3 got its GP2IDs)
+        alloc = read_alloc_log(store, study_code)
+        n = int(mapid.max()) + 1 if len(mapid)>0 else 1
+        reserved = alloc.last_uid.max()
+        if pd.notna(reserved) and reserved >= n:
+          print(f'uid_idx up to {reserved} already allocated to the manifests of {study_code}')
+          n = int(reserved) + 1
+        if len(mapid)>0:
+          uids = sort_ids(uids[~pd.Index(uids).isin(mapid.index)])
+          print('N of new participants not in the previous manifests:', len(uids))
+
+        # allocated uid_idx for new participants
+        mapid = pd.concat([mapid, pd.Series(np.arange(n, n+len(uids)), index=uids)])
+
+        # map the sequencial number and create GP2IDs
+        x2 = pd.concat([x0,x1], ignore_index=True)
+        x2['uid_idx'] = x2.clinical_id.map(mapid)
+
+        # sample number of the participant for GP2sampleID: the previous samples keep theirs,
+        # the samples of this manifest continue from the last number in the other manifests
+        # (including those after it) --> no GP2sampleID of a later manifest is given again
+        is_new = (x2.manifest_id==manifest_id).to_numpy()
+        x_other = pd.concat([x0, x_after], ignore_index=True)
+        n_prev = (pd.Series(parse_gp2id(x_other.GP2sampleID), index=x_other.clinical_id.map(mapid)).groupby(level=0).max()
+                  if len(x_other)>0 else pd.Series(dtype=np.int64))
+        rep = np.zeros(len(x2), dtype=np.int64)
+        if not is_new.all():
+          rep[~is_new] = parse_gp2id(x2.GP2sampleID[~is_new])
+        uid_new = x2.uid_idx[is_new]
+        rep[is_new] = uid_new.map(n_prev).fillna(0).to_numpy(dtype=np.int64) + uid_new.groupby(uid_new).cumcount().to_numpy() + 1
+        x2['uid_idx_cumcount'] = rep
+
+      # create GP2IDs and unique sample IDs
+      x2['GP2ID'] = format_gp2id(study_code, x2.uid_idx)
+      x2['GP2sampleID'] = format_gp2sampleid(study_code, x2.uid_idx, x2.uid_idx_cumcount)
+      x2['SampleRepNo'] = np.char.add('s', x2.uid_idx_cumcount.to_numpy().astype(str))
+      x2 = x2.reset_index(drop=True)
+      timer.lap(f'{study_code}: ID mapping')
+
+
+      # Table for Sample Number values
+      x2['manifest'] = x2.study.astype('str') + '_' + x2.manifest_id
+      print('\n====================')
+      xtab = crosstab(x2.manifest, x2.SampleRepNo, x2.GP2sampleID)
+      print(xtab)
+
+      # Table for Phenotypes
+      print('\n====================')
+      xtab = crosstab(x2.manifest, x2.Phenotype, x2.GP2sampleID)
+      print(xtab)
+
+      # drop temporary variables
+      x2 = x2.drop(columns=['uid_idx', 'uid_idx_cumcount', 'manifest', 'QC'], errors='ignore')
+      x3 = x2.loc[x2.manifest_id==manifest_id].copy().reset_index(drop=True)
+      timer.lap(f'{study_code}: tables')
     
 
-    # Return the results
-    output_file = f'{study_code}_sample_manifest_qced_{manifest_id}.csv'
-    output_path = f'/content/drive/Shared drives/GP2_data_repo/sample_manifest/qced/{output_file}'
-    print(f'\nSaved the GP2ID assigned table at [sample_manifest/qced] folder as: \n  * [{output_file}]\n')
-
-    x3.to_csv(output_path, index=False)
+      # Return the results
+      output_path = store.write(x3, 'qced', f'{study_code}_sample_manifest_qced_{manifest_id}')
+      print(f'\nSaved the GP2ID assigned table at [sample_manifest/qced] folder as: \n  * [{os.path.basename(output_path)}]\n')
+      if registry is None:
+        write_alloc_log(store, study_code, alloc, manifest_id, n, len(uids))
+        write_alloc_participants(store, study_code, participants, mapid.iloc[len(mapid)-len(uids):])
+      if sample_index is not None:
+        sample_index.add(x3, study_code, manifest_id)
+      timer.lap(f'{study_code}: file write')
 
-    allx2 = allx2.append(x2)
-    allx3 = allx3.append(x3)
+    allx3.append(x3)
+    yield study_code, x2, x3
+    timer.reset() # not counting the time of the caller
 
   if len(study_codes)>1:
-    output_file = f'{("_").join(study_codes)}_sample_manifest_qced_{manifest_id}.csv'
-    output_path = f'/content/drive/Shared drives/GP2_data_repo/sample_manifest/qced/{output_file}'
-    print(f'\nAdditionaly. saving the GP2ID assigned table of all samples from {("+").join(study_codes)} at [sample_manifest/qced] folder as: \n  * [{output_file}]')
-    allx3.to_csv(output_path, index=False)
-  
-  print(f'The DataFrame of all samples from {("+").join(study_codes)} including those from the previous manifests is returned for further checking')
-  return allx2
+    output_path = store.write(pd.concat(allx3), 'qced', f'{("_").join(study_codes)}_sample_manifest_qced_{manifest_id}')
+    print(f'\nAdditionaly. saving the GP2ID assigned table of all samples from {("+").join(study_codes)} at [sample_manifest/qced] folder as: \n  * [{os.path.basename(output_path)}]')
+    timer.lap('file write (all studies)')
 
 ##################################################################################################################
 
+def fingerprint_diff(target, reference, cols_to_compare, key='GP2sampleID'):
+  """
+  Compares the rows of target and reference by 64-bit digests of cols_to_compare.
+  The rows are matched by the key and only the differences are returned (indexed by the key):
+  study, status (added/removed/changed) and {column}_changed flags
+  """
+  t_digest, t_hash = row_fingerprint(target, cols_to_compare)
+  r_digest, r_hash = row_fingerprint(reference, cols_to_compare)
+  t_key = pd.Index(target[key])
+  r_key = pd.Index(reference[key])
+  if t_key.has_duplicates or r_key.has_duplicates:
+    print(f'!!!WARNING!!! Duplicated {key} --> only the first entry is compared')
+  t_first = ~t_key.duplicated()
+  r_first = ~r_key.duplicated()
+
+  # reference entry for each target entry (-1: added)
+  pos = r_key[r_first].get_indexer(t_key[t_first])
+  r_rows = np.flatnonzero(r_first)
+  t_rows = np.flatnonzero(t_first)
+  matched = pos >= 0
+  t_m, r_m = t_rows[matched], r_rows[pos[matched]]
+  changed = t_digest[t_m] != r_digest[r_m]
+  removed = np.setdiff1d(np.arange(len(r_rows)), pos[matched])
+
+  added_rows, changed_rows, removed_rows = t_rows[~matched], t_m[changed], r_rows[removed]
+  flags = np.vstack([np.ones((len(added_rows), len(cols_to_compare)), bool),
+                     t_hash[changed_rows] != r_hash[r_m[changed]],
+                     np.ones((len(removed_rows), len(cols_to_compare)), bool)])
+  df_diff = pd.DataFrame(flags, columns=[f'{v}_changed' for v in cols_to_compare],
+                         index=pd.Index(np.concatenate([t_key[added_rows], t_key[changed_rows], r_key[removed_rows]]), name=key))
+  df_diff.insert(0, 'status', ['added']*len(added_rows) + ['changed']*len(changed_rows) + ['removed']*len(removed_rows))
+  df_diff.insert(0, 'study', np.concatenate([target.study.to_numpy()[added_rows], target.study.to_numpy()[changed_rows],
+                                             reference.study.to_numpy()[removed_rows]]))
+  return df_diff
+
+
 def compare_consistency(target, reference, 
                         cols_to_compare=['study', 'sample_id', 'clinical_id', 
                                          'GP2sampleID', 'GP2ID', 
-                                         'manifest_id', 'original_manifest']):
+                                         'manifest_id', 'original_manifest'],
+                        fingerprint=False, timer=None, store=None, log=None):
   """
   This fuction compares the target DataFrame against the reference DataFrame.
   The defalut setting of the cols_to_compare
   ['study', 'sample_id', 'clinical_id', 'GP2sampleID', 'GP2ID', 'manifest_id', 'original_manifest']
   If you would like to test the overall consistency, use all columns like - 
   cols_to_compare = target.columns
+  With fingerprint=True, rows are compared by 64-bit digests of the columns (much less memory).
+  Then the differences are returned keyed by GP2sampleID as added/removed/changed entries
+  with a change flag per column (see fingerprint_diff)
+  timer: stage_timer.StageTimer to record the time/memory of each stage (optional)
+  store: manifest_store.ManifestStore to save the master sheet (default: manifest_store.get_store())
+  log: master_log.MasterSheetLog. If given, target is compared with the key index of the log instead of
+  the reference (MasterSheetLog.compare: changed and removed entries) and its new entries are validated
+  and appended as the next version instead of saving the full table (the issues are returned if any).
+  An empty log starts from the reference. Intended changes of entries are appended with log.append(entries, 'update')
   """
+  if timer is None:
+    timer = null_timer
+  timer.reset()
+  store = get_store(store)
   print(f'Target DF shape  : {target.shape}')
-  df = target[cols_to_compare]
-  n_df = df.shape[0]
-  df=df.apply(convertNumeric, axis=0)
   print(f'Refrence DF shape: {reference.shape}')
-  ref = reference[cols_to_compare]
-  ref=ref.apply(convertNumeric, axis=0)
-  n_ref = ref.shape[0]
-  df['source']='target'
-  ref['source']='reference'
-  
-  dfall = pd.concat([df, ref], axis=0, ignore_index=True)
-  
-  dfuniq= dfall.drop_duplicates(subset=dfall.columns[:-1]) # remove duplicates == entries in old should be duplicated in new
-  n_uniq = dfuniq.shape[0]
+  n_df = target.shape[0]
+  n_ref = reference.shape[0]
+  # create version
+  today = dt.datetime.today()
+  version = f'{today.year:04d}{today.month:02d}{today.day:02d}'
+  if log is not None: # compared with the key index of the log, not the full tables
+    if log.head==0: # the reference is the base of the log
+      log.snapshot(reference, note='reference')
+    log_version, issues, n_new = log.append_target(target, note=f'GP2sampleID_{version}')
+    timer.lap('log compare/append')
+    if log_version is None:
+      return issues
+    print('\nThe file is consistent with the previous version.')
+    print(f'N_total = {n_df}')
+    print(f'N_new   = {n_new}')
+    return
+  if fingerprint:
+    df_diff = fingerprint_diff(target, reference, list(cols_to_compare))
+    consistent = (df_diff.status!='added').sum()==0
+    timer.lap('fingerprint compare')
+  else:
+    df = target[cols_to_compare]
+    df=df.apply(canonical_id, axis=0)
+    ref = reference[cols_to_compare]
+    ref=ref.apply(canonical_id, axis=0)
+    timer.lap('normalize ids')
+    df['source']='target'
+    ref['source']='reference'
+    
+    dfall = pd.concat([df, ref], axis=0, ignore_index=True)
+    
+    dfuniq= dfall.drop_duplicates(subset=dfall.columns[:-1]) # remove duplicates == entries in old should be duplicated in new
+    consistent = n_df == dfuniq.shape[0]
+    timer.lap('compare')
 
-  if n_df == n_uniq:
+  if consistent:
     print('\nThe file is consistent with the previous version.')
     print(f'N_total = {n_df}')
     print(f'N_new   = {n_df - n_ref}')
 
-    # create version
-    today = dt.datetime.today()
-    version = f'{today.year:04d}{today.month:02d}{today.day:02d}'
-    filepath=f'/content/drive/Shared drives/GP2_data_repo/sample_manifest/master_sheet/GP2sampleID_{version}_draft.csv'
+    filepath = store.write(target, 'master_sheet', f'GP2sampleID_{version}_draft')
     print(f'The table was saved as\n  {filepath}')
-    target.to_csv(filepath, index=False)
+    timer.lap('file write')
   else:
     print('\n!!!ERRROR!!!\nNew file is inconsistent with the previous version.\n')
+    if fingerprint:
+      print('===== Number of different entries ========')
+      print(crosstab(df_diff.study, df_diff.status, margins=False))
+      timer.lap('difference table')
+      print(f'\nInconsisctency entries and new entries are returned')
+      return df_diff
     df_diff = dfall.drop_duplicates(subset=dfall.columns[:-1], keep=False).sort_values(['GP2sampleID', 'source']).copy()
     print('===== Number of different entries (consistent entries were removed) ========')
-    print(df_diff.pivot_table(index='study', columns='source', values='GP2sampleID', aggfunc='count'))
+    print(crosstab(df_diff.study, df_diff.source, df_diff.GP2sampleID, margins=False))
+    timer.lap('difference table')
     print(f'\nInconsisctency entries and new entries are returned')
     return df_diff.reset_index(drop=True)
\ No newline at end of file
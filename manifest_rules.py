@@ -0,0 +1,478 @@
+# validation rules of the sample manifest
+# declared once here and run by validate() for both the app and checkSampleManifest
+import argparse
+import pandas as pd
+import numpy as np
+from manifest_utils import plate_layouts, parse_well, well_cells
+from manifest_xlsx import read_xlsx
+
+template_cols = ['study', 'sample_id', 'sample_type',
+                 'DNA_volume', 'DNA_conc', 'r260_280',
+                 'Plate_name', 'Plate_position', 'clinical_id',
+                 'study_arm', 'sex', 'race',
+                 'age', 'age_of_onset', 'age_at_diagnosis', 'age_at_death', 'family_history',
+                 'region', 'comment', 'alternative_id1', 'alternative_id2']
+# added by the app
+qc_added_cols = ['Phenotype', 'Genotyping_site', 'Sample_submitter', 'original_manifest']
+numeric_cols = ['DNA_volume', 'DNA_conc', 'r260_280', 'age', 'age_of_onset', 'age_at_diagnosis', 'age_at_death']
+fulgent_cols = ['DNA_volume', 'DNA_conc', 'Plate_name', 'Plate_position']
+
+# controlled vocabularies
+vocab = {
+  'sample_type': ['Blood (EDTA)', 'Blood (ACD)', 'Blood', 'DNA',
+                  'DNA from blood', 'DNA from FFPE', 'RNA', 'Saliva',
+                  'Buccal Swab', 'T-25 Flasks (Amniotic)', 'FFPE Slide',
+                  'FFPE Block', 'Fresh tissue', 'Frozen tissue',
+                  'Bone Marrow Aspirate', 'Whole BMA', 'CD3+ BMA', 'Other'],
+  'Phenotype': ["PD", "Control", "Prodromal", "Other", "Not Reported"],
+  'sex': ["Male", "Female", "Intersex", "Unknown", "Other", "Not Reported"],
+  'race': ["American Indian or Alaska Native", "Asian", "White", "Black or African American",
+           "Multi-racial", "Native Hawaiian or Other Pacific Islander", "Other", "Unknown", "Not Reported"],
+  'family_history': ["Yes", "No", "Unknown", "Not Reported"],
+  'Genotyping_site': ['NIH', 'Fulgent'],
+}
+
+# dtypes to read a manifest with (read_manifest): the columns with a few distinct values
+# as categoricals and the IDs as text. The numeric columns are float64 if all values are numbers
+category_cols = ['study', 'sample_type', 'study_arm', 'sex', 'race', 'family_history', 'region', 'Plate_name',
+                 'Phenotype', 'Genotyping_site', 'Sample_submitter', 'original_manifest',
+                 'sex_for_qc', 'race_for_qc', 'family_history_for_qc', 'region_for_qc']
+str_cols = ['sample_id', 'clinical_id', 'Plate_position', 'comment', 'alternative_id1', 'alternative_id2']
+schema = {**{v:'category' for v in category_cols}, **{v:'str' for v in str_cols}}
+# all the columns of a (self-QCed) manifest
+known_cols = template_cols + qc_added_cols + ['sex_for_qc', 'race_for_qc', 'family_history_for_qc', 'region_for_qc']
+
+
+def read_manifest(f, excel=False, dtype=schema, usecols=None):
+  """
+  Reads a manifest csv (xlsx if excel, with manifest_xlsx.read_xlsx) with the dtypes of schema
+  f: path or file object
+  usecols: columns to read (default: all), e.g. known_cols
+  Numeric columns with text values are kept as read (the numeric rule reports them)
+  """
+  if excel:
+    df = read_xlsx(f, usecols, dtype)
+  else:
+    df = pd.read_csv(f, dtype=dtype, usecols=None if usecols is None else lambda v: v in usecols)
+  for v in numeric_cols:
+    if v in df.columns and pd.api.types.is_numeric_dtype(df[v].dtype) and not pd.api.types.is_bool_dtype(df[v].dtype):
+      df[v] = df[v].astype('float64')
+  return df
+
+
+def rule(column, kind, allowed=None, severity='error', where=None):
+  """
+  kind: 'column' (column exists), 'missing' (no missing value), 'vocab' (values in allowed),
+    'numeric' (numbers only, missing is fine) or 'unique' (no duplicated value)
+  severity: 'error' (must be fixed) or 'warning'
+  where: (column, value) to check only the rows with the value, e.g. ('Genotyping_site', 'Fulgent')
+  """
+  return {'column':column, 'kind':kind, 'allowed':allowed, 'severity':severity, 'where':where}
+
+
+# uploaded manifest (app.py). Genotyping_site is added from the menu before the check
+upload_rules = ([rule(v, 'column') for v in template_cols] +
+                [rule(v, 'missing') for v in ['study', 'sample_id', 'sample_type', 'clinical_id', 'study_arm', 'sex']] +
+                [rule(v, 'missing', where=('Genotyping_site', 'Fulgent')) for v in fulgent_cols] +
+                [rule('sample_id', 'unique'),
+                 rule('sample_type', 'vocab', vocab['sample_type'])] +
+                [rule(v, 'numeric') for v in numeric_cols])
+
+# self-QCed manifest (checkSampleManifest). sex, race and family_history are the *_for_qc values if given
+qc_rules = ([rule(v, 'column') for v in template_cols + qc_added_cols] +
+            [rule(v, 'missing') for v in ['sample_id', 'clinical_id', 'study', 'sample_type', 'region',
+                                          'Genotyping_site', 'Sample_submitter']] +
+            [rule(v, 'missing', where=('Genotyping_site', 'Fulgent')) for v in ['DNA_volume', 'DNA_conc', 'Plate_name', 'Plate_position']] +
+            [rule('sample_id', 'unique'), rule('clinical_id', 'unique'),
+             rule('Genotyping_site', 'vocab', vocab['Genotyping_site'])] +
+            [rule(v, 'missing', severity='warning') for v in ['sex', 'race', 'family_history']] +
+            [rule(v, 'vocab', vocab[v], severity='warning') for v in ['sample_type', 'Phenotype', 'sex', 'race', 'family_history']] +
+            [rule(v, 'numeric', severity='warning') for v in ['age', 'age_of_onset', 'age_at_diagnosis', 'age_at_death']])
+
+
+def validate(df, rules):
+  """
+  Runs the rules on df. The rules are grouped by column and each column is factorized once
+  (categoricals are not, their category codes are used), then all the rules of the column
+  are evaluated on the codes.
+  Rules of a missing column are not run (the column rule fails instead).
+  out: DataFrame of the failed rules (in the order of the rules) -
+    column, kind, severity, n (N of rows), values (offending values), where, rows (positions in df)
+  """
+  by_col = {}
+  for r in rules:
+    by_col.setdefault(r['column'], []).append(r)
+  masks = {} # rows selected by where
+  issues = []
+  no_rows = np.array([], dtype=np.int64)
+  for col, col_rules in by_col.items():
+    if col not in df.columns:
+      r = next((r for r in col_rules if r['kind']=='column'), col_rules[0])
+      issues.append((r, 0, np.array([col], dtype=object), no_rows))
+      continue
+    if all(r['kind']=='column' or (r['kind']=='numeric' and _is_number(df[col])) for r in col_rules):
+      codes = uniques = None # nothing to factorize
+    else:
+      codes, uniques = _codes(df[col])
+    for r in col_rules:
+      if r['kind']=='column' or (r['kind']=='numeric' and _is_number(df[col])):
+        continue
+      select = codes >= 0 if r['kind']!='missing' else codes < 0
+      if r['where'] is not None:
+        select = select & _where_mask(df, r['where'], masks)
+      if r['kind']=='missing':
+        rows = np.flatnonzero(select)
+        values = np.array([], dtype=object)
+      elif r['kind']=='vocab':
+        bad = ~pd.Index(uniques).astype('str').isin(r['allowed'])
+        bad &= np.bincount(codes[codes >= 0], minlength=len(uniques)) > 0 # unused categories
+        rows = np.flatnonzero(select & bad[codes])
+        values = np.asarray(uniques[bad], dtype=object)
+      elif r['kind']=='numeric':
+        bad = _not_number(uniques)
+        rows = np.flatnonzero(select & bad[codes])
+        values = np.asarray(uniques[bad], dtype=object)
+      elif r['kind']=='unique':
+        n = np.bincount(codes[select], minlength=len(uniques))
+        rows = np.flatnonzero(select & (n > 1)[codes])
+        values = np.asarray(uniques[n > 1], dtype=object)
+      else:
+        raise ValueError(f'unknown rule kind: {r["kind"]}')
+      if len(rows)>0:
+        issues.append((r, len(rows), values, rows))
+
+  return _issue_frame(issues, rules)
+
+
+def _codes(x):
+  # integer codes (-1 = missing) and distinct values of x (the categories of a categorical)
+  if isinstance(x.dtype, pd.CategoricalDtype):
+    return np.asarray(x.cat.codes, dtype=np.intp), x.cat.categories
+  return pd.factorize(x)
+
+
+def _is_number(x):
+  # numeric dtype of any width, numpy or nullable (Int64, Float32..), except bool
+  return pd.api.types.is_numeric_dtype(x.dtype) and not pd.api.types.is_bool_dtype(x.dtype)
+
+
+def _not_number(uniques):
+  # bool mask of the distinct values that are not numbers (text that can not be parsed, True/False)
+  u = pd.Series(np.asarray(uniques, dtype=object))
+  return (pd.to_numeric(u, errors='coerce').isna().to_numpy() |
+          u.map(lambda v: isinstance(v, (bool, np.bool_))).to_numpy(dtype=bool))
+
+
+def _where_mask(df, where, masks):
+  # rows of df with the value of where (column, value), cached in masks
+  if where not in masks:
+    w_col, w_value = where
+    masks[where] = (df[w_col].eq(w_value).to_numpy(dtype=bool, na_value=False)
+                    if w_col in df.columns else np.zeros(len(df), bool))
+  return masks[where]
+
+
+def _issue_frame(issues, rules):
+  # list of (rule, n, values, rows) --> output of validate
+  order = {id(r):i for i, r in enumerate(rules)}
+  issues.sort(key=lambda x: order[id(x[0])])
+  return pd.DataFrame({'column':[r['column'] for r, *_ in issues],
+                       'kind':[r['kind'] for r, *_ in issues],
+                       'severity':[r['severity'] for r, *_ in issues],
+                       'n':[n for _, n, _, _ in issues],
+                       'values':[v for *_, v, _ in issues],
+                       'where':[r['where'] for r, *_ in issues],
+                       'rows':[rows for *_, rows in issues]},
+                      columns=['column', 'kind', 'severity', 'n', 'values', 'where', 'rows'])
+
+
+def find_issue(issues, column, kind):
+  # the failed rule of column and kind (a row of the output of validate) or None
+  x = issues[(issues.column==column) & (issues.kind==kind)]
+  return None if len(x)==0 else x.iloc[0]
+
+
+def cell_errors(df, issues, n_wells=None, id_col='sample_id'):
+  """
+  The failed rules down to the cells: one row per (row, column, kind), built from the rows
+  of the issues at once. Column rules are left out (no cell to point at).
+  issues: output of validate
+  n_wells: the plate errors of manifest_utils.well_cells are added if given (and the plate columns exist)
+  out: DataFrame of row (position in df), id_col, column, kind, severity, value (as in the cell);
+    sorted by row. column, kind and severity are categoricals
+  """
+  issues = issues[issues.kind!='column']
+  n = np.array([len(x) for x in issues.rows], dtype=np.int64)
+  parts = [pd.DataFrame({'row':np.concatenate([np.asarray(x, dtype=np.int64) for x in issues.rows] + [np.array([], np.int64)]),
+                         'column':np.repeat(issues.column.to_numpy(dtype=object), n),
+                         'kind':np.repeat(issues.kind.to_numpy(dtype=object), n),
+                         'severity':np.repeat(issues.severity.to_numpy(dtype=object), n),
+                         'value':np.concatenate([df[v].to_numpy(dtype=object)[x] for v, x in zip(issues.column, issues.rows)] +
+                                                [np.array([], dtype=object)])})]
+  if n_wells is not None and 'Plate_name' in df.columns and 'Plate_position' in df.columns:
+    parts.append(well_cells(df.Plate_name, df.Plate_position, n_wells))
+  out = pd.concat(parts, ignore_index=True).sort_values('row', kind='stable', ignore_index=True)
+  out.insert(1, id_col, df[id_col].to_numpy(dtype=object)[out.row.to_numpy()] if id_col in df.columns else None)
+  for v in ['column', 'kind', 'severity']:
+    out[v] = pd.Categorical(out[v], categories=pd.unique(out[v]))
+  return out
+
+
+class _KeyIndex:
+  """
+  Hashed keys (uint64) --> row of the first entry, kept as a few sorted numpy blocks
+  (merged like a binary counter) instead of a python set: 16 bytes per key
+  """
+  def __init__(self):
+    self.blocks = []
+
+  def lookup(self, keys):
+    # row of the first entry of each key (-1 if new)
+    rows = np.full(len(keys), -1, dtype=np.int64)
+    for k, r in self.blocks:
+      i = np.searchsorted(k, keys).clip(max=len(k)-1)
+      hit = k[i] == keys
+      rows[hit] = r[i[hit]]
+    return rows
+
+  def add(self, keys, rows):
+    if len(keys)==0:
+      return
+    order = np.argsort(keys)
+    self.blocks.append((keys[order], rows[order]))
+    while len(self.blocks)>1 and len(self.blocks[-2][0]) <= 2 * len(self.blocks[-1][0]):
+      (k1, r1), (k2, r2) = self.blocks.pop(), self.blocks.pop()
+      k, r = np.concatenate([k2, k1]), np.concatenate([r2, r1])
+      order = np.argsort(k, kind='stable')
+      self.blocks.append((k[order], r[order]))
+
+
+def validate_csv(path, rules, chunksize=100_000, n_wells=96):
+  """
+  Streaming version of validate (+ manifest_utils.check_plate_wells) for manifests too large to load.
+  The csv is read in chunks of chunksize rows and only the columns used by the rules.
+  Across the chunks only compact states are kept: hashed keys of the unique columns (_KeyIndex),
+  N of entries per well of each plate, value counts of the vocab columns and the offending rows.
+  Columns with vocab/unique rules and the plate columns are read as text.
+  out: dict of
+    n_rows: N of rows
+    issues: same as validate(pd.read_csv(path), rules)
+    wells: same as check_plate_wells (Plate_name and Plate_position are given)
+    counts: value counts of the vocab columns (dict of Series)
+    numeric: numeric_profile.NumericSketch.result() of the numeric columns
+  """
+  from numeric_profile import NumericSketch # imports this module
+  header = pd.read_csv(path, nrows=0).columns
+  by_col = {}
+  for r in rules:
+    by_col.setdefault(r['column'], []).append(r)
+  issues = []
+  for col, col_rules in by_col.items():
+    if col not in header:
+      r = next((r for r in col_rules if r['kind']=='column'), col_rules[0])
+      issues.append((r, 0, np.array([col], dtype=object), np.array([], dtype=np.int64)))
+  rules_run = [r for r in rules if r['kind']!='column' and r['column'] in header]
+  plate_cols = ['Plate_name', 'Plate_position']
+  check_plates = all(v in header for v in plate_cols)
+  text_cols = set([r['column'] for r in rules_run if r['kind'] in ['vocab', 'unique']] +
+                  [r['where'][0] for r in rules_run if r['where'] is not None and r['where'][0] in header] +
+                  (plate_cols if check_plates else []))
+  usecols = set([r['column'] for r in rules_run]) | text_cols
+
+  # states across the chunks
+  found = {id(r):[] for r in rules_run} # offending rows per chunk
+  bad_values = {id(r):{} for r in rules_run} # offending value --> first row
+  key_index = {id(r):_KeyIndex() for r in rules_run if r['kind']=='unique'}
+  counts = {r['column']:pd.Series(dtype=np.int64) for r in rules_run if r['kind']=='vocab'}
+  nrow, ncol = plate_layouts[n_wells]
+  plate_idx = {} # Plate_name --> index of occupancy
+  occupancy = np.zeros((0, n_wells), dtype=np.int64) # N of entries per well (plates x wells)
+  plate_n = np.zeros(0, dtype=np.int64) # N of entries per plate
+  out_of_range = []
+  sketch = NumericSketch([r['column'] for r in rules_run if r['kind']=='numeric'])
+  n_rows = 0
+
+  reader = pd.read_csv(path, chunksize=chunksize, usecols=list(usecols), dtype={v:'str' for v in text_cols})
+  for chunk in reader:
+    offset = n_rows
+    n_rows += len(chunk)
+    sketch.update(chunk, offset)
+    masks = {}
+    for col in chunk.columns:
+      col_rules = [r for r in rules_run if r['column']==col]
+      if len(col_rules)==0:
+        continue
+      codes, uniques = pd.factorize(chunk[col])
+      for r in col_rules:
+        if r['kind']=='numeric' and _is_number(chunk[col]):
+          continue
+        select = codes >= 0 if r['kind']!='missing' else codes < 0
+        if r['where'] is not None:
+          select = select & _where_mask(chunk, r['where'], masks)
+        if r['kind']=='missing':
+          found[id(r)].append(offset + np.flatnonzero(select))
+        elif r['kind']=='vocab':
+          counts[col] = counts[col].add(pd.Series(np.bincount(codes[codes >= 0], minlength=len(uniques)),
+                                                  index=uniques), fill_value=0).astype(np.int64)
+          bad = ~pd.Index(uniques).astype('str').isin(r['allowed'])
+          rows = np.flatnonzero(select & bad[codes])
+          found[id(r)].append(offset + rows)
+          for v, i in zip(uniques[bad], np.flatnonzero(bad)):
+            bad_values[id(r)].setdefault(v, offset + np.argmax(codes==i))
+        elif r['kind']=='numeric':
+          bad = _not_number(uniques)
+          found[id(r)].append(offset + np.flatnonzero(select & bad[codes]))
+          for v, i in zip(uniques[bad], np.flatnonzero(bad)):
+            bad_values[id(r)].setdefault(v, offset + np.argmax(codes==i))
+        elif r['kind']=='unique':
+          # first entry of each value in this chunk, then the values seen in the previous chunks
+          u_codes = np.unique(codes[select])
+          first = np.full(len(uniques), -1, dtype=np.int64)
+          sel_rows = np.flatnonzero(select)
+          first[codes[sel_rows][::-1]] = sel_rows[::-1]
+          n = np.bincount(codes[select], minlength=len(uniques))
+          keys = pd.util.hash_array(np.asarray(uniques[u_codes], dtype=object))
+          prev = np.full(len(uniques), -1, dtype=np.int64)
+          prev[u_codes] = key_index[id(r)].lookup(keys)
+          key_index[id(r)].add(keys[prev[u_codes] < 0], offset + first[u_codes[prev[u_codes] < 0]])
+          dup = (n > 1) | (prev >= 0)
+          found[id(r)].append(offset + np.flatnonzero(select & dup[codes]))
+          found[id(r)].append(prev[dup & (prev >= 0)])
+          for i in np.flatnonzero(dup):
+            bad_values[id(r)].setdefault(uniques[i], prev[i] if prev[i] >= 0 else offset + first[i])
+
+    if check_plates:
+      p_codes, p_uniq = pd.factorize(chunk.Plate_name)
+      for v in p_uniq:
+        plate_idx.setdefault(v, len(plate_idx))
+      n_plates = len(plate_idx)
+      occupancy = np.vstack([occupancy, np.zeros((n_plates - len(occupancy), n_wells), dtype=np.int64)])
+      plate_n = np.concatenate([plate_n, np.zeros(n_plates - len(plate_n), dtype=np.int64)])
+      g_codes = np.append(np.array([plate_idx[v] for v in p_uniq], dtype=np.int64), -1)[p_codes]
+      row, col = parse_well(chunk.Plate_position, n_wells)
+      on_plate = g_codes >= 0
+      ok = on_plate & (row >= 0)
+      plate_n += np.bincount(g_codes[on_plate], minlength=n_plates)
+      occupancy += np.bincount(g_codes[ok] * n_wells + row[ok] * ncol + col[ok],
+                               minlength=n_plates*n_wells).reshape(n_plates, n_wells)
+      bad = on_plate & (row < 0) & chunk.Plate_position.notna().to_numpy()
+      out_of_range.append(chunk.loc[bad, ['Plate_name', 'Plate_position']].set_axis(offset + np.flatnonzero(bad)))
+
+  for r in rules_run:
+    rows = np.unique(np.concatenate(found[id(r)])) if len(found[id(r)])>0 else np.array([], dtype=np.int64)
+    if len(rows)>0:
+      values = sorted(bad_values[id(r)], key=bad_values[id(r)].get) # in the order of appearance
+      issues.append((r, len(rows), np.array(values, dtype=object), rows))
+  out = {'n_rows':n_rows, 'issues':_issue_frame(issues, rules),
+         'counts':{k:v.sort_values(ascending=False, kind='stable') for k, v in counts.items()},
+         'numeric':sketch.result()}
+
+  if check_plates:
+    plates = np.array(list(plate_idx), dtype=object)
+    try:
+      order = np.argsort(plates)
+    except TypeError: # mixed types can not be sorted
+      order = np.arange(len(plates))
+    plates = list(plates[order])
+    occupancy = occupancy[order].reshape(len(order), nrow, ncol)
+    n_samples = pd.Series(plate_n[order], index=pd.Index(plates, name='Plate_name'), name='n')
+    dup_p, dup_r, dup_c = np.nonzero(occupancy > 1)
+    out['wells'] = {'n_samples':n_samples,
+                    'over_capacity':n_samples[n_samples > n_wells],
+                    'duplicated':pd.DataFrame({'Plate_name':[plates[i] for i in dup_p],
+                                               'Plate_position':[f'{chr(65+r)}{c+1}' for r, c in zip(dup_r, dup_c)],
+                                               'n':occupancy[dup_p, dup_r, dup_c]}),
+                    'out_of_range':pd.concat(out_of_range) if len(out_of_range)>0 else
+                                   pd.DataFrame(columns=['Plate_name', 'Plate_position']),
+                    'occupancy':occupancy}
+  return out
+
+
+def validate_incremental(df, rules, state=None, row_keys=None):
+  """
+  Same output as validate(df, rules), re-checking only the rows that are new or changed
+  since the version validated with state (the state returned for the previous upload).
+  Rows are matched by content (row_keys), so inserted/deleted rows are fine.
+  Results of the per-row rules (missing, vocab) and the hashed values of the unique columns
+  are cached per row; duplicates are then found on the cached hashes. Column/numeric rules are checked as is.
+  row_keys: hash of each row, e.g. of the csv line of the row (default: hash of the columns used by the rules)
+  out: (issues, state for the next upload, changed - bool array of the new or changed rows)
+  """
+  row_rules = [r for r in rules if r['kind'] in ['missing', 'vocab']]
+  uniq_rules = [r for r in rules if r['kind']=='unique']
+  frame_issues = validate(df, [r for r in rules if r['kind'] in ['column', 'numeric']])
+  if (frame_issues.kind=='column').any(): # missing columns, nothing to cache
+    return validate(df, rules), None, np.ones(len(df), bool)
+  if row_keys is None:
+    cols = sorted(set(r['column'] for r in rules if r['kind']!='column') |
+                  set(r['where'][0] for r in rules if r['where'] is not None and r['where'][0] in df.columns))
+    row_keys = pd.util.hash_pandas_object(df[cols], index=False).to_numpy()
+  row_keys = np.asarray(row_keys)
+  if state is None or state['rules'] is not rules:
+    state = {'rules':rules, 'keys':pd.Index(np.array([], dtype=row_keys.dtype)),
+             'fail':np.zeros((0, len(row_rules)), bool), 'value_hash':np.zeros((0, len(uniq_rules)), np.uint64)}
+
+  # cached results of the unchanged rows
+  pos = state['keys'].get_indexer(row_keys)
+  changed = pos < 0
+  new_rows = np.flatnonzero(changed)
+  fail = np.zeros((len(df), len(row_rules)), bool)
+  fail[~changed] = state['fail'][pos[~changed]]
+  value_hash = np.zeros((len(df), len(uniq_rules)), np.uint64)
+  value_hash[~changed] = state['value_hash'][pos[~changed]]
+
+  # the changed rows
+  x = df.iloc[new_rows]
+  for j, r in enumerate(row_rules):
+    issue = validate(x, [r])
+    if len(issue)>0:
+      fail[new_rows[issue.rows[0]], j] = True
+  for j, r in enumerate(uniq_rules):
+    value_hash[new_rows, j] = pd.util.hash_array(x[r['column']].to_numpy(dtype=object))
+
+  issues = []
+  masks = {}
+  for j, r in enumerate(row_rules):
+    rows = np.flatnonzero(fail[:, j])
+    if len(rows)>0:
+      values = pd.unique(df[r['column']].iloc[rows].to_numpy(dtype=object)) if r['kind']=='vocab' else []
+      issues.append((r, len(rows), np.array(values, dtype=object), rows))
+  for j, r in enumerate(uniq_rules):
+    select = df[r['column']].notna().to_numpy()
+    if r['where'] is not None:
+      select = select & _where_mask(df, r['where'], masks)
+    sel_rows = np.flatnonzero(select)
+    rows = sel_rows[pd.Index(value_hash[sel_rows, j]).duplicated(keep=False)]
+    if len(rows)>0:
+      issues.append((r, len(rows), np.array(pd.unique(df[r['column']].iloc[rows].to_numpy(dtype=object)), dtype=object), rows))
+  for x in frame_issues.itertuples():
+    r = next(r for r in rules if r['column']==x.column and r['kind']==x.kind)
+    issues.append((r, x.n, x.values, x.rows))
+
+  first = ~pd.Index(row_keys).duplicated()
+  state = {'rules':rules, 'keys':pd.Index(row_keys[first]), 'fail':fail[first], 'value_hash':value_hash[first]}
+  return _issue_frame(issues, rules), state, changed
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Checks a (large) sample manifest csv chunk by chunk')
+  parser.add_argument('path', help='sample manifest csv')
+  parser.add_argument('--qced', action='store_true', help='check as a self-QCed manifest (qc_rules instead of upload_rules)')
+  parser.add_argument('--chunksize', type=int, default=100_000, help='N of rows per chunk')
+  parser.add_argument('--n_wells', type=int, default=96, choices=list(plate_layouts), help='N of wells per plate')
+  args = parser.parse_args()
+
+  res = validate_csv(args.path, qc_rules if args.qced else upload_rules, args.chunksize, args.n_wells)
+  print('N of entries:', res['n_rows'])
+  if len(res['issues'])==0:
+    print('No issue')
+  for _, x in res['issues'].iterrows():
+    print(f'{x.severity.upper()}: {x.column} - {x.kind}: N={x.n} {list(x["values"][:10])}')
+  if 'wells' in res:
+    wells = res['wells']
+    for plate, n in wells['over_capacity'].items():
+      print(f'WARNING: {n} entries on plate [{plate}]')
+    for _, x in wells['duplicated'].iterrows():
+      print(f'ERROR: Plate position duplicated - {x.Plate_position} on [{x.Plate_name}] (N={x.n})')
+    for _, x in wells['out_of_range'].iterrows():
+      print(f'ERROR: Plate position not on a {args.n_wells}-well plate - {x.Plate_position} on [{x.Plate_name}]')
@@ -0,0 +1,273 @@
+# storage of the qced, finalized and master_sheet files of the sample manifests
+# csv (default) or parquet (keeps the dtypes, columns can be loaded selectively; needs pyarrow)
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import io
+import os
+import shutil
+import socket
+import threading
+import time
+import pandas as pd
+
+# defaults of get_store(), can be set by configure() or the environment variables
+repo_dir = os.environ.get('GP2_SAMPLE_MANIFEST_DIR', '/content/drive/Shared drives/GP2_data_repo/sample_manifest')
+file_format = os.environ.get('GP2_SAMPLE_MANIFEST_FORMAT', 'csv')
+# local copies of the files read from repo_dir (None: no cache), e.g. ~/.cache/gp2_sample_manifest
+cache_folder = os.environ.get('GP2_SAMPLE_MANIFEST_CACHE')
+n_workers = 4 # N of files read at the same time by read_many
+lock_timeout = 600 # sec to wait for a lock of ManifestStore.lock
+lock_heartbeat = 30 # sec between the refreshes of the mtime of a held lock
+lock_stale = 300 # sec without a refresh after which a lock is considered left by a crashed process
+formats = ['csv', 'parquet']
+
+
+def _arrow_safe(df):
+  # object columns of mixed types (e.g. 1 and 'White') can not be saved by arrow --> strings
+  df = df.copy(deep=False)
+  for v in df.columns[df.dtypes==object]:
+    if pd.api.types.infer_dtype(df[v], skipna=True) in ['mixed', 'mixed-integer']:
+      df[v] = df[v].astype('string')
+  return df
+
+
+def read_table(path, columns=None):
+  """
+  Reads a csv/parquet file (by the extension)
+  columns: columns to load (the ones not in the file are ignored), in the order of the file for both formats
+  """
+  if path.endswith('.parquet'):
+    if columns is not None:
+      import pyarrow.parquet as pq
+      columns = [v for v in pq.read_schema(path).names if v in columns]
+    return pd.read_parquet(path, columns=columns)
+  if columns is not None:
+    return pd.read_csv(path, usecols=lambda v: v in columns)
+  return pd.read_csv(path)
+
+
+def write_table(df, path):
+  # written to a temporary file next to path and renamed, so a reader never sees a partial file
+  tmp = f'{path}.{os.getpid()}_{threading.get_ident()}.tmp'
+  try:
+    if path.endswith('.parquet'):
+      _arrow_safe(df).to_parquet(tmp, index=False)
+    else:
+      df.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+  finally:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+
+def table_bytes(df, fmt='csv'):
+  """
+  df as the content of a csv, gzipped csv ('csv.gz') or parquet file, e.g. for a download.
+  Written to a byte buffer (no csv string of the whole table)
+  """
+  buf = io.BytesIO()
+  if fmt=='parquet':
+    _arrow_safe(df).to_parquet(buf, index=False)
+  elif fmt=='csv.gz':
+    df.to_csv(buf, index=False, compression={'method':'gzip', 'compresslevel':6, 'mtime':0})
+  elif fmt=='csv':
+    df.to_csv(buf, index=False)
+  else:
+    raise ValueError(f'unknown format: {fmt}')
+  return buf.getvalue()
+
+
+def _take_stale(path):
+  """
+  Removes the lock file path if its mtime was not refreshed for lock_stale sec.
+  The file is renamed first (atomic: of the processes waiting for the lock only one gets it),
+  then checked again as it may be a new lock created after the stat (put back then)
+  out: True if the lock is gone (removed here or released meanwhile)
+  """
+  try:
+    if time.time() - os.stat(path).st_mtime <= lock_stale:
+      return False
+    tmp = f'{path}.{os.getpid()}_{threading.get_ident()}.stale'
+    os.rename(path, tmp)
+  except FileNotFoundError: # released or taken over by another process meanwhile
+    return True
+  if time.time() - os.stat(tmp).st_mtime <= lock_stale:
+    try:
+      os.link(tmp, path) # not if a lock was created meanwhile
+    except FileExistsError:
+      pass
+    except OSError: # no hard links on the file system
+      if not os.path.exists(path):
+        os.rename(tmp, path)
+        return False
+  os.remove(tmp)
+  return not os.path.exists(path)
+
+
+class ManifestStore:
+  """
+  {root}/{folder}/{name}.{csv or parquet}, folder is qced, finalized or master_sheet
+  Files are written in fmt. When reading, a file in the other format is used if there is no
+  file in fmt (e.g. the csv files from before switching to parquet)
+  cache_dir: files are read from local copies in cache_dir. A copy is used while the mtime and
+    size of the file in root are the same, so the finalized manifests are copied only once
+  max_workers: N of files read at the same time by read_many
+  """
+  def __init__(self, root=None, fmt=None, cache_dir=None, max_workers=None):
+    self.root = repo_dir if root is None else root
+    self.fmt = file_format if fmt is None else fmt
+    self.cache_dir = cache_folder if cache_dir is None else cache_dir
+    self.max_workers = n_workers if max_workers is None else max_workers
+    if self.fmt not in formats:
+      raise ValueError(f'fmt is one of {formats}')
+
+  def __repr__(self):
+    return f'ManifestStore({self.root!r}, {self.fmt!r}, cache_dir={self.cache_dir!r})'
+
+  def folder(self, folder):
+    return os.path.join(self.root, folder)
+
+  def path(self, folder, name, fmt=None):
+    return os.path.join(self.root, folder, f'{name}.{fmt or self.fmt}')
+
+  def find(self, folder, name):
+    # path of the existing file of name (fmt first), None if not found
+    for fmt in [self.fmt] + [v for v in formats if v!=self.fmt]:
+      if os.path.exists(self.path(folder, name, fmt)):
+        return self.path(folder, name, fmt)
+    return None
+
+  def exists(self, folder, name):
+    return self.find(folder, name) is not None
+
+  def read(self, folder, name, columns=None):
+    path = self.find(folder, name)
+    if path is None:
+      raise FileNotFoundError(self.path(folder, name))
+    if not self.cache_dir: # None or empty
+      return self._read_file(path, columns)
+    return read_table(self.cached(path), columns)
+
+  def read_many(self, items, columns=None):
+    """
+    Reads the files of items [(folder, name), ...] in max_workers threads
+    out: list of DataFrames in the order of items
+    """
+    items = list(items)
+    if self.max_workers<=1 or len(items)<=1:
+      return [self.read(folder, name, columns) for folder, name in items]
+    with concurrent.futures.ThreadPoolExecutor(min(self.max_workers, len(items))) as pool:
+      return list(pool.map(lambda v: self.read(v[0], v[1], columns), items))
+
+  def cached(self, path):
+    """
+    Local copy of a file of root in cache_dir (copied if missing or the mtime/size differs)
+    out: path of the copy
+    """
+    key = hashlib.md5(os.path.abspath(self.root).encode()).hexdigest()[:12]
+    local = os.path.join(self.cache_dir, key, os.path.relpath(path, self.root))
+    st = os.stat(path)
+    if os.path.exists(local):
+      lst = os.stat(local)
+      if lst.st_mtime_ns==st.st_mtime_ns and lst.st_size==st.st_size:
+        return local
+    os.makedirs(os.path.dirname(local), exist_ok=True)
+    tmp = f'{local}.{os.getpid()}_{threading.get_ident()}.tmp'
+    self._copy_file(path, tmp)
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns)) # the mtime of the file when it was copied
+    os.replace(tmp, local)
+    return local
+
+  # the only accesses to the file contents in root (to be overridden e.g. to add latency in benchmark)
+  def _read_file(self, path, columns=None):
+    return read_table(path, columns)
+
+  def _copy_file(self, src, dst):
+    shutil.copyfile(src, dst)
+
+  def write(self, df, folder, name):
+    # out: path of the file
+    path = self.path(folder, name)
+    write_table(df, path)
+    return path
+
+  @contextlib.contextmanager
+  def lock(self, name, timeout=None):
+    """
+    Exclusive lock of name for the processes sharing root (also on other machines):
+    the file {root}/.locks/{name}.lock is created (O_EXCL) and removed at the end.
+    Waits up to timeout sec (default: lock_timeout), then TimeoutError.
+    While held, the mtime of the file is refreshed every lock_heartbeat sec (a thread), so a lock
+    not refreshed for lock_stale sec was left by a crashed process and is taken over (see _take_stale)
+    """
+    path = os.path.join(self.root, '.locks', f'{name}.lock')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    timeout = lock_timeout if timeout is None else timeout
+    token = f'{socket.gethostname()} {os.getpid()} {threading.get_ident()}\n'
+    t0 = time.monotonic()
+    while True:
+      try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        break
+      except FileExistsError:
+        if _take_stale(path):
+          continue
+        if time.monotonic() - t0 > timeout:
+          raise TimeoutError(f'{path} is locked for more than {timeout} sec')
+        time.sleep(0.05)
+    os.write(fd, token.encode())
+    done = threading.Event()
+    def heartbeat():
+      while not done.wait(lock_heartbeat):
+        with contextlib.suppress(OSError): # the file of this lock even if taken over
+          os.utime(fd if os.utime in os.supports_fd else path)
+    beat = threading.Thread(target=heartbeat, daemon=True)
+    beat.start()
+    try:
+      yield path
+    finally:
+      done.set()
+      beat.join()
+      os.close(fd)
+      with contextlib.suppress(FileNotFoundError):
+        with open(path) as f:
+          mine = f.read()==token
+        if mine: # not a lock of another process (after a takeover)
+          os.remove(path)
+
+  def export_csv(self, folder, name, path=None):
+    # csv copy of a file for hand-off (default: next to the file). out: path of the csv
+    if path is None:
+      path = self.path(folder, name, 'csv')
+    src = self.find(folder, name)
+    if src != path:
+      write_table(read_table(src), path)
+    return path
+
+  def list(self, folder, pattern='*'):
+    # names (without the extension) of the files matching the pattern, csv and parquet
+    files = glob.glob(os.path.join(self.root, folder, pattern + '.csv')) + \
+            glob.glob(os.path.join(self.root, folder, pattern + '.parquet'))
+    return sorted(set(os.path.splitext(os.path.basename(f))[0] for f in files))
+
+
+def configure(root=None, fmt=None, cache=None, workers=None):
+  # sets the defaults of get_store()
+  global repo_dir, file_format, cache_folder, n_workers
+  if root is not None:
+    repo_dir = root
+  if fmt is not None:
+    if fmt not in formats:
+      raise ValueError(f'fmt is one of {formats}')
+    file_format = fmt
+  if cache is not None:
+    cache_folder = cache
+  if workers is not None:
+    n_workers = workers
+
+
+def get_store(store=None):
+  # store if given, else the store of the defaults (repo_dir, file_format, cache_folder, n_workers)
+  return store if store is not None else ManifestStore()
@@ -0,0 +1,384 @@
+# shared helpers for app.py and manifest_func2.py
+import pandas as pd
+import numpy as np
+
+
+def _factorize(x, na_label=None):
+  # integer codes (-1 = missing) and sorted labels of x.
+  # If na_label is given, missing entries get their own label instead of being dropped
+  if isinstance(getattr(x, 'dtype', None), pd.CategoricalDtype): # the category codes, no hashing
+    codes, labels = _sort_codes(np.asarray(x.cat.codes, dtype=np.intp), x.cat.categories)
+  else:
+    try:
+      codes, labels = pd.factorize(x, sort=True)
+    except TypeError: # mixed types can not be sorted
+      codes, labels = pd.factorize(x)
+  labels = list(labels)
+  if na_label is not None and (codes < 0).any():
+    codes, labels = _sort_codes(np.where(codes < 0, len(labels), codes), labels + [na_label])
+  return codes, labels
+
+
+def _sort_codes(codes, labels):
+  # codes and labels with the labels sorted (kept as is if they can not be sorted)
+  try:
+    order = np.argsort(np.array(labels, dtype=object))
+  except TypeError:
+    return codes, labels
+  rank = np.empty(len(order), dtype=np.intp)
+  rank[order] = np.arange(len(order))
+  return np.where(codes < 0, -1, rank[codes.clip(min=0)]), [labels[i] for i in order]
+
+
+def fill_missing(x, value):
+  # x.fillna(value), also for categoricals (value is added to the categories)
+  if isinstance(x.dtype, pd.CategoricalDtype) and value not in x.cat.categories:
+    x = x.cat.add_categories([value])
+  return x.fillna(value)
+
+
+def recode(x, mapdic):
+  # x.replace(mapdic), also for categoricals (the categories are recoded, not each entry)
+  if isinstance(x.dtype, pd.CategoricalDtype):
+    return x.map(lambda v: mapdic.get(v, v))
+  return x.replace(mapdic)
+
+
+def crosstab(index, columns, values=None, margins=True, index_na=None, columns_na=None):
+  """
+  Count table of index x columns, same as
+  df.pivot_table(index=.., columns=.., values=.., aggfunc='count', margins=True, fill_value=0)
+  but computed from the factorized codes with np.bincount, so the frame is never copied.
+  index, columns: Series of the same length
+  values: if given, only entries with non-missing values are counted (e.g. sample_id)
+  index_na, columns_na: label for missing index/columns entries (instead of fillna on a copy).
+    If not given, the missing entries are not counted (same as pivot_table)
+  """
+  r_codes, r_labels = _factorize(index, index_na)
+  c_codes, c_labels = _factorize(columns, columns_na)
+  keep = (r_codes >= 0) & (c_codes >= 0)
+  if values is not None:
+    keep &= pd.notna(np.asarray(values))
+  nr, nc = len(r_labels), len(c_labels)
+  flat = r_codes[keep].astype(np.int64) * nc + c_codes[keep]
+  counts = np.bincount(flat, minlength=nr*nc).reshape(nr, nc)
+
+  # only the levels observed in the counted entries (as pivot_table)
+  r_obs = counts.sum(1) > 0
+  c_obs = counts.sum(0) > 0
+  counts = counts[r_obs][:, c_obs]
+  r_labels = [v for v, o in zip(r_labels, r_obs) if o]
+  c_labels = [v for v, o in zip(c_labels, c_obs) if o]
+  if margins:
+    counts = np.vstack([np.column_stack([counts, counts.sum(1)]),
+                        np.append(counts.sum(0), counts.sum())])
+    r_labels = r_labels + ['All']
+    c_labels = c_labels + ['All']
+  xtab = pd.DataFrame(counts,
+                      index=pd.Index(r_labels, name=getattr(index, 'name', None)),
+                      columns=pd.Index(c_labels, name=getattr(columns, 'name', None)))
+  return xtab
+
+
+# plate layouts: n_wells --> (n rows, n columns)
+plate_layouts = {96:(8, 12), 384:(16, 24)}
+
+def parse_well(pos, n_wells=96):
+  """
+  Parses plate positions (A1..H12 for 96 wells, A1..P24 for 384 wells; A01 is fine too)
+  into integer row/column codes. Only the unique positions are parsed as strings.
+  out: (row, col) int arrays starting from 0. -1 if missing, not parsable or out of range
+  """
+  nrow, ncol = plate_layouts[n_wells]
+  codes, uniq = pd.factorize(pd.Series(pos))
+  parsed = pd.Series(uniq).astype(str).str.strip().str.upper().str.extract(r'^([A-Z])0*(\d+)$')
+  is_parsed = parsed[0].notna().to_numpy()
+  u_row = np.full(len(uniq) + 1, -1, dtype=np.int64) # the last one for missing (code -1)
+  u_col = np.full(len(uniq) + 1, -1, dtype=np.int64)
+  u_row[:-1][is_parsed] = parsed[0][is_parsed].map(ord).to_numpy() - ord('A')
+  u_col[:-1][is_parsed] = parsed[1][is_parsed].astype(np.int64).to_numpy() - 1
+  bad = (u_row >= nrow) | (u_col < 0) | (u_col >= ncol)
+  u_row[bad] = -1
+  u_col[bad] = -1
+  return u_row[codes], u_col[codes]
+
+
+def check_plate_wells(plate_name, plate_position, n_wells=96):
+  """
+  Checks all plates at once with one grouped pass over (Plate_name, Plate_position).
+  Entries without Plate_name are not checked.
+  out: dict of
+    n_samples: N of entries per plate (Series)
+    over_capacity: plates with more than n_wells entries (Series of N)
+    duplicated: wells used more than once (DataFrame of Plate_name, Plate_position, n)
+    out_of_range: entries with a position not on the plate (DataFrame, indexed as the input)
+    occupancy: N of entries per well, array of (plates, rows, columns) in the order of n_samples
+  """
+  nrow, ncol = plate_layouts[n_wells]
+  plate_name = pd.Series(plate_name)
+  plate_position = pd.Series(plate_position, index=plate_name.index)
+  p_codes, plates = _factorize(plate_name)
+  n_plates = len(plates)
+  row, col = parse_well(plate_position, n_wells)
+
+  on_plate = p_codes >= 0
+  n_samples = np.bincount(p_codes[on_plate], minlength=n_plates)
+  n_samples = pd.Series(n_samples, index=pd.Index(plates, name='Plate_name'), name='n')
+
+  # positions given but not on the plate
+  bad = on_plate & (row < 0) & plate_position.notna().to_numpy()
+  out_of_range = pd.DataFrame({'Plate_name':plate_name[bad], 'Plate_position':plate_position[bad]})
+
+  # occupancy grid
+  ok = on_plate & (row >= 0)
+  key = p_codes[ok].astype(np.int64) * n_wells + row[ok] * ncol + col[ok]
+  occupancy = np.bincount(key, minlength=n_plates*n_wells).reshape(n_plates, nrow, ncol)
+
+  return _wells(n_samples, occupancy, out_of_range, n_wells)
+
+
+def _wells(n_samples, occupancy, out_of_range, n_wells):
+  # output of check_plate_wells from N of entries per plate/well and the out of range entries
+  plates = list(n_samples.index)
+  dup_p, dup_r, dup_c = np.nonzero(occupancy > 1)
+  duplicated = pd.DataFrame({'Plate_name':[plates[i] for i in dup_p],
+                             'Plate_position':[f'{chr(65+r)}{c+1}' for r, c in zip(dup_r, dup_c)],
+                             'n':occupancy[dup_p, dup_r, dup_c]})
+  return {'n_samples':n_samples,
+          'over_capacity':n_samples[n_samples > n_wells],
+          'duplicated':duplicated,
+          'out_of_range':out_of_range,
+          'occupancy':occupancy}
+
+
+def check_plate_wells_incremental(plate_name, plate_position, row_keys, state=None, n_wells=96):
+  """
+  Same output as check_plate_wells, checking again only the plates whose entries changed
+  since the version checked with state (the state returned for the previous upload).
+  A plate is matched by its name and the hashes of its rows (row_keys, in any order).
+  Plates with positions not on the plate are always checked again.
+  out: (output of check_plate_wells (out_of_range indexed by position), state for the next upload)
+  """
+  nrow, ncol = plate_layouts[n_wells]
+  plate_name = pd.Series(plate_name).reset_index(drop=True)
+  plate_position = pd.Series(plate_position).reset_index(drop=True)
+  p_codes, plates = _factorize(plate_name)
+  on_plate = np.flatnonzero(p_codes >= 0)
+  n = np.bincount(p_codes[on_plate], minlength=len(plates))
+  key = np.zeros(len(plates), dtype=np.uint64) # sum of the row hashes (wraps around)
+  np.add.at(key, p_codes[on_plate], np.asarray(row_keys).astype(np.uint64)[on_plate])
+  prev = {} if state is None or state['n_wells']!=n_wells else state['plates']
+  redo = np.array([p not in prev or prev[p][0]!=(int(k), int(m)) or prev[p][2]
+                   for p, k, m in zip(plates, key, n)], dtype=bool)
+
+  rows = on_plate[redo[p_codes[on_plate]]]
+  checked = check_plate_wells(plate_name[rows], plate_position[rows], n_wells)
+  occupancy = np.zeros((len(plates), nrow, ncol), dtype=np.int64)
+  where = {p:i for i, p in enumerate(plates)}
+  for j, p in enumerate(checked['n_samples'].index):
+    occupancy[where[p]] = checked['occupancy'][j]
+  for i in np.flatnonzero(~redo):
+    occupancy[i] = prev[plates[i]][1]
+  n_samples = pd.Series(n, index=pd.Index(plates, name='Plate_name'), name='n')
+  out_of_range = checked['out_of_range'].sort_index()
+  bad = set(out_of_range.Plate_name)
+  state = {'n_wells':n_wells,
+           'plates':{p:((int(key[i]), int(n[i])), occupancy[i], p in bad) for i, p in enumerate(plates)}}
+  return _wells(n_samples, occupancy, out_of_range, n_wells), state
+
+
+def well_cells(plate_name, plate_position, n_wells=96):
+  """
+  The plate errors of check_plate_wells down to the entries, as in manifest_rules.cell_errors:
+  positions not on the plate (kind 'well') and all the entries of the wells used more than once
+  (kind 'duplicated_well'). Entries without Plate_name are not checked.
+  out: DataFrame of row (position in the input), column, kind, severity, value
+  """
+  nrow, ncol = plate_layouts[n_wells]
+  plate_name = pd.Series(plate_name).reset_index(drop=True)
+  plate_position = pd.Series(plate_position).reset_index(drop=True)
+  row, col = parse_well(plate_position, n_wells)
+  on_plate = plate_name.notna().to_numpy()
+  bad = np.flatnonzero(on_plate & (row < 0) & plate_position.notna().to_numpy())
+  ok = np.flatnonzero(on_plate & (row >= 0))
+  wells = pd.DataFrame({'plate':plate_name.to_numpy(dtype=object)[ok], 'well':row[ok] * ncol + col[ok]})
+  dup = ok[wells.duplicated(keep=False).to_numpy()]
+  rows = np.concatenate([bad, dup])
+  return pd.DataFrame({'row':rows,
+                       'column':'Plate_position',
+                       'kind':np.repeat(['well', 'duplicated_well'], [len(bad), len(dup)]).astype(object),
+                       'severity':'error',
+                       'value':plate_position.to_numpy(dtype=object)[rows]})
+
+
+def plate_grid(wells, plate):
+  """
+  Occupancy of a plate as a DataFrame (rows A.., columns 1..) for display
+  wells: output of check_plate_wells
+  """
+  grid = wells['occupancy'][wells['n_samples'].index.get_loc(plate)]
+  nrow, ncol = grid.shape
+  return pd.DataFrame(grid, index=[chr(65+r) for r in range(nrow)], columns=range(1, ncol+1))
+
+
+def _gp2id_bytes(study_code, idx, width):
+  # GP2IDs as a byte matrix (one row per ID). The zero-padded digits are computed with
+  # integer arithmetic instead of formatting the IDs one by one
+  digits = (idx[:, None] // 10**np.arange(width-1, -1, -1)) % 10 + ord('0')
+  prefix = np.frombuffer(f'{study_code}_'.encode(), dtype=np.uint8)
+  return np.hstack([np.broadcast_to(prefix, (len(idx), len(prefix))), digits.astype(np.uint8)])
+
+
+def _to_str(mat):
+  # byte matrix --> array of str (trailing NULs are dropped)
+  return np.ascontiguousarray(mat).view(f'S{mat.shape[1]}').ravel().astype(str)
+
+
+def format_gp2id(study_code, uid_idx, width=6):
+  """
+  GP2IDs from uid indices, same as [f'{study_code}_{i:06}' for i in uid_idx]
+  """
+  idx = np.asarray(uid_idx, dtype=np.int64)
+  if len(idx)==0 or idx.min() < 0 or idx.max() >= 10**width or not str(study_code).isascii(): # rare, one by one
+    return np.array([f'{study_code}_{i:0{width}}' for i in idx], dtype=str)
+  return _to_str(_gp2id_bytes(study_code, idx, width))
+
+
+def format_gp2sampleid(study_code, uid_idx, rep, width=6):
+  """
+  GP2sampleIDs from uid indices and replicate numbers, same as
+  [f'{study_code}_{i:06}_s{r}' for i, r in zip(uid_idx, rep)]
+  """
+  idx = np.asarray(uid_idx, dtype=np.int64)
+  rep = np.asarray(rep, dtype=np.int64)
+  if len(idx)==0 or idx.min() < 0 or idx.max() >= 10**width or not str(study_code).isascii():
+    return np.array([f'{study_code}_{i:0{width}}_s{r}' for i, r in zip(idx, rep)], dtype=str)
+  # only a few replicate numbers --> format the unique ones
+  codes, uniq = pd.factorize(rep)
+  suffix = np.array([f'_s{r}' for r in uniq], dtype='S')[codes]
+  suffix = suffix.view(np.uint8).reshape(len(idx), -1)
+  return _to_str(np.hstack([_gp2id_bytes(study_code, idx, width), suffix]))
+
+
+def parse_gp2id(ids):
+  """
+  Number after the last '_' as int without str.split
+  GP2ID (STUDY_000012 --> 12) and GP2sampleID (STUDY_000012_s2 --> 2)
+  -1 if the text after the last '_' is not non-digits followed by the number (as the regex fallback)
+  """
+  ids = pd.Series(ids, dtype=object).fillna('')
+  try:
+    b = ids.to_numpy().astype('S')
+  except UnicodeEncodeError: # non-ascii
+    return pd.to_numeric(ids.str.extract(r'_\D*(\d+)$')[0], errors='coerce').fillna(-1).astype(np.int64).to_numpy()
+  n, w = len(b), b.dtype.itemsize
+  mat = np.frombuffer(b.tobytes(), dtype=np.uint8).reshape(n, w)
+  length = (mat != 0).sum(1)
+  j = np.arange(w)
+  last_sep = w - 1 - np.argmax(mat[:, ::-1]==ord('_'), axis=1)
+  last_sep[~(mat==ord('_')).any(1)] = w
+  is_digit = (mat >= ord('0')) & (mat <= ord('9')) & (j > last_sep[:, None]) & (j < length[:, None])
+  expo = np.clip(length[:, None] - 1 - j, 0, 18)
+  value = np.where(is_digit, (mat.astype(np.int64) - ord('0')) * 10**expo, 0).sum(1)
+  # the digits are the end of the text: non-digits (e.g. 's') then only digits after the last '_'
+  n_digit = is_digit.sum(1)
+  ok = (n_digit > 0) & (np.argmax(is_digit, axis=1) + n_digit == length)
+  return np.where(ok, value, -1)
+
+
+def hash_column(x):
+  """
+  64-bit hash of each entry of a column. The canonical IDs (canonical_id) are hashed as text,
+  so 3011, 3011.0 and '3011' get the same hash and large integer IDs stay distinct
+  """
+  ids = canonical_id(x)
+  h = pd.util.hash_array(ids.fillna('').to_numpy(dtype=object))
+  h[ids.isna().to_numpy()] = _missing_hash
+  return h
+
+
+def hash_rows(df):
+  """
+  64-bit hash of each row of df (all the columns) in vectorized passes, e.g. to find the rows
+  changed since the last upload. Text is hashed by 8-byte words of its bytes (no hash per string object),
+  categoricals by their categories and numbers as float64. Missing values get their own hash
+  """
+  h = np.zeros(len(df), dtype=np.uint64)
+  with np.errstate(over='ignore'):
+    for v in df.columns:
+      h = (h * np.uint64(1000003)) ^ _hash_values(df[v])
+  return h
+
+
+_missing_hash = np.uint64(0x9E3779B97F4A7C15)
+
+def _hash_values(x):
+  # 64-bit hash of each entry of a Series (see hash_rows)
+  if isinstance(x.dtype, pd.CategoricalDtype):
+    codes = np.asarray(x.cat.codes, dtype=np.intp)
+    return np.append(_hash_values(pd.Series(x.cat.categories)), _missing_hash)[codes]
+  if pd.api.types.is_numeric_dtype(x.dtype) or pd.api.types.is_bool_dtype(x.dtype):
+    return pd.util.hash_array(x.to_numpy(dtype='float64', na_value=np.nan))
+  is_na = x.isna().to_numpy()
+  values = np.where(is_na, '', x.to_numpy(dtype=object))
+  try:
+    b = values.astype('S')
+  except UnicodeEncodeError: # non-ascii
+    h = pd.util.hash_array(values.astype(str).astype(object))
+  else:
+    w = -(-b.dtype.itemsize // 8) * 8
+    words = b.astype(f'S{w}').view(np.uint64).reshape(len(b), -1)
+    h = np.zeros(len(b), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+      for j in range(words.shape[1]):
+        h = (h ^ words[:, j]) * np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(31)
+  h[is_na] = _missing_hash
+  return h
+
+
+def row_fingerprint(df, cols):
+  """
+  64-bit digest of each row of df[cols]
+  out: (digest per row, hash per row x column)
+  """
+  col_hash = np.column_stack([hash_column(df[v]) for v in cols]) if len(df)>0 else np.zeros((0, len(cols)), np.uint64)
+  digest = np.zeros(len(df), dtype=np.uint64)
+  for j in range(len(cols)):
+    digest = (digest * np.uint64(1000003)) ^ col_hash[:, j]
+  return digest, col_hash
+
+
+def canonical_id(x):
+  """
+  Canonical string of IDs in one vectorized pass: 3011, 3011.0, '3011', '3011.0' and ' 3011 ' --> '3011'.
+  Only integers within +-2**53 (exact as float) are canonicalized; integer columns are kept exact.
+  Other strings (e.g. '3.50', '1e3' or longer numbers) are kept as they are (stripped), missing stays missing.
+  out: Series of the pandas string dtype (not object)
+  """
+  x = pd.Series(x)
+  if pd.api.types.is_integer_dtype(x.dtype) or pd.api.types.is_bool_dtype(x.dtype):
+    return x.astype('string')
+  if pd.api.types.is_float_dtype(x.dtype):
+    out = pd.Series(pd.NA, index=x.index, dtype='string')
+    num = x.astype('float64').to_numpy()
+    is_num = np.isfinite(num)
+    with np.errstate(invalid='ignore'):
+      is_int = is_num & (num % 1 == 0) & (np.abs(num) < 2**53)
+    out[is_int] = num[is_int].astype(np.int64).astype(str)
+    out[is_num & ~is_int] = num[is_num & ~is_int].astype(str)
+    return out
+  out = x.astype('string').str.strip()
+  is_int = out.str.fullmatch(r'[+-]?\d{1,16}(\.0*)?').fillna(False).to_numpy(dtype=bool) # < 2**63
+  num = pd.to_numeric(out[is_int].str.replace(r'\.0*$', '', regex=True)).astype(np.int64)
+  in_range = (np.abs(num) < 2**53).to_numpy()
+  out[np.flatnonzero(is_int)[in_range]] = num[in_range].astype(str).to_numpy()
+  return out
+
+
+def sort_ids(ids):
+  # canonical IDs sorted as numbers first (numerically) and then as strings
+  ids = pd.Series(ids, dtype='string').reset_index(drop=True)
+  num = pd.to_numeric(ids, errors='coerce').astype('float64')
+  order = np.lexsort((ids.fillna('').to_numpy(dtype=object), num.fillna(0).to_numpy(), num.isna().to_numpy()))
+  return ids[order].to_numpy(dtype=object)
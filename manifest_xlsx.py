@@ -0,0 +1,161 @@
+# fast reader of the first sheet of an xlsx file (the sample manifest template)
+# the sheet xml is parsed directly (zipfile + ElementTree.iterparse) instead of building
+# an openpyxl cell object per cell, and only the requested columns are converted
+import datetime as dt
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+import pandas as pd
+from pandas.io.parsers import TextParser
+try: # optional: pd.read_excel(engine='calamine') is faster still (Rust)
+  import python_calamine
+  engine = 'calamine'
+except ImportError:
+  engine = None
+
+ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+rel_ns = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+# built-in number formats of dates/times (ECMA-376 18.8.30)
+date_fmt_ids = set(range(14, 23)) | set(range(45, 48))
+excel_epoch = dt.datetime(1899, 12, 30)
+
+
+def _col_index(ref):
+  # 'A1' --> 0, 'AB12' --> 27
+  n = 0
+  for ch in ref:
+    if ch.isdigit():
+      break
+    n = n * 26 + ord(ch) - 64
+  return n - 1
+
+
+def _first_sheet(z):
+  # path of the first sheet in the zip (the order of the workbook, not of the files)
+  wb = ET.fromstring(z.read('xl/workbook.xml'))
+  rid = wb.find(f'{ns}sheets/{ns}sheet').get(f'{rel_ns}id')
+  rels = ET.fromstring(z.read('xl/_rels/workbook.xml.rels'))
+  target = next(r.get('Target') for r in rels if r.get('Id')==rid)
+  return target.lstrip('/') if target.startswith('/') else 'xl/' + target
+
+
+def _shared_strings(z):
+  if 'xl/sharedStrings.xml' not in z.namelist():
+    return []
+  strings = []
+  for _, el in ET.iterparse(z.open('xl/sharedStrings.xml')):
+    if el.tag==f'{ns}si': # plain (t) or rich text (r/t), not the phonetic runs (rPh)
+      strings.append(''.join(t.text or '' for t in el.findall(f'{ns}t') + el.findall(f'{ns}r/{ns}t')))
+      el.clear()
+  return strings
+
+
+def _date_styles(z):
+  # indexes of the cell styles (s attribute) with a date/time number format
+  if 'xl/styles.xml' not in z.namelist():
+    return set()
+  styles = ET.fromstring(z.read('xl/styles.xml'))
+  custom = {int(f.get('numFmtId')) for f in styles.iter(f'{ns}numFmt')
+            if re.search(r'[dmyhs]', re.sub(r'"[^"]*"|\[[^\]]*\]', '', f.get('formatCode', '').lower()))}
+  xfs = styles.find(f'{ns}cellXfs')
+  if xfs is None:
+    return set()
+  return {i for i, xf in enumerate(xfs) if int(xf.get('numFmtId', 0)) in date_fmt_ids | custom}
+
+
+def _iso_datetime(v):
+  # value of a t="d" cell as openpyxl gives it: date, datetime, time or the text if not ISO 8601
+  for parse in [dt.date.fromisoformat if len(v)==10 else dt.datetime.fromisoformat, dt.time.fromisoformat]:
+    try:
+      return parse(v)
+    except ValueError:
+      pass
+  return v
+
+
+def xlsx_rows(f):
+  """
+  Values of the rows of the first sheet (lists, None for the empty cells), as openpyxl
+  read_only/values_only gives them: numbers as int (if whole) or float, dates as datetime
+  (also the ISO 8601 dates of t="d" cells)
+  f: path or file object
+  """
+  row_tag, v_tag, t_tag = f'{ns}row', f'{ns}v', f'{ns}t'
+  with zipfile.ZipFile(f) as z:
+    shared = _shared_strings(z)
+    dates = {str(i) for i in _date_styles(z)}
+    last = 0 # row number of the previous row (empty rows are not in the xml)
+    col_of = {} # column letters --> index
+    for _, el in ET.iterparse(z.open(_first_sheet(z))):
+      if el.tag!=row_tag:
+        continue
+      r = int(el.get('r', last + 1))
+      for _ in range(r - last - 1):
+        yield []
+      last = r
+      row = []
+      for i, c in enumerate(el):
+        attr = c.attrib
+        t = attr.get('t')
+        if t=='inlineStr':
+          v = ''.join(x.text or '' for x in c.iter(t_tag))
+        else:
+          v = c.findtext(v_tag)
+          if not v: # no value, or a formula without a cached value (<v/>)
+            continue
+          if t=='s':
+            v = shared[int(v)]
+          elif t=='b':
+            v = v=='1'
+          elif t=='d': # ISO 8601 date/time
+            v = _iso_datetime(v)
+          elif t!='str' and t!='e': # number
+            v = float(v)
+            if attr.get('s') in dates:
+              v = excel_epoch + dt.timedelta(days=v)
+            elif v.is_integer():
+              v = int(v)
+        if 'r' in attr:
+          letters = attr['r'].rstrip('0123456789')
+          j = col_of.get(letters)
+          if j is None:
+            j = col_of[letters] = _col_index(letters)
+        else:
+          j = i
+        if j > len(row):
+          row.extend([None] * (j - len(row)))
+        row.append(v)
+      el.clear()
+      yield row
+
+
+def _sheet_data(f, usecols=None):
+  # header and rows of the columns in usecols (all if None) as lists, '' for the empty cells (as pandas)
+  rows = xlsx_rows(f)
+  header = next(rows, [])
+  keep = [j for j, v in enumerate(header) if v is not None and (usecols is None or v in usecols)]
+  return [[header[j] for j in keep]] + [['' if j >= len(row) or row[j] is None else row[j] for j in keep]
+                                        for row in rows]
+
+
+def read_xlsx(f, usecols=None, dtype=None):
+  """
+  First sheet of an xlsx file as pd.read_excel(f, sheet_name=0, usecols=usecols, dtype=dtype)
+  but parsed with xlsx_rows. Only the columns in usecols (names) are kept and converted.
+  If python-calamine is installed, pd.read_excel(engine='calamine') is used instead.
+  Falls back to pd.read_excel if the file can not be parsed this way (e.g. not an xlsx zip)
+  """
+  if engine is None:
+    try:
+      data = _sheet_data(f, usecols)
+    except (zipfile.BadZipFile, KeyError, StopIteration, ET.ParseError):
+      data = None
+      if hasattr(f, 'seek'):
+        f.seek(0)
+    if data is not None:
+      if len(data[0])==0: # empty sheet
+        return pd.DataFrame()
+      # the same conversion of the values as pd.read_excel
+      return TextParser(data, header=0, dtype=dtype).read()
+  return pd.read_excel(f, sheet_name=0, engine=engine, dtype=dtype,
+                       usecols=None if usecols is None else lambda v: v in usecols)
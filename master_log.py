@@ -0,0 +1,335 @@
+# GP2sampleID master sheet as a base snapshot + append-only delta segments (one per accepted batch)
+# {root}/master_sheet/{name}_log/
+#   base_v{version}.{fmt}   full table at the version (the first version and each compaction)
+#   delta_v{version}.{fmt}  rows added/updated/deleted by the version (column _op)
+#   versions.csv            one row per segment (version, kind, N of rows of each op, note, time)
+#   keys.sqlite             key index of the latest version: a delta is validated with lookups
+#                           of its own rows only, not by comparing the full tables
+import datetime as dt
+import os
+import sqlite3
+import pandas as pd
+import numpy as np
+from manifest_utils import canonical_id
+from manifest_store import get_store, read_table, write_table
+
+compact_every = 20 # append writes a new base after this many deltas (None: only by compact())
+ops = ['add', 'update', 'delete']
+version_cols = ['version', 'kind', 'n_rows', 'n_add', 'n_update', 'n_delete', 'note', 'time']
+key_cols = ['GP2sampleID', 'GP2ID', 'study', 'clinical_id', 'sample_id']
+
+schema = """
+CREATE TABLE IF NOT EXISTS meta (
+  k TEXT PRIMARY KEY,
+  v INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS sample (
+  GP2sampleID TEXT PRIMARY KEY,
+  GP2ID TEXT,
+  study TEXT,
+  clinical_id TEXT,
+  sample_id TEXT);
+CREATE INDEX IF NOT EXISTS sample_gp2id ON sample (GP2ID);
+CREATE INDEX IF NOT EXISTS sample_clinical ON sample (study, clinical_id);
+CREATE INDEX IF NOT EXISTS sample_sample_id ON sample (study, sample_id);
+"""
+
+# (issue, sql) of validate: rows of the delta (temporary table _delta) conflicting with the index
+checks = [
+  ('added GP2sampleID already in the master sheet',
+   "SELECT d.GP2sampleID, d.GP2sampleID, s.GP2sampleID FROM _delta d JOIN sample s ON d.GP2sampleID=s.GP2sampleID "
+   "WHERE d.op='add'"),
+  ('updated/deleted GP2sampleID not in the master sheet',
+   "SELECT d.GP2sampleID, d.GP2sampleID, NULL FROM _delta d LEFT JOIN sample s ON d.GP2sampleID=s.GP2sampleID "
+   "WHERE d.op!='add' AND s.GP2sampleID IS NULL"),
+  ('GP2ID of another clinical_id',
+   "SELECT d.GP2sampleID, d.clinical_id, s.clinical_id FROM _delta d JOIN sample s ON d.GP2ID=s.GP2ID "
+   "WHERE d.op!='delete' AND s.GP2sampleID!=d.GP2sampleID AND s.clinical_id!=d.clinical_id "
+   "AND s.GP2sampleID NOT IN (SELECT GP2sampleID FROM _delta)"),
+  ('clinical_id of another GP2ID',
+   "SELECT d.GP2sampleID, d.GP2ID, s.GP2ID FROM _delta d JOIN sample s ON d.study=s.study AND d.clinical_id=s.clinical_id "
+   "WHERE d.op!='delete' AND s.GP2sampleID!=d.GP2sampleID AND s.GP2ID!=d.GP2ID "
+   "AND s.GP2sampleID NOT IN (SELECT GP2sampleID FROM _delta)"),
+  ('sample_id of another GP2sampleID',
+   "SELECT d.GP2sampleID, d.sample_id, s.GP2sampleID FROM _delta d JOIN sample s ON d.study=s.study AND d.sample_id=s.sample_id "
+   "WHERE d.op!='delete' AND s.GP2sampleID!=d.GP2sampleID "
+   "AND s.GP2sampleID NOT IN (SELECT GP2sampleID FROM _delta WHERE op!='add')"),
+]
+
+
+def _keys(df):
+  # canonical key columns of df (missing columns as NA)
+  return pd.DataFrame({v:canonical_id(df[v]) if v in df.columns else pd.Series(pd.NA, index=df.index, dtype='string')
+                       for v in key_cols}).astype(object).where(lambda x: x.notna(), None)
+
+
+class MasterSheetLog:
+  """
+  Versions of the master sheet (1, 2, ...) stored as segments in the store (csv/parquet as the store).
+  append: validates a delta against the key index and writes it as the next version
+  append_target: the same for the new entries of a full table whose other entries match the index (compare)
+  materialize: the table at any version (the last base before it + the deltas after the base)
+  compact: writes the latest version as a base (materialize then reads one file)
+  """
+  def __init__(self, store=None, name='GP2sampleID'):
+    self.store = get_store(store)
+    self.name = name
+    self.folder = os.path.join('master_sheet', f'{name}_log')
+    self.root = self.store.folder(self.folder)
+    self.versions_path = os.path.join(self.root, 'versions.csv')
+    self.index_path = os.path.join(self.root, 'keys.sqlite')
+
+  def __repr__(self):
+    return f'MasterSheetLog({self.root!r}, head={self.head})'
+
+  def segment(self, kind, version):
+    # path of the segment (the existing file in csv or parquet if any)
+    name = f'{kind}_v{version:05d}'
+    return self.store.find(self.folder, name) or self.store.path(self.folder, name)
+
+  def versions(self):
+    if not os.path.exists(self.versions_path):
+      return pd.DataFrame({v:pd.Series(dtype=np.int64 if v.startswith(('version', 'n_')) else str) for v in version_cols})
+    return read_table(self.versions_path)
+
+  @property
+  def head(self):
+    # latest version (0: empty)
+    v = self.versions()
+    return int(v.version.max()) if len(v)>0 else 0
+
+  def _connect(self):
+    os.makedirs(self.root, exist_ok=True)
+    con = sqlite3.connect(self.index_path, isolation_level=None, timeout=60)
+    con.executescript(schema)
+    return con
+
+  def _index_version(self, con):
+    row = con.execute("SELECT v FROM meta WHERE k='version'").fetchone()
+    return 0 if row is None else row[0]
+
+  def _update_index(self, con, delta, version, rebuild=False):
+    # applies delta (column _op) to the key index in one transaction
+    keys = _keys(delta)
+    op = delta['_op'].to_numpy()
+    cur = con.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+      if rebuild:
+        cur.execute('DELETE FROM sample')
+      cur.executemany('DELETE FROM sample WHERE GP2sampleID=?', ((k,) for k in keys.GP2sampleID[op=='delete']))
+      cur.executemany('INSERT OR REPLACE INTO sample VALUES (?,?,?,?,?)', keys[op!='delete'].itertuples(index=False))
+      cur.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+      cur.execute('COMMIT')
+    except BaseException:
+      cur.execute('ROLLBACK')
+      raise
+
+  def index(self):
+    # connection to the key index of the head version (rebuilt if behind, e.g. after a crash)
+    con = self._connect()
+    head = self.head
+    if self._index_version(con)!=head:
+      print(f'Rebuilding the key index of {self.name} (version {head})')
+      self._update_index(con, self.materialize(head).assign(_op='add'), head, rebuild=True)
+    return con
+
+  def validate(self, delta, op='add'):
+    """
+    Checks the rows of delta against the key index of the latest version (and each other)
+    out: DataFrame (GP2sampleID, issue, value, existing), empty if the delta can be appended
+    """
+    delta = _with_op(delta, op)
+    keys = _keys(delta)
+    issues = []
+    missing = keys.GP2sampleID.isna()
+    issues += [(None, 'GP2sampleID missing', None, None)] * int(missing.sum())
+    dup = keys.GP2sampleID.duplicated(keep=False) & ~missing
+    issues += [(k, 'GP2sampleID duplicated in the delta', k, None) for k in keys.GP2sampleID[dup].unique()]
+    con = self.index()
+    try:
+      cur = con.cursor()
+      cur.execute('CREATE TEMP TABLE IF NOT EXISTS _delta (GP2sampleID TEXT, GP2ID TEXT, study TEXT, '
+                  'clinical_id TEXT, sample_id TEXT, op TEXT)')
+      cur.execute('DELETE FROM _delta')
+      cur.executemany('INSERT INTO _delta VALUES (?,?,?,?,?,?)',
+                      zip(*[keys[v] for v in key_cols], delta['_op']))
+      for issue, sql in checks:
+        issues += [(k, issue, v, e) for k, v, e in cur.execute(sql).fetchall()]
+    finally:
+      con.close()
+    return pd.DataFrame(issues, columns=['GP2sampleID', 'issue', 'value', 'existing'])
+
+  def compare(self, target):
+    """
+    Checks the entries of target (full table) against the key index of the latest version:
+    the entries with a GP2sampleID in the index must have the same key columns (SQL lookups),
+    and the N of them must be the N of entries in the index (else the removed ones are listed)
+    out: (issues: DataFrame (GP2sampleID, issue, value, existing), known: bool array of the rows of target in the index)
+    """
+    keys = _keys(target)
+    issues = []
+    dup = keys.GP2sampleID.duplicated(keep=False) & keys.GP2sampleID.notna()
+    issues += [(k, 'GP2sampleID duplicated in the target', k, None) for k in keys.GP2sampleID[dup].unique()]
+    con = self.index()
+    try:
+      cur = con.cursor()
+      cur.execute('CREATE TEMP TABLE IF NOT EXISTS _target (i INTEGER, GP2sampleID TEXT, GP2ID TEXT, study TEXT, '
+                  'clinical_id TEXT, sample_id TEXT)')
+      cur.execute('CREATE INDEX IF NOT EXISTS _target_key ON _target (GP2sampleID)')
+      cur.execute('DELETE FROM _target')
+      cur.executemany('INSERT INTO _target VALUES (?,?,?,?,?,?)', zip(range(len(keys)), *[keys[v] for v in key_cols]))
+      known = np.zeros(len(keys), bool)
+      known[[i for (i,) in cur.execute('SELECT t.i FROM _target t JOIN sample s ON t.GP2sampleID=s.GP2sampleID')]] = True
+      for v in key_cols[1:]:
+        issues += cur.execute(f"SELECT t.GP2sampleID, '{v} changed', t.{v}, s.{v} FROM _target t "
+                              f"JOIN sample s ON t.GP2sampleID=s.GP2sampleID WHERE t.{v} IS NOT s.{v}").fetchall()
+      n_index = cur.execute('SELECT count(*) FROM sample').fetchone()[0]
+      if keys.GP2sampleID[known].nunique() < n_index:
+        issues += cur.execute("SELECT s.GP2sampleID, 'removed from the target', NULL, s.GP2sampleID FROM sample s "
+                              "WHERE NOT EXISTS (SELECT 1 FROM _target t WHERE t.GP2sampleID=s.GP2sampleID)").fetchall()
+    finally:
+      con.close()
+    return pd.DataFrame(issues, columns=['GP2sampleID', 'issue', 'value', 'existing']), known
+
+  def append_target(self, target, note=''):
+    """
+    Appends the new entries of target (full table, GP2sampleID not in the index) as the next version
+    if the other entries of target are the entries of the latest version (compare) and the new ones
+    can be added (validate). Nothing is written if there are issues
+    out: (version or None, issues, N of new entries)
+    """
+    with self.store.lock(f'{self.name}_log'):
+      issues, known = self.compare(target)
+      if len(issues)>0:
+        print(f'\n!!!ERRROR!!!\n{len(issues)} entries of the target differ from {self.name}. Nothing was appended.')
+        print(issues.issue.value_counts().to_string())
+        return None, issues, 0
+      version, issues = self._append(target[~known].assign(_op='add'), note)
+    return version, issues, int((~known).sum())
+
+  def append(self, delta, op='add', note=''):
+    """
+    Validates delta and writes it as the next version (nothing is written if there are issues)
+    op: add, update or delete for all rows if delta has no _op column
+    out: (version or None, issues)
+    """
+    delta = _with_op(delta, op)
+    with self.store.lock(f'{self.name}_log'):
+      return self._append(delta, note)
+
+  def _append(self, delta, note):
+    issues = self.validate(delta)
+    if len(issues)>0:
+      print(f'\n!!!ERRROR!!!\n{len(issues)} issues in the delta of {self.name}. Nothing was appended.')
+      print(issues.issue.value_counts().to_string())
+      return None, issues
+    version = self.head + 1
+    kind = 'delta' if version > 1 else 'base'
+    if kind=='base': # the first version is the base
+      write_table(delta[delta._op!='delete'].drop(columns='_op'), self.segment('base', version))
+    else:
+      write_table(delta, self.segment('delta', version))
+    con = self._connect()
+    try:
+      self._update_index(con, delta, version, rebuild=kind=='base')
+    finally:
+      con.close()
+    n = delta._op.value_counts()
+    self._add_version(version, kind, len(delta), n, note)
+    print(f'{self.name} version {version}: ' + ', '.join(f'{v} {n.get(v, 0)}' for v in ops))
+    v = self.versions()
+    since_base = (v.version > v.version[v.kind=='base'].max()).sum()
+    if compact_every is not None and since_base >= compact_every:
+      self._compact()
+    return version, issues
+
+  def snapshot(self, df, note=''):
+    # writes df (full table) as the base of the next version. out: version
+    with self.store.lock(f'{self.name}_log'):
+      os.makedirs(self.root, exist_ok=True)
+      version = self.head + 1
+      write_table(df, self.segment('base', version))
+      con = self._connect()
+      try:
+        self._update_index(con, df.assign(_op='add'), version, rebuild=True)
+      finally:
+        con.close()
+      self._add_version(version, 'base', len(df), {'add':len(df)}, note)
+    return version
+
+  def _add_version(self, version, kind, n_rows, n, note):
+    row = {'version':version, 'kind':kind, 'n_rows':n_rows, **{f'n_{v}':int(n.get(v, 0)) for v in ops},
+           'note':note, 'time':dt.datetime.now().isoformat(timespec='seconds')}
+    records = self.versions().to_dict('records') + [row]
+    write_table(pd.DataFrame(records, columns=version_cols), self.versions_path)
+
+  def materialize(self, version=None):
+    """
+    Master sheet at version (default: latest): the last base at or before version,
+    then the deltas after it in order (reads only these files)
+    """
+    v = self.versions()
+    version = self.head if version is None else version
+    v = v[v.version<=version]
+    bases = v[v.kind=='base']
+    if len(bases)==0:
+      raise ValueError(f'no base of {self.name} at or before version {version}')
+    base = int(bases.version.max())
+    df = read_table(self.segment('base', base))
+    deltas = v[(v.kind=='delta') & (v.version>base)].version.sort_values()
+    if len(deltas)==0:
+      return df
+    d = pd.concat([read_table(self.segment('delta', int(i))) for i in deltas], ignore_index=True)
+    return _apply(df, d)
+
+  def compact(self, drop_old=False):
+    """
+    Writes the latest version as a base. drop_old: removes the segments before it
+    (the older versions can not be materialized any more)
+    """
+    with self.store.lock(f'{self.name}_log'):
+      return self._compact(drop_old)
+
+  def _compact(self, drop_old=False):
+    head = self.head
+    df = self.materialize(head)
+    write_table(df, self.segment('base', head))
+    v = self.versions()
+    if not ((v.version==head) & (v.kind=='base')).any():
+      self._add_version(head, 'base', len(df), {'add':len(df)}, 'compaction')
+    if drop_old:
+      v = self.versions()
+      keep = (v.version==head) & (v.kind=='base')
+      for r in v[~keep].itertuples():
+        os.remove(self.segment(r.kind, r.version))
+      write_table(v[keep], self.versions_path)
+    print(f'{self.name} compacted at version {head}: nrow = {df.shape[0]}')
+    return head
+
+
+def _with_op(delta, op):
+  if '_op' in delta.columns:
+    bad = set(delta._op.unique()) - set(ops)
+    if len(bad)>0:
+      raise ValueError(f'_op is one of {ops}: {bad}')
+    return delta
+  if op not in ops:
+    raise ValueError(f'op is one of {ops}')
+  return delta.assign(_op=op)
+
+
+def _apply(df, d, key='GP2sampleID'):
+  # table df after the rows of d (column _op, in order): the last op of each key wins.
+  # Updated rows stay in place (every row of a key duplicated in df), added rows are appended
+  # (in the order they were first added). Columns first given by d are added (missing in the other rows)
+  columns = list(df.columns) + [v for v in d.columns if v not in df.columns and v!='_op']
+  last = d.drop_duplicates(key, keep='last').set_index(key).loc[d[key].drop_duplicates()]
+  op = last._op.to_numpy()
+  pos = last.index.get_indexer(df[key]) # row of last for each row of df, -1 if not in d
+  hit = pos >= 0
+  keep = ~hit | (op[pos] != 'delete')
+  take = np.where(hit, len(df) + pos, np.arange(len(df)))[keep]
+  added = np.flatnonzero(~last.index.isin(df[key]) & (op != 'delete'))
+  rows = pd.concat([df.reindex(columns=columns), last.drop(columns='_op').reset_index().reindex(columns=columns)],
+                   ignore_index=True)
+  return rows.iloc[np.concatenate([take, len(df) + added])].reset_index(drop=True)
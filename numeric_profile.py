@@ -0,0 +1,288 @@
+# profile of the numeric columns of a manifest: the columns are stacked into one float matrix
+# (column-major) and all the statistics of all columns come from vectorized reductions over it
+# (missing, min/mean/max, fixed-bin histograms by bincount), distinct values from hashing and
+# quantiles (only if asked) from partitions.
+# NumericSketch: mergeable summary for chunked/very large inputs (approximate distinct and quantiles)
+import warnings
+import numpy as np
+import pandas as pd
+from manifest_rules import numeric_cols
+
+quantiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+n_bins = 10 # histogram bins per column (as np.histogram)
+max_values = 5 # value counts instead of a histogram if N of distinct values <= max_values
+# plausible range of the values (warning if outside)
+ranges = {'DNA_volume':(0, np.inf), 'DNA_conc':(0, np.inf), 'r260_280':(0, np.inf),
+          'age':(0, 120), 'age_of_onset':(0, 120), 'age_at_diagnosis':(0, 120), 'age_at_death':(0, 120)}
+# (a, b): a <= b is expected (warning if a > b)
+plausibility = [('age_of_onset', 'age'), ('age_at_diagnosis', 'age'), ('age', 'age_at_death'),
+                ('age_of_onset', 'age_at_death'), ('age_at_diagnosis', 'age_at_death')]
+
+
+def stack(df, columns=numeric_cols):
+  # float matrix (rows x columns, column-major) of the columns, NaN for missing/non-numeric/absent
+  x = np.full((len(df), len(columns)), np.nan, order='F')
+  for j, v in enumerate(columns):
+    if v not in df.columns:
+      continue
+    col = df[v]
+    if not pd.api.types.is_numeric_dtype(col.dtype) or pd.api.types.is_bool_dtype(col.dtype):
+      col = pd.to_numeric(col.astype('object'), errors='coerce')
+    x[:, j] = col.to_numpy(dtype='float64', na_value=np.nan)
+  return x
+
+
+def _checks(x, columns, offset=0):
+  """
+  Range and cross-column plausibility checks on the matrix (all rules at once)
+  out: list of (check, rows)
+  """
+  out = []
+  idx = [j for j, v in enumerate(columns) if v in ranges]
+  if len(idx)>0:
+    lo = np.array([ranges[columns[j]][0] for j in idx])
+    hi = np.array([ranges[columns[j]][1] for j in idx])
+    bad = (x[:, idx] < lo) | (x[:, idx] > hi)
+    for k, j in enumerate(idx):
+      out.append((f'{columns[j]} not in [{lo[k]:g}, {hi[k]:g}]', offset + np.flatnonzero(bad[:, k])))
+  pairs = [(a, b) for a, b in plausibility if a in columns and b in columns]
+  if len(pairs)>0:
+    bad = x[:, [columns.index(a) for a, _ in pairs]] > x[:, [columns.index(b) for _, b in pairs]]
+    for k, (a, b) in enumerate(pairs):
+      out.append((f'{a} > {b}', offset + np.flatnonzero(bad[:, k])))
+  return out
+
+
+def _violation_frame(checks, max_rows=1000):
+  # out: DataFrame (check, n, rows) of the checks with any offending row
+  rows = [(c, len(r), r[:max_rows]) for c, r in checks if len(r)>0]
+  return pd.DataFrame(rows, columns=['check', 'n', 'rows'])
+
+
+def _histograms(x, lo, hi, bins):
+  """
+  Histograms of all columns at once (one bincount), bins equal bins over [lo, hi] of each column
+  as np.histogram(column) (a column of one value: [value - 0.5, value + 0.5]).
+  Only the finite values are counted (lo and hi: range of the finite values)
+  out: (counts: columns x bins, edges: columns x bins+1)
+  """
+  n_col = x.shape[1]
+  lo, hi = lo.copy(), hi.copy()
+  same = lo==hi
+  lo[same] -= 0.5
+  hi[same] += 0.5
+  ok = ~np.isnan(lo)
+  lo[~ok], hi[~ok] = 0, 1
+  edges = lo[:, None] + (hi - lo)[:, None] * np.linspace(0, 1, bins + 1)[None, :]
+  edges[:, -1] = hi
+  valid = np.isfinite(x)
+  c = np.nonzero(valid.T)[0] # column by column
+  v = x.T[valid.T]
+  i = np.floor((v - lo[c]) * (bins / (hi - lo))[c]).astype(np.int64).clip(0, bins - 1)
+  # the same corrections of the floating point error as np.histogram
+  i -= v < edges[c, i]
+  i += (v >= edges[c, i + 1]) & (i != bins - 1)
+  counts = np.bincount(c * bins + i, minlength=n_col * bins).reshape(n_col, bins)
+  return counts, edges
+
+
+def _quantiles(x, n, q):
+  """
+  Quantiles q of each column (linear interpolation as np.quantile) from a partition of
+  the non-missing values around the order statistics needed (no full sort)
+  out: {q: array of the columns}
+  """
+  out = {p:np.full(x.shape[1], np.nan) for p in q}
+  for j in np.flatnonzero(n > 0):
+    v = x[:, j][~np.isnan(x[:, j])]
+    h = np.array(q) * (n[j] - 1)
+    f = np.floor(h).astype(np.int64)
+    k = np.unique(np.concatenate([f, np.minimum(f + 1, n[j] - 1)]))
+    v = np.partition(v, k)
+    for p, hp, fp in zip(q, h, f):
+      a, b = v[fp], v[min(fp + 1, n[j] - 1)]
+      out[p][j] = a if a == b else a + (hp - fp) * (b - a) # a == b: also +-inf
+  return out
+
+
+def profile(df, columns=numeric_cols, bins=n_bins, q=()):
+  """
+  All statistics of the numeric columns of the stacked matrix: N, min, max and sums from
+  nan-reductions over the whole matrix, histograms from one bincount of the bin indices,
+  distinct values from hashing (no sort), quantiles q (e.g. quantiles) only if asked
+  out: dict of
+    summary: DataFrame indexed by column (n, n_missing, n_distinct, min, mean, max, quantiles q)
+    hist: {column: (counts, edges)} fixed-bin histograms of the finite values
+      (as np.histogram(column[np.isfinite(column)], bins))
+    values: {column: value counts (dropna=False)} of the columns with <= max_values distinct values
+    violations: DataFrame (check, n, rows) of the range and cross-column plausibility checks
+  """
+  columns = list(columns)
+  x = stack(df, columns) + 0.0 # -0.0 as 0.0
+  n_row, n_col = x.shape
+  n = np.count_nonzero(~np.isnan(x), axis=0)
+  has = n > 0
+  with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+    warnings.simplefilter('ignore', RuntimeWarning) # all-missing columns
+    lo = np.nanmin(x, axis=0) if n_row > 0 else np.full(n_col, np.nan)
+    hi = np.nanmax(x, axis=0) if n_row > 0 else np.full(n_col, np.nan)
+    mean = np.where(has, np.nansum(x, axis=0) / n, np.nan) # NaN as 0 in the sum, as pandas mean
+  uniques = [pd.unique(x[:, j][~np.isnan(x[:, j])]) for j in range(n_col)]
+  n_distinct = np.array([len(u) for u in uniques], dtype=np.int64)
+  summary = {'n':n, 'n_missing':n_row - n, 'n_distinct':n_distinct, 'min':lo, 'mean':mean, 'max':hi}
+  for p, v in _quantiles(x, n, q).items():
+    summary[f'q{round(p * 100):02d}'] = v
+  summary = pd.DataFrame(summary, index=pd.Index(columns, name='column'))
+
+  finite = np.isfinite(x)
+  has_finite = finite.any(axis=0)
+  if (has_finite != has).any() or np.isinf(lo).any() or np.isinf(hi).any(): # +-inf (e.g. 'inf' in a csv)
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore', RuntimeWarning)
+      lo, hi = np.nanmin(np.where(finite, x, np.nan), axis=0), np.nanmax(np.where(finite, x, np.nan), axis=0)
+  counts, edges = _histograms(x, lo, hi, bins)
+  hist = {v:(counts[j], edges[j]) for j, v in enumerate(columns) if has_finite[j]}
+  values = {}
+  for j in np.flatnonzero(has & (n_distinct <= max_values)):
+    u = np.sort(uniques[j])
+    v = x[:, j][~np.isnan(x[:, j])]
+    s = pd.Series(np.bincount(np.searchsorted(u, v), minlength=len(u)), index=u, name='count')
+    if n[j] < n_row:
+      s = pd.concat([s, pd.Series([n_row - n[j]], index=[np.nan], name='count')])
+    values[columns[j]] = s.rename_axis(columns[j]).sort_values(ascending=False, kind='stable')
+  return {'summary':summary, 'hist':hist, 'values':values, 'violations':_violation_frame(_checks(x, columns))}
+
+
+def _hash(x):
+  # splitmix64 of the float bits (-0.0 as 0.0), uint64 matrix
+  z = (x + 0.0).view(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+  z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+  z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+  return z ^ (z >> np.uint64(31))
+
+
+class NumericSketch:
+  """
+  Mergeable one-pass summary of the numeric columns for chunked/very large inputs:
+  N, missing, sum, min, max (exact), the violations of the checks (exact, row numbers in the input),
+  distinct values (k minimum hash values: exact below k distinct values, else about 1/sqrt(k) error) and
+  quantiles/histograms from log-spaced buckets (relative error alpha, see DDSketch).
+  sketch = NumericSketch(); for chunk in chunks: sketch.update(chunk); sketch.result()
+  Sketches of parts of the input are combined with merge (give the offset of each part to update)
+  """
+  min_abs = 1e-9 # smaller absolute values go to the zero bucket
+
+  def __init__(self, columns=numeric_cols, alpha=0.005, k=1024):
+    self.columns = list(columns)
+    self.alpha = alpha
+    self.k = k
+    self.log_gamma = np.log((1 + alpha) / (1 - alpha))
+    self.offset = int(np.ceil(-np.log(self.min_abs) / self.log_gamma)) + 1 # bucket keys of |x| >= min_abs > 0
+    c = len(self.columns)
+    self.n_rows = 0
+    self.n = np.zeros(c, dtype=np.int64)
+    self.sum = np.zeros(c)
+    self.min = np.full(c, np.inf)
+    self.max = np.full(c, -np.inf)
+    self.finite_min = np.full(c, np.inf) # range of the finite values (of the buckets)
+    self.finite_max = np.full(c, -np.inf)
+    self.buckets = pd.Series(dtype=np.int64) # column * 2**32 + signed bucket key --> count
+    self.kmv = [np.array([], dtype=np.uint64) for _ in range(c)]
+    self.checks = {}
+
+  def _keys(self, v):
+    # signed bucket keys: 0 for |v| < min_abs, +-(ceil(log_gamma |v|) + offset) otherwise
+    a = np.abs(v)
+    with np.errstate(divide='ignore'):
+      k = np.ceil(np.log(np.maximum(a, self.min_abs)) / self.log_gamma).astype(np.int64) + self.offset
+    return np.where(a < self.min_abs, 0, np.sign(v).astype(np.int64) * k)
+
+  def update(self, df, offset=None):
+    """
+    Adds the rows of df. out: self
+    offset: row number of the first row of df in the input (default: the next rows after the ones added)
+    """
+    x = stack(df, self.columns)
+    offset = self.n_rows if offset is None else offset
+    valid = ~np.isnan(x)
+    self.n += valid.sum(axis=0)
+    with np.errstate(invalid='ignore'): # inf - inf
+      self.sum += np.nansum(x, axis=0)
+    if len(x)>0:
+      with np.errstate(invalid='ignore'):
+        self.min = np.fmin(self.min, np.nanmin(np.where(valid, x, np.inf), axis=0))
+        self.max = np.fmax(self.max, np.nanmax(np.where(valid, x, -np.inf), axis=0))
+        finite = np.isfinite(x)
+        self.finite_min = np.fmin(self.finite_min, np.min(np.where(finite, x, np.inf), axis=0))
+        self.finite_max = np.fmax(self.finite_max, np.max(np.where(finite, x, -np.inf), axis=0))
+    r, c = np.nonzero(np.isfinite(x)) # +-inf not in the buckets
+    codes, counts = np.unique(c.astype(np.int64) * 2**32 + self._keys(x[r, c]), return_counts=True)
+    self.buckets = self.buckets.add(pd.Series(counts, index=codes), fill_value=0).astype(np.int64)
+    h = _hash(np.where(valid, x, 0.0))
+    for j in range(len(self.columns)):
+      self.kmv[j] = np.unique(np.concatenate([self.kmv[j], h[valid[:, j], j]]))[:self.k]
+    for check, rows in _checks(x, self.columns, offset):
+      self.checks.setdefault(check, []).append(rows)
+    self.n_rows += len(x)
+    return self
+
+  def merge(self, other):
+    # combined sketch of self and other (same columns, alpha and k). out: new sketch
+    out = NumericSketch(self.columns, self.alpha, self.k)
+    out.n_rows = self.n_rows + other.n_rows
+    out.n = self.n + other.n
+    out.sum = self.sum + other.sum
+    out.min = np.fmin(self.min, other.min)
+    out.max = np.fmax(self.max, other.max)
+    out.finite_min = np.fmin(self.finite_min, other.finite_min)
+    out.finite_max = np.fmax(self.finite_max, other.finite_max)
+    out.buckets = self.buckets.add(other.buckets, fill_value=0).astype(np.int64)
+    out.kmv = [np.unique(np.concatenate([a, b]))[:self.k] for a, b in zip(self.kmv, other.kmv)]
+    for check in dict.fromkeys(list(self.checks) + list(other.checks)): # in the order of the checks
+      out.checks[check] = self.checks.get(check, []) + other.checks.get(check, [])
+    return out
+
+  def _values(self, keys):
+    # representative value of the buckets (the middle of the bucket, relative error <= alpha)
+    k = np.abs(keys) - self.offset
+    return np.where(keys==0, 0.0, np.sign(keys) * 2 * np.exp(k * self.log_gamma) / (1 + np.exp(self.log_gamma)))
+
+  def result(self, bins=n_bins, q=quantiles):
+    """
+    Same as profile (n_distinct and quantiles estimated, quantiles and histograms from the buckets
+    of the finite values, values of the columns with few distinct values not given)
+    """
+    c = len(self.columns)
+    has = self.n > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+      mean = np.where(has, self.sum / self.n, np.nan)
+    n_distinct = np.array([len(h) if len(h) < self.k else
+                           int(round((self.k - 1) / ((h[-1].astype(np.float64) + 1) / 2.0**64))) for h in self.kmv])
+    lo = np.where(has, self.min, np.nan)
+    hi = np.where(has, self.max, np.nan)
+    summary = {'n':self.n, 'n_missing':self.n_rows - self.n, 'n_distinct':n_distinct, 'min':lo, 'mean':mean, 'max':hi}
+    col = (self.buckets.index.to_numpy() + 2**31) // 2**32 # keys are within +-2**31
+    keys = self.buckets.index.to_numpy() - col * 2**32
+    finite = self.finite_min <= self.finite_max
+    f_lo = np.where(finite, self.finite_min, np.nan)
+    f_hi = np.where(finite, self.finite_max, np.nan)
+    vals = self._values(keys).clip(f_lo[col], f_hi[col]) if len(keys)>0 else np.array([])
+    cnts = self.buckets.to_numpy()
+    order = np.lexsort((vals, col))
+    col, vals, cnts = col[order], vals[order], cnts[order]
+    for p in q:
+      est = np.full(c, np.nan)
+      for j in np.flatnonzero(finite):
+        m = col==j
+        cum = np.cumsum(cnts[m])
+        est[j] = vals[m][np.searchsorted(cum, p * (cum[-1] - 1), side='right')]
+      summary[f'q{round(p * 100):02d}'] = est
+    summary = pd.DataFrame(summary, index=pd.Index(self.columns, name='column'))
+    # histograms of the bucket values weighted by the counts (the edges as profile)
+    _, edges = _histograms(np.empty((0, c)), f_lo, f_hi, bins)
+    hist = {}
+    for j in np.flatnonzero(finite):
+      m = col==j
+      hist[self.columns[j]] = (np.histogram(vals[m], bins=edges[j], weights=cnts[m])[0].astype(np.int64), edges[j])
+    checks = [(check, np.sort(np.concatenate(rows))) for check, rows in self.checks.items()]
+    return {'summary':summary, 'hist':hist, 'values':{}, 'violations':_violation_frame(checks)}
@@ -0,0 +1,165 @@
+# global index of the sample IDs of all the finalized manifests (all studies) to find
+# the sample_id of a new manifest already used by an earlier one
+# {name}.sqlite: exact lookup, (id, column, study, manifest_id) of every ID
+# {name}.keys.npy: sorted 64-bit hashes of the IDs, loaded in milliseconds (memory mapped).
+#   A new ID is looked up in the sqlite file only if its hash is in the array
+import glob
+import os
+import re
+import sqlite3
+import pandas as pd
+import numpy as np
+from manifest_utils import canonical_id
+from manifest_store import get_store, read_table
+
+# default of the app, can be set by the environment variable
+index_path = os.environ.get('GP2_SAMPLE_ID_INDEX', 'sample_id_index.sqlite')
+id_cols = ['sample_id', 'alternative_id1', 'alternative_id2']
+
+schema = """
+CREATE TABLE IF NOT EXISTS sample_key (
+  id TEXT NOT NULL,
+  col TEXT NOT NULL,
+  study TEXT NOT NULL,
+  manifest_id TEXT NOT NULL,
+  PRIMARY KEY (id, col, study, manifest_id));
+CREATE INDEX IF NOT EXISTS sample_key_manifest ON sample_key (study, manifest_id);
+"""
+
+
+def hash_ids(ids):
+  # 64-bit hashes of the canonical IDs (manifest_utils.canonical_id). out: uint64 array
+  return pd.util.hash_pandas_object(pd.Series(ids, dtype=object), index=False).to_numpy()
+
+
+class SampleIDIndex:
+  """
+  Membership test of IDs against all the IDs added so far:
+  sorted hashes (keys.npy) --> candidates --> exact lookup in sqlite (no false positives)
+  read_only: for the app (no writes, the connection can be shared by the threads)
+  """
+  def __init__(self, path=None, read_only=False):
+    self.path = index_path if path is None else path
+    self.keys_path = os.path.splitext(self.path)[0] + '.keys.npy'
+    if read_only:
+      self.con = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+    else:
+      self.con = sqlite3.connect(self.path, isolation_level=None, timeout=60)
+      self.con.executescript(schema)
+    self.keys = np.load(self.keys_path, mmap_mode='r') if os.path.exists(self.keys_path) \
+      else np.array([], dtype=np.uint64)
+
+  def close(self):
+    self.con.close()
+
+  def __len__(self):
+    return len(self.keys)
+
+  def _save_keys(self, keys):
+    tmp = f'{self.keys_path}.{os.getpid()}.tmp.npy'
+    np.save(tmp, keys)
+    os.replace(tmp, self.keys_path)
+    self.keys = np.load(self.keys_path, mmap_mode='r')
+
+  def add_keys(self, h):
+    """
+    Merges the hashes h to the hash array (one write of the array).
+    The array is reloaded first, so the keys added by other processes are kept
+    (call in a write transaction of the sqlite file, as add does)
+    """
+    keys = np.load(self.keys_path) if os.path.exists(self.keys_path) else np.array([], dtype=np.uint64)
+    h = np.setdiff1d(np.unique(np.asarray(h, dtype=np.uint64)), keys, assume_unique=True)
+    self._save_keys(np.insert(keys, np.searchsorted(keys, h), h).astype(np.uint64))
+
+  def add(self, df, study, manifest_id, columns=id_cols, save_keys=True):
+    """
+    Adds the IDs of a manifest (the columns of df in columns). If the manifest was
+    already added, its IDs are replaced.
+    study: study of all the rows or a column name of df
+    save_keys: False to add many manifests and then the returned hashes at once (add_keys)
+    out: hashes of the IDs
+    """
+    rows = []
+    for v in [v for v in columns if v in df.columns]:
+      ids = canonical_id(df[v])
+      ok = ids.notna().to_numpy()
+      studies = df[study][ok].astype('str') if study in df.columns else [study] * ok.sum()
+      rows += list(zip(ids[ok], [v] * ok.sum(), studies, [manifest_id] * ok.sum()))
+    h = hash_ids([r[0] for r in rows])
+    cur = self.con.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+      for s in set(r[2] for r in rows) or [study]:
+        cur.execute('DELETE FROM sample_key WHERE study=? AND manifest_id=?', (s, manifest_id))
+      cur.executemany('INSERT OR IGNORE INTO sample_key VALUES (?,?,?,?)', rows)
+      # hashes of the replaced IDs stay in the array (only candidates, see rebuild_keys)
+      if save_keys:
+        self.add_keys(h)
+      cur.execute('COMMIT')
+    except BaseException:
+      cur.execute('ROLLBACK')
+      raise
+    return h
+
+  def rebuild_keys(self):
+    # hash array of the IDs in the sqlite file (drops the hashes of the replaced manifests)
+    ids = [r[0] for r in self.con.execute('SELECT DISTINCT id FROM sample_key')]
+    self._save_keys(np.unique(hash_ids(ids)).astype(np.uint64))
+
+  def lookup(self, ids, chunk=900):
+    """
+    Exact matches of the IDs
+    out: DataFrame (id, col, study, manifest_id), one row per match
+    """
+    ids = pd.unique(canonical_id(ids).dropna().to_numpy(dtype=object))
+    if len(self.keys)>0 and len(ids)>0:
+      h = hash_ids(ids)
+      pos = np.searchsorted(self.keys, h).clip(max=len(self.keys) - 1)
+      ids = ids[self.keys[pos]==h]
+    else:
+      ids = ids[:0]
+    rows = []
+    for i in range(0, len(ids), chunk): # only the candidates, usually a few
+      part = ids[i:i + chunk].tolist()
+      rows += self.con.execute('SELECT id, col, study, manifest_id FROM sample_key WHERE id IN '
+                               f'({",".join("?" * len(part))})', part).fetchall()
+    return pd.DataFrame(rows, columns=['id', 'col', 'study', 'manifest_id'])
+
+  def collisions(self, df, columns=['sample_id'], manifest=None):
+    """
+    IDs of df (the columns in columns) used by the manifests in the index
+    manifest: (study, manifest_id) not counted as a collision (e.g. a redo of the manifest)
+    out: DataFrame (column, id, col, study, manifest_id), col: the column of the ID in the earlier manifest
+    """
+    out = []
+    for v in [v for v in columns if v in df.columns]:
+      hits = self.lookup(df[v])
+      if manifest is not None:
+        hits = hits[(hits.study!=manifest[0]) | (hits.manifest_id!=manifest[1])]
+      out.append(hits.assign(column=v))
+    if len(out)==0:
+      return pd.DataFrame(columns=['column', 'id', 'col', 'study', 'manifest_id'])
+    return pd.concat(out, ignore_index=True)[['column', 'id', 'col', 'study', 'manifest_id']]
+
+
+def build_index(path=None, finalized_dir=None, qced_files=[], store=None, columns=id_cols):
+  """
+  One time import of the existing manifests to a sample ID index.
+  All the {study_code}_sample_manifest_qced_m{n} csv/parquet files in finalized_dir
+  (default: the finalized folder of the store, see manifest_store) are loaded.
+  Not yet finalized manifests can be added as a list of paths (qced_files).
+  Manifests assigned later are added by giveGP2ID (sample_index)
+  """
+  index = SampleIDIndex(path)
+  keys = []
+  if finalized_dir is None:
+    finalized_dir = get_store(store).folder('finalized')
+  files = sorted(glob.glob(os.path.join(finalized_dir, '*_sample_manifest_qced_m*.csv')) +
+                 glob.glob(os.path.join(finalized_dir, '*_sample_manifest_qced_m*.parquet'))) + list(qced_files)
+  for f in files:
+    mid = re.search(r'_sample_manifest_qced_(m\d+)\.(csv|parquet)$', f).group(1)
+    df = read_table(f, ['study'] + columns)
+    keys.append(index.add(df, 'study', mid, columns, save_keys=False))
+    print(f'{os.path.basename(f)}: nrow = {df.shape[0]}')
+  index.add_keys(np.concatenate(keys) if len(keys)>0 else []) # the hash array is written once
+  return index
@@ -0,0 +1,81 @@
+# creating mock sample manifests (python version of sample_manifest.R)
+import math
+import pandas as pd
+import numpy as np
+
+full_plate_pos = [f'{r}{c}' for c in range(1, 13) for r in 'ABCDEFGH']
+
+
+def make_manifest(nr=500, n_studies=1, n_plates=None, dup_rate=0.01, missing_rate=0.25,
+                  qced=False, seed=1):
+  """
+  Mock sample manifest with the template columns
+  nr: N of samples
+  n_studies: N of studies (PDSTUDY1, PDSTUDY2, ...; PDSTUDY if 1)
+  n_plates: samples are spread over n_plates plates (default: filled up to 96 per plate)
+  dup_rate: fraction of samples from a participant who already has a sample (same clinical_id)
+  missing_rate: fraction of missing values in race, age_of_onset, family_history and region
+  qced: if True, the values are in the controlled vocabularies and the columns added by the app
+    (Phenotype, Genotyping_site, Sample_submitter, original_manifest) are included,
+    i.e. the input of checkSampleManifest
+  """
+  rng = np.random.default_rng(seed)
+  if n_plates is None:
+    n_plates = math.ceil(nr / 96)
+  def with_missing(x):
+    return pd.Series(x).where(rng.random(nr) >= missing_rate)
+
+  # participants; dup_rate of the samples are from an earlier participant
+  uid = np.arange(nr)
+  is_dup = rng.random(nr) < dup_rate
+  is_dup[0] = False
+  uid[is_dup] = (rng.random(is_dup.sum()) * np.flatnonzero(is_dup)).astype(int)
+  while (uid[uid] != uid).any(): # the earlier sample may be a duplicate itself
+    uid = uid[uid]
+
+  plate_no = np.arange(nr) * n_plates // nr + 1
+  plate_pos = np.arange(nr) - np.searchsorted(plate_no, plate_no)
+  age = rng.normal(68, 5, nr)
+  df = pd.DataFrame({
+    'study': [f'PDSTUDY{i+1}' for i in np.arange(nr) * n_studies // nr] if n_studies>1 else 'PDSTUDY',
+    'sample_id': [f'sample_no_{i+1}' for i in range(nr)],
+    'sample_type': 'DNA',
+    'DNA_volume': rng.normal(40, 5, nr),
+    'DNA_conc': rng.uniform(0.5, 1.3, nr),
+    'r260_280': rng.uniform(1.3, 2.1, nr),
+    'Plate_name': [f'P{i}' for i in plate_no],
+    'Plate_position': np.array(full_plate_pos * math.ceil(nr / 96 + 1))[plate_pos % 96],
+    'clinical_id': [f'MED{i+1}' for i in uid],
+    'study_arm': rng.choice(['Disease', 'Healthy'], nr),
+    'sex': rng.choice([1, 2], nr),
+    'race': with_missing(rng.choice([1, 2, 3], nr)),
+    'age': age,
+    'age_of_onset': with_missing(age - rng.uniform(2, 15, nr)),
+    'age_at_diagnosis': age - rng.uniform(0.2, 8, nr),
+    'age_at_death': np.nan,
+    'family_history': with_missing(rng.choice(['N', 'Y', 'U'], nr)),
+    'region': with_missing(rng.choice(['US', 'Japan', 'Canada'], nr)),
+    'comment': np.nan,
+    'alternative_id1': np.nan,
+    'alternative_id2': np.nan})
+
+  if qced:
+    df['Phenotype'] = df.study_arm.map({'Disease':'PD', 'Healthy':'Control'})
+    df['sex'] = df.sex.map({1:'Male', 2:'Female'})
+    df['race'] = df.race.map({1:'White', 2:'Asian', 3:'Black or African American'}).fillna('Not Reported')
+    df['family_history'] = df.family_history.map({'N':'No', 'Y':'Yes', 'U':'Unknown'}).fillna('Not Reported')
+    df['region'] = df.region.map({'US':'USA', 'Japan':'JPN', 'Canada':'CAN'}).fillna('Not Reported')
+    df['Genotyping_site'] = 'NIH'
+    df['Sample_submitter'] = 'H. Morris'
+    df['original_manifest'] = 'PDSTUDY_sample_manifest.csv'
+  return df
+
+
+def split_manifests(df, n_manifests=3):
+  # splits a manifest into n_manifests consecutive manifests (m1, m2, ...) as a dict
+  bounds = np.linspace(0, len(df), n_manifests + 1).astype(int)
+  return {f'm{i+1}': df.iloc[bounds[i]:bounds[i+1]].reset_index(drop=True) for i in range(n_manifests)}
+
+
+if __name__ == '__main__':
+  make_manifest().to_csv('PDSTUDY_sample_manifest_mock.csv', index=False)
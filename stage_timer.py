@@ -0,0 +1,78 @@
+# opt-in timing and memory instrumentation of the QC stages
+import contextlib
+import datetime as dt
+import json
+import time
+import tracemalloc
+import pandas as pd
+
+
+class StageTimer:
+  """
+  Records wall time, CPU time and peak allocation (tracemalloc, if memory=True) of named stages.
+  Each lap(stage) records the stage since the previous lap (or reset).
+    with StageTimer(memory=True, log_path='qc_stages.jsonl') as timer:
+      checkSampleManifest(data, timer=timer)
+    timer.report()
+  log_path: if given, each stage is also appended there as a JSON line (with **context)
+  Peak allocation only covers python/numpy allocations and slows down the code while tracing.
+  """
+  def __init__(self, memory=False, log_path=None, enabled=True, **context):
+    self.enabled = enabled
+    self.memory = memory and enabled
+    self.log_path = log_path
+    self.context = context
+    self.records = []
+    self._own_tracing = False
+    if self.memory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+      self._own_tracing = True
+    self.reset()
+
+  def reset(self):
+    # start a new stage without recording the time since the previous lap
+    if not self.enabled:
+      return
+    self._wall = time.perf_counter()
+    self._cpu = time.process_time()
+    if self.memory:
+      tracemalloc.reset_peak()
+
+  def lap(self, stage):
+    if not self.enabled:
+      return
+    rec = {'stage': stage,
+           'wall_sec': round(time.perf_counter() - self._wall, 6),
+           'cpu_sec': round(time.process_time() - self._cpu, 6)}
+    if self.memory:
+      rec['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 3)
+    self.records.append(rec)
+    if self.log_path is not None:
+      with open(self.log_path, 'a') as f:
+        f.write(json.dumps({'time': dt.datetime.now().isoformat(timespec='seconds'), **self.context, **rec}) + '\n')
+    self.reset()
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    self.reset()
+    yield
+    self.lap(name)
+
+  def report(self):
+    # DataFrame of the recorded stages
+    return pd.DataFrame(self.records, columns=['stage', 'wall_sec', 'cpu_sec'] + (['peak_mb'] if self.memory else []))
+
+  def close(self):
+    if self._own_tracing:
+      tracemalloc.stop()
+      self._own_tracing = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+# used when no timer is given (does nothing)
+null_timer = StageTimer(enabled=False)
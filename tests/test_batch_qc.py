@@ -0,0 +1,35 @@
+import json
+import os
+from batch_qc import run_batch
+from manifest_store import ManifestStore
+from sample_manifest import make_manifest
+
+
+def test_assignment_in_summary(tmp_path):
+  path = str(tmp_path / 'PDSTUDY_sample_manifest_m1.csv')
+  make_manifest(200, 1, qced=True).to_csv(path, index=False)
+  store = ManifestStore(str(tmp_path / 'repo'))
+  for sub in ['qced', 'finalized']:
+    os.makedirs(store.folder(sub))
+
+  ok = run_batch([path], str(tmp_path / 'ok'), 1, assign=True, store=store, dup_not_allowed=False)
+  assert ok.status[0] == 'PASS' and ok.gp2id_status[0] == 'OK'
+  assert ok.n_GP2ID_assigned[0] == 200
+
+  failed = run_batch([path], str(tmp_path / 'failed'), 1, assign=True, store=store, dup_not_allowed=False,
+                     registry=str(tmp_path / 'missing' / 'registry.sqlite'))
+  assert failed.gp2id_status[0] == 'FAIL'
+  assert failed.error[0].startswith('GP2ID PDSTUDY_m1:')
+
+
+def test_issues_from_checkSampleManifest(tmp_path):
+  # rows of the issues are positions in the file (also after the removed entries)
+  x = make_manifest(50, 1, qced=True)
+  x.loc[3, 'sample_id'] = None
+  x.loc[10, 'clinical_id'] = None
+  path = str(tmp_path / 'PDSTUDY_sample_manifest_m1.csv')
+  x.to_csv(path, index=False)
+  run_batch([path], str(tmp_path / 'out'), 1)
+  with open(tmp_path / 'out' / 'PDSTUDY_sample_manifest_m1.csv.json') as f:
+    issues = json.load(f)['issues']
+  assert [v['rows'] for v in issues if v['column']=='clinical_id' and v['kind']=='missing'] == [[10]]
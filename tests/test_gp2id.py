@@ -0,0 +1,90 @@
+import contextlib
+import io
+import os
+import pandas as pd
+import pytest
+from manifest_store import ManifestStore
+from manifest_func2 import checkSampleManifest, giveGP2ID
+from sample_manifest import make_manifest, split_manifests
+from benchmark import hammer, _redo_content
+from gp2id_registry import GP2IDRegistry
+
+
+@pytest.fixture(scope='module')
+def manifests():
+  with contextlib.redirect_stdout(io.StringIO()):
+    x = checkSampleManifest(make_manifest(400, 1, qced=True), dup_not_allowed=False)
+  return split_manifests(x.sample(frac=1, random_state=2).reset_index(drop=True), 4)
+
+
+def run(tmp_path, steps, registry):
+  # giveGP2ID of the steps [(manifest_id, data), ...] in order --> the qced file after each step
+  store = ManifestStore(str(tmp_path))
+  for sub in ['qced', 'finalized']:
+    os.makedirs(store.folder(sub), exist_ok=True)
+  reg = str(tmp_path / 'registry.sqlite') if registry else None
+  out = []
+  for mid, x in steps:
+    with contextlib.redirect_stdout(io.StringIO()):
+      giveGP2ID(x, mid, [f'm{i}' for i in range(1, 10)], reg, store=store)
+    out.append(store.read('qced', f'PDSTUDY_sample_manifest_qced_{mid}'))
+  return out, pd.concat([store.read('qced', v) for v in store.list('qced')], ignore_index=True)
+
+
+def check_ids(out):
+  # one GP2ID per clinical_id, one clinical_id per GP2ID, no GP2sampleID twice
+  out = out.assign(clinical_id=out.clinical_id.astype(str))
+  assert (out.groupby('clinical_id').GP2ID.nunique() == 1).all()
+  assert (out.groupby('GP2ID').clinical_id.nunique() == 1).all()
+  assert not out.GP2sampleID.duplicated().any()
+
+
+def test_registry_and_files_agree(tmp_path, manifests):
+  m = manifests
+  steps = [('m1', m['m1']), ('m2', m['m2']), ('m3', m['m3']), ('m4', m['m4']),
+           ('m2', _redo_content(m, 'm2', 5)), ('m3', m['m3']), ('m2', m['m2']), ('m1', _redo_content(m, 'm1', 7))]
+  files, files_all = run(tmp_path / 'files', steps, registry=False)
+  reg, reg_all = run(tmp_path / 'registry', steps, registry=True)
+  cols = ['sample_id', 'GP2ID', 'GP2sampleID']
+  for a, b in zip(files, reg):
+    pd.testing.assert_frame_equal(a[cols], b[cols])
+  check_ids(files_all)
+  check_ids(reg_all)
+
+
+def test_redo_keeps_gp2id(tmp_path, manifests):
+  m = manifests
+  out, _ = run(tmp_path, [('m1', m['m1']), ('m2', m['m2']), ('m3', m['m3']), ('m2', m['m2'])], registry=False)
+  assert (out[1].GP2ID == out[3].GP2ID).all()
+
+
+def test_redo_after_later_manifest(tmp_path, manifests):
+  # a new sample of a participant of m3 added to m2 after m3 got its GP2IDs
+  m = manifests
+  extra = m['m3'].iloc[:3].assign(sample_id=['extra1', 'extra2', 'extra3'])
+  out, out_all = run(tmp_path, [('m1', m['m1']), ('m2', m['m2']), ('m3', m['m3']),
+                                ('m2', pd.concat([m['m2'], extra], ignore_index=True))], registry=False)
+  assert (out[3].GP2ID.iloc[-3:].to_numpy() == out[2].GP2ID.iloc[:3].to_numpy()).all()
+  check_ids(out_all)
+
+
+@pytest.mark.parametrize('registry', [False, True])
+def test_concurrent_assignment(registry):
+  res = hammer(n_procs=4, n_manifests=5, n_redo=6, nr=400, registry=registry, locked=True)
+  assert res['errors'] == []
+  assert res['GP2ID_reused'] == 0
+  assert res['clinical_id_split'] == 0
+  assert res['GP2sampleID_dup'] == 0
+
+
+def test_registry_next_uid_not_lowered(tmp_path):
+  reg = GP2IDRegistry(str(tmp_path / 'registry.sqlite'))
+  uid, rep = reg.assign('PD', 'm1', ['c1', 'c2', 'c3', 'c3'])
+  assert uid.tolist()==[1, 2, 3, 3] and rep.tolist()==[1, 1, 1, 2]
+  # a corrected history maps c3 to an earlier GP2ID: uid 3 was given already and is not given again
+  reg.import_history(pd.DataFrame({'study':'PD', 'clinical_id':['c3'], 'GP2ID':['PD_000002'],
+                                   'GP2sampleID':['PD_000002_s5'], 'manifest_id':'m0'}))
+  uid, rep = reg.assign('PD', 'm2', ['c4', 'c2'])
+  assert uid.tolist()==[4, 2] and rep.tolist()==[1, 6] # replicate numbers from the samples
+  assert 'replicate' not in [r[0] for r in reg.con.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+  reg.close()
@@ -0,0 +1,117 @@
+import io
+import numpy as np
+import pandas as pd
+import pytest
+from manifest_rules import read_manifest, validate, validate_csv, validate_incremental, upload_rules, qc_rules
+from manifest_utils import check_plate_wells, check_plate_wells_incremental, hash_rows
+from sample_manifest import make_manifest
+
+
+@pytest.fixture(scope='module')
+def manifest():
+  x = make_manifest(2000, 1)
+  x['Genotyping_site'] = 'Fulgent'
+  x['Phenotype'] = 'PD'
+  x['Sample_submitter'] = 'lab'
+  x['original_manifest'] = 'm1'
+  x.loc[[3, 50], 'sex'] = np.nan
+  x.loc[7, 'sample_type'] = 'Hair'
+  x.loc[9, 'sample_id'] = x.sample_id[8]
+  x['age'] = x.age.astype(object)
+  x.loc[11, 'age'] = 'old'
+  x.loc[12, 'Plate_position'] = 'Z99'
+  x.loc[13, 'Plate_position'] = x.Plate_position[14]
+  x.loc[13, 'Plate_name'] = x.Plate_name[14]
+  return read_manifest(io.BytesIO(x.to_csv(index=False).encode()))
+
+
+def edit(df):
+  # a corrected/changed version: rows fixed, removed, inserted and changed
+  x = df.copy()
+  x.loc[3, 'sex'] = x.sex[4]
+  x.loc[20, 'sample_type'] = 'Hair'
+  x.loc[30, 'Plate_position'] = x.Plate_position[31]
+  x = pd.concat([x.iloc[:100], x.iloc[[5, 6]].assign(sample_id=['new1', 'new2']), x.iloc[150:]], ignore_index=True)
+  return x
+
+
+def assert_issues_equal(a, b):
+  assert list(a.column) == list(b.column) and list(a.kind) == list(b.kind)
+  assert list(a.n) == list(b.n)
+  for x, y in zip(a.rows, b.rows):
+    assert np.array_equal(np.sort(x), np.sort(y))
+  for x, y in zip(a['values'], b['values']):
+    assert set(map(str, x)) == set(map(str, y))
+
+
+def assert_wells_equal(a, b):
+  for k in ['n_samples', 'over_capacity', 'duplicated', 'out_of_range']:
+    table = lambda x: pd.DataFrame(x).reset_index().astype(str).to_numpy().tolist() # text or categorical
+    assert table(a[k])==table(b[k])
+  assert np.array_equal(a['occupancy'], b['occupancy'])
+
+
+@pytest.mark.parametrize('rules', [upload_rules, qc_rules], ids=['upload', 'qc'])
+def test_validate_csv(tmp_path, manifest, rules):
+  path = tmp_path / 'm.csv'
+  manifest.to_csv(path, index=False)
+  df = read_manifest(str(path))
+  out = validate_csv(str(path), rules, chunksize=300) # duplicates across the chunks
+  assert out['n_rows']==len(df)
+  assert_issues_equal(out['issues'], validate(df, rules))
+  assert_wells_equal(out['wells'], check_plate_wells(df.Plate_name, df.Plate_position))
+
+
+@pytest.mark.parametrize('rules', [upload_rules, qc_rules], ids=['upload', 'qc'])
+def test_validate_incremental(manifest, rules):
+  issues, state, changed = validate_incremental(manifest.drop(columns='sex'), rules)
+  assert state is None and changed.all()
+  assert_issues_equal(issues, validate(manifest.drop(columns='sex'), rules))
+  issues, state, changed = validate_incremental(manifest, rules, None, hash_rows(manifest))
+  assert changed.all()
+  assert_issues_equal(issues, validate(manifest, rules))
+  x = edit(manifest)
+  issues, state, changed = validate_incremental(x, rules, state, hash_rows(x))
+  assert_issues_equal(issues, validate(x, rules))
+  assert changed.sum() == 5 # 3 changed and 2 inserted rows
+
+
+def test_check_plate_wells_incremental(manifest):
+  wells, state = check_plate_wells_incremental(manifest.Plate_name, manifest.Plate_position, hash_rows(manifest))
+  assert_wells_equal(wells, check_plate_wells(manifest.Plate_name, manifest.Plate_position))
+  x = edit(manifest)
+  wells, state = check_plate_wells_incremental(x.Plate_name, x.Plate_position, hash_rows(x), state)
+  assert_wells_equal(wells, check_plate_wells(x.Plate_name, x.Plate_position))
+
+
+def test_hash_rows():
+  x = pd.DataFrame({'a':['x', None, '', 'é', 'x'], 'b':[1.0, 2.0, np.nan, 1.0, 1.0],
+                    'c':pd.Categorical(['u', 'v', None, 'u', 'u'])})
+  h = hash_rows(x)
+  assert h[0] == h[4] and len(set(h[:4])) == 4
+
+
+def test_read_manifest_dtypes(tmp_path):
+  text = ('study,sample_id,sample_type,clinical_id,sex,Plate_name,Plate_position,age,DNA_conc,comment\n'
+          'S1,0012,DNA,007,Male,P1,A1,50,1.5,\n'
+          'S1,0013,Blood,008,Female,P1,A2,61,x,ok\n'
+          'S1,0014,DNA,,,P2,A1,,2,\n')
+  path = tmp_path / 'm.csv'
+  path.write_text(text)
+  df = read_manifest(str(path))
+  for v in ['study', 'sample_type', 'sex', 'Plate_name']:
+    assert isinstance(df[v].dtype, pd.CategoricalDtype), v
+  assert df.sex.cat.categories.tolist()==['Female', 'Male'] and df.sex.isna().sum()==1
+  # IDs as text (leading zeros kept), numbers as float64, text in a numeric column kept as read
+  assert df.sample_id.tolist()==['0012', '0013', '0014'] and df.clinical_id[0]=='007' and pd.isna(df.clinical_id[2])
+  assert pd.api.types.is_string_dtype(df.Plate_position.dtype) and not isinstance(df.Plate_position.dtype, pd.CategoricalDtype)
+  assert df.age.dtype=='float64' and not pd.api.types.is_numeric_dtype(df.DNA_conc.dtype)
+  # the vocab rules run on the categories
+  issues = validate(df, [r for r in upload_rules if r['kind']=='vocab'])
+  assert len(issues)==0
+  assert read_manifest(str(path), usecols=['sample_id', 'sex', 'x']).columns.tolist()==['sample_id', 'sex']
+  # xlsx: the same dtypes
+  x = df.copy()
+  x.to_excel(tmp_path / 'm.xlsx', index=False)
+  xl = read_manifest(str(tmp_path / 'm.xlsx'), excel=True)
+  assert (xl.dtypes.astype(str)==df.dtypes.astype(str)).all()
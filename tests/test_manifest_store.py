@@ -0,0 +1,145 @@
+import io
+import os
+import threading
+import time
+import pandas as pd
+import pytest
+import manifest_store
+from manifest_store import ManifestStore, table_bytes
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+  monkeypatch.setattr(manifest_store, 'lock_heartbeat', 0.05)
+  monkeypatch.setattr(manifest_store, 'lock_stale', 0.5)
+  return ManifestStore(str(tmp_path))
+
+
+def hold(store, name, sec, holders, log):
+  with store.lock(name, timeout=30):
+    holders.append(1)
+    log.append(len(holders))
+    time.sleep(sec)
+    holders.pop()
+
+
+def test_lock_heartbeat(store):
+  # held longer than lock_stale: the refreshed lock is not taken over
+  holders, log = [], []
+  threads = [threading.Thread(target=hold, args=(store, 'x', sec, holders, log)) for sec in [1.5, 0.1]]
+  threads[0].start()
+  time.sleep(0.2)
+  threads[1].start()
+  for t in threads:
+    t.join()
+  assert log==[1, 1]
+  assert os.listdir(os.path.join(store.root, '.locks'))==[]
+
+
+def test_stale_lock_taken_over_once(store):
+  path = os.path.join(store.root, '.locks', 'x.lock')
+  os.makedirs(os.path.dirname(path))
+  with open(path, 'w') as f:
+    f.write('crashed\n')
+  os.utime(path, (time.time() - 10, time.time() - 10))
+  holders, log = [], []
+  threads = [threading.Thread(target=hold, args=(store, 'x', 0.05, holders, log)) for _ in range(8)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert log==[1] * 8
+  assert os.listdir(os.path.dirname(path))==[]
+
+
+class SlowStore(ManifestStore):
+  # local directory with injected latency (as benchmark.RemoteStore): the earlier files are the slower ones
+  def __init__(self, root, **kw):
+    super().__init__(root, 'csv', **kw)
+    self.reads, self.copies = [], []
+
+  def _read_file(self, path, columns=None):
+    self.reads.append(path)
+    time.sleep(0.3 - 0.05 * int(os.path.basename(path)[1]))
+    return super()._read_file(path, columns)
+
+  def _copy_file(self, src, dst):
+    self.copies.append(src)
+    time.sleep(0.05)
+    super()._copy_file(src, dst)
+
+
+def write_files(root, n=5):
+  store = ManifestStore(str(root), 'csv')
+  os.makedirs(store.folder('finalized'))
+  for i in range(n):
+    store.write(pd.DataFrame({'sample_id':[f's{i}_{k}' for k in range(3)], 'n':i}), 'finalized', f'm{i}')
+  return [('finalized', f'm{i}') for i in range(n)]
+
+
+def test_read_many_order(tmp_path):
+  items = write_files(tmp_path)
+  store = SlowStore(str(tmp_path), max_workers=5)
+  t0 = time.monotonic()
+  out = store.read_many(items)
+  assert time.monotonic() - t0 < 0.8 # in parallel (one by one: 1 sec)
+  assert [x.n[0] for x in out]==list(range(5)) # in the order of items, not of completion
+  assert [x.columns.tolist() for x in store.read_many(items, ['sample_id'])]==[['sample_id']] * 5
+
+
+def test_cached_copies_once(tmp_path):
+  items = write_files(tmp_path / 'root', 2)
+  store = SlowStore(str(tmp_path / 'root'), cache_dir=str(tmp_path / 'cache'))
+  first = store.read_many(items)
+  assert len(store.copies)==2 and store.reads==[]
+  again = store.read_many(items)
+  assert len(store.copies)==2 # mtime and size unchanged: the copies are used
+  for a, b in zip(first, again):
+    pd.testing.assert_frame_equal(a, b)
+  # the file changes (size and mtime): copied again
+  path = store.find('finalized', 'm1')
+  store.write(pd.DataFrame({'sample_id':['new'], 'n':[9]}), 'finalized', 'm1')
+  st = os.stat(path)
+  os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+  assert store.read('finalized', 'm1').n.tolist()==[9] and len(store.copies)==3
+  # same size, other mtime: copied again
+  st = os.stat(path)
+  os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+  store.read('finalized', 'm1')
+  assert store.copies[-1]==path and len(store.copies)==4
+
+
+def frame():
+  return pd.DataFrame({'sample_id':['s1', 's2', None], 'age':[50.5, None, 61.0], 'n':[1, 2, 3],
+                       'race':[1, 'White', None]}) # mixed types: saved as text in parquet
+
+
+def test_parquet_round_trip(tmp_path):
+  store = ManifestStore(str(tmp_path), 'parquet')
+  os.makedirs(store.folder('qced'))
+  df = frame()
+  assert store.write(df, 'qced', 'm1').endswith('m1.parquet')
+  out = store.read('qced', 'm1')
+  pd.testing.assert_frame_equal(out.drop(columns='race'), df.drop(columns='race'), check_dtype=False)
+  assert out.race.tolist()[:2]==['1', 'White'] and pd.isna(out.race[2])
+  # columns not in the file are ignored
+  assert store.read('qced', 'm1', ['n', 'GP2ID', 'sample_id']).columns.tolist()==['sample_id', 'n']
+  # a csv file is read if there is no parquet file (files from before switching to parquet), and the other way round
+  ManifestStore(str(tmp_path), 'csv').write(df, 'qced', 'm0')
+  assert store.find('qced', 'm0').endswith('m0.csv') and store.read('qced', 'm0', ['n', 'x']).columns.tolist()==['n']
+  assert ManifestStore(str(tmp_path), 'csv').read('qced', 'm1').shape==df.shape
+  assert sorted(store.list('qced'))==['m0', 'm1']
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'csv.gz', 'parquet'])
+def test_table_bytes(fmt):
+  df = frame().drop(columns='race')
+  b = table_bytes(df, fmt)
+  read = {'csv':pd.read_csv, 'csv.gz':lambda f: pd.read_csv(f, compression='gzip'), 'parquet':pd.read_parquet}[fmt]
+  pd.testing.assert_frame_equal(read(io.BytesIO(b)), df, check_dtype=False)
+  assert table_bytes(df, fmt)==b # the same bytes each time (no gzip timestamp)
+
+
+def test_table_bytes_format():
+  with pytest.raises(ValueError):
+    table_bytes(frame(), 'xlsx')
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+from manifest_utils import canonical_id, hash_column, format_gp2id, format_gp2sampleid, parse_gp2id
+from manifest_utils import crosstab, check_plate_wells
+from manifest_func2 import fingerprint_diff
+
+
+def test_canonical_id():
+  x = pd.Series([' 3011 ', '3011.0', '+7', '0123', '3.50', '1e3', 'PD-1', '', None,
+                 '12345678901234567890', str(2**53 + 1)], dtype=object)
+  assert canonical_id(x).tolist()==['3011', '3011', '7', '123', '3.50', '1e3', 'PD-1', '', pd.NA,
+                                    '12345678901234567890', str(2**53 + 1)]
+  # numbers: integers exact, whole floats within 2**53 as integers
+  assert canonical_id(pd.Series([3011, 2**60 + 1])).tolist()==['3011', str(2**60 + 1)]
+  assert canonical_id(pd.Series([3011.0, np.nan, 2.5])).tolist()==['3011', pd.NA, '2.5']
+  assert canonical_id(pd.Series([3011, 'x', 3011.0, 2**60 + 1], dtype=object)).tolist()==['3011', 'x', '3011', str(2**60 + 1)]
+  assert canonical_id(pd.Series([1, None], dtype='Int64')).tolist()==['1', pd.NA]
+  assert str(canonical_id(x).dtype)=='string'
+
+
+def test_fingerprint_diff_large_ids():
+  ref = pd.DataFrame({'study':'PD', 'GP2sampleID':['PD_000001_s1', 'PD_000002_s1', 'PD_000003_s1'],
+                      'clinical_id':['12345678901234567890', 2**53, 3011]})
+  target = ref.assign(clinical_id=['12345678901234567891', 2**53 + 1, '3011.0'])
+  diff = fingerprint_diff(target, ref, ['GP2sampleID', 'clinical_id'])
+  assert list(diff.index)==['PD_000001_s1', 'PD_000002_s1'] and (diff.status=='changed').all()
+  assert diff.clinical_id_changed.all() and not diff.GP2sampleID_changed.any()
+  assert (hash_column(['3011', 3011, 3011.0, None, np.nan])[:3]==hash_column(['3011'])[0]).all()
+
+
+def test_format_gp2id():
+  idx, rep = [0, 3, 12, 999999], [1, 2, 10, 1]
+  for study in ['PD', 'PDé', 'ÄB-1', 7]:
+    assert format_gp2id(study, idx).tolist()==[f'{study}_{i:06}' for i in idx]
+    assert format_gp2sampleid(study, idx, rep).tolist()==[f'{study}_{i:06}_s{r}' for i, r in zip(idx, rep)]
+  assert format_gp2id('PD', [1234567, -1]).tolist()==['PD_1234567', 'PD_-00001']
+
+
+def test_parse_gp2id():
+  ids = ['PD_000012', 'PD_000012_s2', 'PD_12a3', 'PD_12_', 'PD12', '', None, 'A_x_y5', 'PD_s', 'PD_ 7',
+         'PD_000012_s', 'PD__3', 'PD_3 ', 'PD_000012_s10']
+  regex = pd.Series(ids, dtype=object).fillna('').str.extract(r'_\D*(\d+)$')[0]
+  expected = pd.to_numeric(regex).fillna(-1).astype(np.int64).tolist()
+  assert parse_gp2id(ids).tolist()==expected
+  assert parse_gp2id(ids + ['PDé_000004']).tolist()==expected + [4] # non-ascii: the regex
+
+
+def test_crosstab_as_pivot_table():
+  rng = np.random.default_rng(1)
+  n = 300
+  df = pd.DataFrame({'a':rng.choice(['x', 'y', 'z', None], n), 'b':rng.choice(['p', 'q', None], n),
+                     'v':rng.choice(['s1', None, 's3'], n)}).astype(object)
+  pivot = lambda x, **kw: x.pivot_table(index='a', columns='b', values='v', aggfunc='count', fill_value=0, **kw)
+  pd.testing.assert_frame_equal(crosstab(df.a, df.b, df.v), pivot(df, margins=True), check_dtype=False)
+  pd.testing.assert_frame_equal(crosstab(df.a, df.b, df.v, margins=False), pivot(df), check_dtype=False)
+  pd.testing.assert_frame_equal(crosstab(df.a, df.b, df.v, index_na='NA'), pivot(df.fillna({'a':'NA'}), margins=True),
+                                check_dtype=False)
+  # categoricals (with unused categories) by their codes: the same table
+  cat = df.astype({'a':pd.CategoricalDtype(['z', 'y', 'x', 'w']), 'b':'category'})
+  pd.testing.assert_frame_equal(crosstab(cat.a, cat.b, cat.v), crosstab(df.a, df.b, df.v), check_index_type=False,
+                                check_column_type=False)
+
+
+def test_check_plate_wells():
+  name = pd.Series(['P1', 'P1', 'P1', 'P1', 'P1', None, 'P2', 'P2'], index=range(10, 18))
+  pos = pd.Series(['A1', 'a01 ', None, np.nan, 'I1', 'A1', 'H12', 'B13'], index=name.index)
+  out = check_plate_wells(name, pos)
+  assert out['n_samples'].to_dict()=={'P1':5, 'P2':2}
+  # A1 and A01 are the same well; missing positions are neither duplicated nor out of range
+  assert out['duplicated'].values.tolist()==[['P1', 'A1', 2]]
+  assert out['out_of_range'].Plate_position.to_dict()=={14:'I1', 17:'B13'}
+  assert out['occupancy'].shape==(2, 8, 12) and out['occupancy'][1, 7, 11]==1 and out['occupancy'].sum()==3
+  assert len(out['over_capacity'])==0
+  big = check_plate_wells(['P1'] * 97, [f'{r}{c}' for r in 'ABCDEFGH' for c in range(1, 13)] + ['A1'])
+  assert big['over_capacity'].to_dict()=={'P1':97}
+  wide = check_plate_wells(['P1', 'P1'], ['P24', 'Q1'], n_wells=384)
+  assert wide['occupancy'].shape==(1, 16, 24) and wide['out_of_range'].Plate_position.tolist()==['Q1']
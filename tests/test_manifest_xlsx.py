@@ -0,0 +1,42 @@
+import datetime as dt
+import re
+import zipfile
+import openpyxl
+import pandas as pd
+from manifest_xlsx import read_xlsx
+
+
+def test_iso_date_cells(tmp_path):
+  # t="d" cells (ISO 8601) as pd.read_excel gives them
+  path = str(tmp_path / 'm.xlsx')
+  wb = openpyxl.Workbook(iso_dates=True)
+  ws = wb.active
+  ws.append(['sample_id', 'date', 'time', 'age'])
+  ws.append(['s1', dt.datetime(2021, 3, 4, 5, 6, 7), dt.time(1, 2, 3), 50])
+  ws.append(['s2', dt.date(2020, 1, 2), None, 61.5])
+  wb.save(path)
+  pd.testing.assert_frame_equal(read_xlsx(path), pd.read_excel(path, engine='openpyxl'))
+  pd.testing.assert_frame_equal(read_xlsx(path, ['sample_id', 'date']),
+                                pd.read_excel(path, engine='openpyxl', usecols=['sample_id', 'date']))
+
+
+def test_formula_without_cached_value(tmp_path):
+  # <c><f>...</f><v/></c> as written by a workbook saved without recalculation: missing as pd.read_excel
+  path = str(tmp_path / 'm.xlsx')
+  wb = openpyxl.Workbook()
+  ws = wb.active
+  ws.append(['sample_id', 'age', 'n'])
+  ws.append(['s1', 50, 1])
+  ws.append(['s2', None, 2])
+  wb.save(path)
+  with zipfile.ZipFile(path) as z:
+    files = {v:z.read(v) for v in z.namelist()}
+  sheet = files['xl/worksheets/sheet1.xml'].decode()
+  cell = re.search(r'<c r="B2"[^>]*>.*?</c>', sheet).group(0)
+  files['xl/worksheets/sheet1.xml'] = sheet.replace(cell, '<c r="B2"><f>C2*50</f><v></v></c>').encode()
+  with zipfile.ZipFile(path, 'w') as z:
+    for v, b in files.items():
+      z.writestr(v, b)
+  out = read_xlsx(path)
+  pd.testing.assert_frame_equal(out, pd.read_excel(path, engine='openpyxl'))
+  assert out.age.isna().all()
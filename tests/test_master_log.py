@@ -0,0 +1,64 @@
+import contextlib
+import io
+import pandas as pd
+import pytest
+from manifest_store import ManifestStore
+from manifest_func2 import compare_consistency
+from master_log import MasterSheetLog
+
+
+def sheet(n, start=0):
+  i = range(start, start + n)
+  return pd.DataFrame({'GP2sampleID':[f'PD-{k:06d}_s1' for k in i], 'GP2ID':[f'PD-{k:06d}' for k in i],
+                       'study':'PDSTUDY', 'clinical_id':[f'c{k}' for k in i], 'sample_id':[f's{k}' for k in i],
+                       'manifest_id':'m1', 'original_manifest':'m1.csv'})
+
+
+@pytest.fixture
+def log(tmp_path):
+  return MasterSheetLog(ManifestStore(str(tmp_path)))
+
+
+def quiet(f, *args, **kw):
+  with contextlib.redirect_stdout(io.StringIO()):
+    return f(*args, **kw)
+
+
+def test_compare_consistency_log(log):
+  ref = sheet(50)
+  target = pd.concat([ref, sheet(20, 50).assign(manifest_id='m2')], ignore_index=True)
+  assert quiet(compare_consistency, target, ref, log=log) is None
+  assert log.head==2
+  pd.testing.assert_frame_equal(log.materialize(), target)
+  pd.testing.assert_frame_equal(log.materialize(1), ref)
+  # a new entry reusing the GP2ID of another clinical_id is not appended
+  bad = pd.concat([target, sheet(1, 70).assign(GP2ID='PD-000003')], ignore_index=True)
+  issues = quiet(compare_consistency, bad, target, log=log)
+  assert list(issues.issue)==['GP2ID of another clinical_id'] and log.head==2
+  # an existing entry changed and another one removed
+  changed = target.drop(index=5).reset_index(drop=True)
+  changed.loc[0, 'clinical_id'] = 'c999'
+  changed = pd.concat([changed, sheet(1, 80)], ignore_index=True)
+  issues = quiet(compare_consistency, changed, target, log=log)
+  assert issues[['GP2sampleID', 'issue', 'existing']].values.tolist()==[
+    ['PD-000000_s1', 'clinical_id changed', 'c0'], ['PD-000005_s1', 'removed from the target', 'PD-000005_s1']]
+  assert issues.value[0]=='c999'
+  assert log.head==2
+  pd.testing.assert_frame_equal(log.materialize(), target)
+
+
+def test_materialize_deltas(log):
+  base = sheet(10)
+  base = pd.concat([base, base.iloc[[3]]], ignore_index=True) # duplicated key in the base
+  quiet(log.snapshot, base)
+  upd = base.iloc[[3, 5]].assign(sample_id=['u3', 'u5'], DNA_volume=[1.5, 2.5]) # column first in a delta
+  quiet(log.append, upd, 'update')
+  quiet(log.append, base.iloc[[7]], 'delete')
+  quiet(log.append, sheet(2, 10), 'add')
+  expected = base.assign(DNA_volume=float('nan'))
+  expected.loc[[3, 10], ['sample_id', 'DNA_volume']] = ['u3', 1.5]
+  expected.loc[5, ['sample_id', 'DNA_volume']] = ['u5', 2.5]
+  expected = pd.concat([expected.drop(index=7), sheet(2, 10)], ignore_index=True)
+  pd.testing.assert_frame_equal(log.materialize(), expected)
+  quiet(log.compact)
+  pd.testing.assert_frame_equal(log.materialize(), expected)
@@ -0,0 +1,78 @@
+import warnings
+import numpy as np
+import pandas as pd
+from numeric_profile import NumericSketch, profile, quantiles
+from sample_manifest import make_manifest
+
+
+def test_profile_matches_pandas():
+  x = make_manifest(3000, 1)
+  x['age'] = x.age.astype(object)
+  x.loc[5, 'age'] = 'unknown'
+  x['age_at_death'] = np.nan
+  x['r260_280'] = np.where(np.arange(len(x)) % 3==0, np.nan, np.arange(len(x)) % 4 - 0.0)
+  out = profile(x, q=quantiles)
+  for v, r in out['summary'].iterrows():
+    col = pd.to_numeric(x[v].astype(object), errors='coerce').astype(float)
+    assert r.n==col.notna().sum() and r.n_missing==col.isna().sum() and r.n_distinct==col.nunique()
+    np.testing.assert_equal([r['min'], r['mean'], r['max']], [col.min(), col.mean(), col.max()])
+    np.testing.assert_allclose([r[f'q{round(p * 100):02d}'] for p in quantiles], col.quantile(quantiles), rtol=1e-12)
+    if r.n>0:
+      counts, edges = np.histogram(col.dropna(), bins=10)
+      assert np.array_equal(out['hist'][v][0], counts) and np.allclose(out['hist'][v][1], edges)
+    if 0 < r.n_distinct <= 5:
+      pd.testing.assert_series_equal(out['values'][v].sort_index(), col.value_counts(dropna=False).sort_index())
+  assert 'age_at_death' not in out['hist']
+  assert list(profile(x)['summary'].columns)==['n', 'n_missing', 'n_distinct', 'min', 'mean', 'max']
+
+
+def manifest_with_violations():
+  x = make_manifest(5000, 2)
+  x.loc[[7, 4321], 'age'] = 130
+  x.loc[[10, 2600], 'age_of_onset'] = x.loc[[10, 2600], 'age'] + 1
+  x.loc[3, 'DNA_conc'] = -1
+  return x
+
+
+def test_sketch_matches_profile():
+  x = manifest_with_violations()
+  exact = profile(x, q=quantiles)
+  chunked = NumericSketch()
+  for i in range(0, len(x), 1000):
+    chunked.update(x.iloc[i:i + 1000])
+  half = len(x) // 2
+  merged = NumericSketch().update(x.iloc[half:], offset=half).merge(NumericSketch().update(x.iloc[:half]))
+  a, b = chunked.result(), merged.result()
+  pd.testing.assert_frame_equal(a['summary'], b['summary'])
+  pd.testing.assert_frame_equal(a['violations'], b['violations'])
+  s, e = a['summary'], exact['summary']
+  for v in ['n', 'n_missing', 'min', 'max']:
+    pd.testing.assert_series_equal(s[v], e[v])
+  np.testing.assert_allclose(s['mean'], e['mean'], rtol=1e-12)
+  small = e.n_distinct < chunked.k
+  pd.testing.assert_series_equal(s.n_distinct[small], e.n_distinct[small])
+  for p in quantiles:
+    v = f'q{round(p * 100):02d}'
+    np.testing.assert_allclose(s[v], e[v], rtol=2 * chunked.alpha, atol=chunked.min_abs)
+  assert list(a['violations'].check)==list(exact['violations'].check)
+  for r, t in zip(a['violations'].rows, exact['violations'].rows):
+    assert np.array_equal(r, t)
+  rows = dict(zip(exact['violations'].check, exact['violations'].rows))
+  assert set(rows['age not in [0, 120]'])>={7, 4321} and set(rows['age_of_onset > age'])>={10, 2600}
+  assert list(rows['DNA_conc not in [0, inf]'])==[3]
+  for v in a['hist']:
+    assert a['hist'][v][0].sum()==exact['hist'][v][0].sum()
+    np.testing.assert_allclose(a['hist'][v][1], exact['hist'][v][1])
+
+
+def test_infinite_values():
+  x = pd.DataFrame({'DNA_conc':['1.5', 'inf', '3', None], 'r260_280':[-np.inf, np.inf, np.nan, np.nan]})
+  with warnings.catch_warnings():
+    warnings.simplefilter('error', RuntimeWarning)
+    out = profile(x, ['DNA_conc', 'r260_280'])
+    sketch = NumericSketch(['DNA_conc', 'r260_280']).update(x).result(q=[0.5])
+  for res in [out, sketch]:
+    assert res['summary'].loc['DNA_conc', 'max']==np.inf and res['summary'].loc['DNA_conc', 'n']==3
+    counts, edges = res['hist']['DNA_conc']
+    assert counts.sum()==2 and edges[0]==1.5 and edges[-1]==3
+    assert 'r260_280' not in res['hist']
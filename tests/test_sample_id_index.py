@@ -0,0 +1,44 @@
+import contextlib
+import io
+import os
+import numpy as np
+import pytest
+from manifest_store import ManifestStore
+from manifest_func2 import checkSampleManifest, giveGP2ID
+from manifest_utils import canonical_id
+from sample_id_index import SampleIDIndex, build_index, hash_ids
+from sample_manifest import make_manifest, split_manifests
+
+
+@pytest.fixture(scope='module')
+def manifests():
+  with contextlib.redirect_stdout(io.StringIO()):
+    x = checkSampleManifest(make_manifest(300, 1, qced=True), dup_not_allowed=False)
+  return split_manifests(x, 3)
+
+
+def test_build_index_and_assign(tmp_path, manifests, monkeypatch):
+  store = ManifestStore(str(tmp_path))
+  for sub in ['qced', 'finalized']:
+    os.makedirs(store.folder(sub), exist_ok=True)
+  with contextlib.redirect_stdout(io.StringIO()):
+    for mid in ['m1', 'm2']:
+      giveGP2ID(manifests[mid], mid, store=store)
+      for name in store.list('qced'):
+        os.replace(store.path('qced', name), store.path('finalized', name))
+    saves = []
+    save = SampleIDIndex._save_keys
+    monkeypatch.setattr(SampleIDIndex, '_save_keys', lambda self, keys: saves.append(len(keys)) or save(self, keys))
+    path = str(tmp_path / 'index.sqlite')
+    build_index(path, store=store).close()
+    assert len(saves)==1 # the hash array is written once
+    # the assigned manifest is added to the index
+    giveGP2ID(manifests['m3'], 'm3', store=store, sample_index=path)
+  index = SampleIDIndex(path, read_only=True)
+  ids = [v for m in manifests.values() for c in ['sample_id', 'alternative_id1', 'alternative_id2']
+         if c in m.columns for v in canonical_id(m[c]).dropna()]
+  assert np.array_equal(index.keys, np.unique(hash_ids(ids)))
+  hits = index.collisions(manifests['m3'])
+  assert set(hits.manifest_id)=={'m3'} and hits.id.nunique()==manifests['m3'].sample_id.nunique()
+  assert len(index.collisions(manifests['m3'], manifest=('PDSTUDY', 'm3')))==0
+  index.close()
@@ -0,0 +1,35 @@
+import json
+import time
+import numpy as np
+from stage_timer import StageTimer, null_timer
+
+
+def test_lap_and_report(tmp_path):
+  path = tmp_path / 'stages.jsonl'
+  with StageTimer(memory=True, log_path=str(path), file='m.csv') as timer:
+    time.sleep(0.05)
+    timer.lap('sleep')
+    x = np.ones(2**20) # 8 MB
+    timer.lap('alloc')
+    del x
+    time.sleep(0.05)
+    timer.reset() # not recorded
+    with timer.stage('noop'):
+      pass
+  report = timer.report()
+  assert report.columns.tolist()==['stage', 'wall_sec', 'cpu_sec', 'peak_mb']
+  assert report.stage.tolist()==['sleep', 'alloc', 'noop']
+  assert report.wall_sec[0] >= 0.05 and report.wall_sec[2] < 0.05 and report.cpu_sec[0] < 0.05
+  assert report.peak_mb[1] >= 8 and report.peak_mb[0] < 1
+  lines = [json.loads(v) for v in path.read_text().splitlines()]
+  assert [v['stage'] for v in lines]==['sleep', 'alloc', 'noop'] and all(v['file']=='m.csv' for v in lines)
+
+
+def test_disabled():
+  null_timer.lap('x')
+  with null_timer.stage('y'):
+    pass
+  assert len(null_timer.records)==0
+  timer = StageTimer()
+  timer.lap('a')
+  assert timer.report().columns.tolist()==['stage', 'wall_sec', 'cpu_sec']